@@ -0,0 +1,309 @@
+"""
+Images stored in uncompressed tar shards (e.g. WebDataset) and zip archives, read without extracting them.
+
+Members of an archive are listed once and their offsets are saved in an index (output/archive_index),
+so a member is read with one positioned read (os.pread) from any thread, without scanning the archive again.
+A member is addressed by a virtual path: path of the archive joined with the member name
+(e.g. data/shard-000.tar/0001.jpg), so the rest of the app handles it like a file in a sub-folder.
+"""
+import hashlib
+import io
+import os
+import struct
+import tarfile
+import threading
+import zipfile
+import zlib
+
+import numpy as np
+
+from scanning import IMG_EXTENSIONS
+from sources import SourceStat, get_source
+
+ARCHIVE_EXTENSIONS = ('.tar', '.zip')
+INDEX_VERSION = 1
+
+# zip local file header: signature, version, flags, method, time, date, crc, compressed size, size,
+# name length, extra field length
+_ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_ZIP_LOCAL_SIGNATURE = 0x04034b50
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class ArchiveIndex:
+    """
+    Offset table of members of one archive: name, offset of the data, stored size, size and compression
+    (0 = stored, 8 = deflate).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.stored_sizes = np.zeros(0, dtype=np.int64)
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.methods = np.zeros(0, dtype=np.uint8)
+        self.name_to_int = {}
+        self.mtime_ns = 0
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def build(self, extensions=IMG_EXTENSIONS):
+        """
+        Lists members of the archive (images only)
+        """
+        stat = os.stat(self.path)
+        rows = self._list_zip(extensions) if self.path.lower().endswith('.zip') else self._list_tar(extensions)
+        self._set_rows(rows)
+        self.mtime_ns = stat.st_mtime_ns
+
+    def _list_tar(self, extensions):
+        rows = []
+        # 'r:' = uncompressed tar, compressed tar can't be read at random positions
+        with tarfile.open(self.path, 'r:') as tar:
+            for member in tar:
+                if member.isfile() and member.name.lower().endswith(extensions):
+                    rows.append((member.name, member.offset_data, member.size, member.size, 0))
+        return rows
+
+    def _list_zip(self, extensions):
+        rows = []
+        with zipfile.ZipFile(self.path) as archive, open(self.path, 'rb') as f:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(extensions):
+                    continue
+                if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    print(f'{self.path}: {info.filename} uses unsupported compression, skipped')
+                    continue
+
+                # the data starts after the local header, whose extra field can differ from the central directory
+                f.seek(info.header_offset)
+                header = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+                if header[0] != _ZIP_LOCAL_SIGNATURE:
+                    print(f'{self.path}: bad local header of {info.filename}, skipped')
+                    continue
+                offset = info.header_offset + _ZIP_LOCAL_HEADER.size + header[9] + header[10]
+                rows.append((info.filename, offset, info.compress_size, info.file_size, info.compress_type))
+        return rows
+
+    def _set_rows(self, rows):
+        self.names = [row[0] for row in rows]
+        self.offsets = np.array([row[1] for row in rows], dtype=np.int64)
+        self.stored_sizes = np.array([row[2] for row in rows], dtype=np.int64)
+        self.sizes = np.array([row[3] for row in rows], dtype=np.int64)
+        self.methods = np.array([row[4] for row in rows], dtype=np.uint8)
+        self.name_to_int = {name: i for i, name in enumerate(self.names)}
+
+    def load(self, path):
+        """
+        Loads saved index. The index is valid only if the archive didn't change.
+        :return: True if the index was loaded
+        """
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != INDEX_VERSION or int(data['mtime_ns']) != os.stat(self.path).st_mtime_ns:
+                    return False
+                self.names = data['names'].tolist()
+                self.offsets = data['offsets']
+                self.stored_sizes = data['stored_sizes']
+                self.sizes = data['sizes']
+                self.methods = data['methods']
+                self.mtime_ns = int(data['mtime_ns'])
+        except FileNotFoundError:
+            return False
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Can't read archive index {path}: {e}")
+            return False
+
+        self.name_to_int = {name: i for i, name in enumerate(self.names)}
+        return True
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, mtime_ns=self.mtime_ns, names=np.array(self.names, dtype=str),
+                     offsets=self.offsets, stored_sizes=self.stored_sizes, sizes=self.sizes, methods=self.methods)
+        os.replace(tmp_path, path)
+
+    def read(self, name):
+        """
+        :param name: member name
+        :return: bytes of the member
+        """
+        i = self.name_to_int[name]
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY)
+            fd = self._fd
+
+        # positioned read doesn't move the file position, so threads can share the descriptor
+        data = os.pread(fd, int(self.stored_sizes[i]), int(self.offsets[i]))
+        if self.methods[i] == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        return data
+
+    def stat(self, name):
+        return SourceStat(int(self.sizes[self.name_to_int[name]]), self.mtime_ns)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+# opened archives {archive path: ArchiveIndex}, shared by all threads
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def open_archive(path, index_folder=None, extensions=IMG_EXTENSIONS):
+    """
+    Returns index of the archive. The index is loaded from index_folder or built (and saved there).
+    """
+    with _archives_lock:
+        archive = _archives.get(path)
+    if archive is not None:
+        return archive
+
+    archive = ArchiveIndex(path)
+    index_path = None
+    if index_folder is not None:
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8', 'surrogateescape')).hexdigest()
+        index_path = os.path.join(index_folder, f'{digest}.npz')
+
+    if index_path is None or not archive.load(index_path):
+        archive.build(extensions)
+        if index_path is not None:
+            try:
+                archive.save(index_path)
+            except OSError as e:
+                print(f"Can't save archive index: {e}")
+
+    with _archives_lock:
+        return _archives.setdefault(path, archive)
+
+
+def close_archives():
+    with _archives_lock:
+        for archive in _archives.values():
+            archive.close()
+        _archives.clear()
+
+
+def split_member_path(path):
+    """
+    :param path: path of an image
+    :return: (archive, member name) if the path points into an opened archive, otherwise None
+    """
+    lower = path.lower()
+    for extension in ARCHIVE_EXTENSIONS:
+        start = 0
+        while True:
+            i = lower.find(extension + os.sep, start)
+            if i < 0:
+                break
+            end = i + len(extension)
+            with _archives_lock:
+                archive = _archives.get(path[:end])
+            if archive is not None:
+                return archive, path[end + 1:].replace(os.sep, '/')
+            start = end
+    return None
+
+
+def expand_archives(paths, index_folder=None, extensions=IMG_EXTENSIONS):
+    """
+    Generator of image paths where archives are replaced by virtual paths of their members
+    :param paths: paths of images and archives
+    """
+    for path in paths:
+        if not is_archive(path):
+            yield path
+            continue
+
+        try:
+            archive = open_archive(path, index_folder, extensions)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            print(f"Can't read archive {path}: {e}")
+            continue
+        for name in archive.names:
+            yield os.path.join(path, *name.split('/'))
+
+
+def read_bytes(path):
+    """
+    :return: content of the file, archive member or remote image (see sources.py)
+    """
+    member = split_member_path(path)
+    if member is not None:
+        return member[0].read(member[1])
+    return get_source(path).read_bytes(path)
+
+
+def read_head(path, length):
+    """
+    :return: first length bytes of the file or remote image (a range request), whole archive member
+    """
+    member = split_member_path(path)
+    if member is not None:
+        return member[0].read(member[1])
+    return get_source(path).read_range(path, 0, length)
+
+
+def stat_image(path):
+    """
+    :return: os.stat_result of the file, or SourceStat (size of the member and mtime of the archive,
+        size and mtime of a remote image)
+    """
+    member = split_member_path(path)
+    if member is not None:
+        return member[0].stat(member[1])
+    return get_source(path).stat(path)
+
+
+def write_label_shards(folder, labels, items, max_members=10000):
+    """
+    Writes labeled archive members into uncompressed tar shards of each label:
+    <folder>/<label>/<label>-000000.tar, <label>-000001.tar, ... Shards are written again from scratch,
+    so they always match current labels. Members are named by the key of the image.
+    :param folder: folder with label folders
+    :param labels: list of all labels
+    :param items: list of (key, path, labels of the image)
+    :param max_members: maximal number of members in one shard
+    :return: number of written members
+    """
+    members = {label: [] for label in labels}
+    for key, path, image_labels in items:
+        for label in image_labels:
+            members[label].append((key, path))
+
+    written = 0
+    for label, label_members in members.items():
+        label_folder = os.path.join(folder, label)
+        shards = []
+        for start in range(0, len(label_members), max_members):
+            shard_path = os.path.join(label_folder, f'{label}-{len(shards):06d}.tar')
+            os.makedirs(label_folder, exist_ok=True)
+            tmp_path = shard_path + '.tmp'
+            with tarfile.open(tmp_path, 'w', format=tarfile.PAX_FORMAT) as tar:
+                for key, path in label_members[start:start + max_members]:
+                    data = read_bytes(path)
+                    info = tarfile.TarInfo(key)
+                    info.size = len(data)
+                    info.mtime = stat_image(path).st_mtime_ns // 1_000_000_000
+                    tar.addfile(info, io.BytesIO(data))
+                    written += 1
+            os.replace(tmp_path, shard_path)
+            shards.append(shard_path)
+
+        # shards left from a session with more labeled images
+        i = len(shards)
+        while os.path.exists(os.path.join(label_folder, f'{label}-{i:06d}.tar')):
+            os.remove(os.path.join(label_folder, f'{label}-{i:06d}.tar'))
+            i += 1
+    return written
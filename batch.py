@@ -0,0 +1,224 @@
+"""
+Headless batch mode: applies labels from a csv file (in the format generated by the app) to a folder with images.
+Images are copied / moved / linked into label folders the same way as in the app, without any GUI.
+
+usage: python batch.py labels.csv /path/to/images --mode copy --workers 8
+"""
+import argparse
+import csv
+import os
+import sys
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from file_ops import COPY_METHODS, copy_file, make_folder, move_file
+from label_store import METADATA_COLUMNS
+from scanning import scan_img_paths
+
+
+def read_label_csv(path):
+    """
+    Reads csv file with one-hot encoded labels (header: img, label1, label2, ...). Image metadata columns
+    (written by the app when enabled) are skipped.
+    :param path: path to the csv file
+    :return: list of labels and list of (img_name, [assigned labels]) tuples
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        labels = header[1:]
+        if tuple(labels[-len(METADATA_COLUMNS):]) == METADATA_COLUMNS:
+            labels = labels[:-len(METADATA_COLUMNS)]
+
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            assigned = [label for label, value in zip(labels, row[1:]) if value.strip() not in ('', '0')]
+            rows.append((row[0], assigned))
+
+    return labels, rows
+
+
+def plan_operations(img_path, labels, input_folder, mode, img_key=None):
+    """
+    Plans file operations which put the image into its label folders (same as the app does)
+    :param img_path: current path of the image
+    :param labels: labels assigned to the image
+    :param input_folder: folder with label folders
+    :param mode: 'copy' (copy to all label folders), 'move' (move to first label folder, copy to the rest)
+        or 'link' (hardlink to all label folders)
+    :param img_key: path of the image relative to input folder ('sub/img1.jpg'), label folders mirror
+        its sub-folders. Default: image name
+    :return: list of (operation, source path, destination folder) tuples
+    """
+    if not labels:
+        return []
+
+    img_name = os.path.basename(img_path)
+    sub_folders = (img_key or img_name).split('/')[:-1]
+    label_folders = [os.path.join(input_folder, label, *sub_folders) for label in labels]
+
+    if mode == 'move':
+        ops = [('move', img_path, label_folders[0])]
+        moved_path = os.path.join(label_folders[0], img_name)
+        ops += [('copy', moved_path, folder) for folder in label_folders[1:]]
+        return ops
+
+    op = 'link' if mode == 'link' else 'copy'
+    return [(op, img_path, folder) for folder in label_folders]
+
+
+def apply_operations(img_name, ops, copy_method='copy'):
+    """
+    Executes planned operations of one image. Operations which were already done by an interrupted run
+    are skipped, so the image can be processed again.
+    :return: image name and error message ('' if everything succeeded)
+    """
+    try:
+        for op, src, dst_folder in ops:
+            dst = os.path.join(dst_folder, os.path.basename(src))
+            if op == 'move':
+                # image was moved by the interrupted run
+                if os.path.abspath(src) == os.path.abspath(dst) or (not os.path.exists(src) and os.path.exists(dst)):
+                    continue
+                move_file(src, dst_folder)
+            elif op == 'link':
+                copy_file(src, dst_folder, 'hardlink')
+            else:
+                copy_file(src, dst_folder, copy_method)
+    except Exception as e:
+        return img_name, str(e)
+
+    return img_name, ''
+
+
+def load_progress(path):
+    """
+    :return: set of image names which were already processed
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return set(line.rstrip('\n') for line in f)
+    except FileNotFoundError:
+        return set()
+
+
+def find_images(input_folder, img_names, recursive, exclude_dirs):
+    """
+    :param img_names: image names or paths relative to input folder ('sub/img1.jpg'), as in the csv
+    :return: {img_name: path} of images from img_names found in the input folder
+    """
+    wanted = set(img_names)
+    found = {}
+    for path in scan_img_paths(input_folder, recursive=recursive, exclude_dirs=exclude_dirs):
+        key = os.path.relpath(path, input_folder).replace(os.sep, '/')
+        if key in wanted:
+            found[key] = path
+            continue
+
+        # csv generated by older versions contains only image names
+        name = os.path.basename(path)
+        if name in wanted:
+            if name in found:
+                print(f'Warning: {name} found more than once, using {found[name]}')
+                continue
+            found[name] = path
+    return found
+
+
+def run(args):
+    labels, rows = read_label_csv(args.labels_csv)
+    output_folder = os.path.join(args.input_folder, 'output')
+    progress_path = args.progress or os.path.join(output_folder, f'batch_progress_{args.mode}.log')
+
+    done = set() if args.restart else load_progress(progress_path)
+    img_paths = find_images(args.input_folder, [img_name for img_name, _ in rows], args.recursive,
+                            labels + ['output'])
+
+    tasks = []
+    missing = []
+    label_counts = Counter()
+    for img_name, assigned in rows:
+        if img_name in done or not assigned:
+            continue
+        img_path = img_paths.get(img_name)
+        if img_path is None and args.mode == 'move':
+            # image could be moved to its first label folder by interrupted run
+            moved_path = os.path.join(args.input_folder, assigned[0], *img_name.split('/'))
+            img_path = moved_path if os.path.exists(moved_path) else None
+        if img_path is None:
+            missing.append(img_name)
+            continue
+        tasks.append((img_name, plan_operations(img_path, assigned, args.input_folder, args.mode, img_name)))
+        label_counts.update(assigned)
+
+    if args.dry_run:
+        op_counts = Counter(op for _, ops in tasks for op, _, _ in ops)
+        print(f'images in csv: {len(rows)}, already done: {len(done)}, to process: {len(tasks)}, '
+              f'missing: {len(missing)}')
+        print('operations: ' + ', '.join(f'{op}: {count}' for op, count in sorted(op_counts.items())))
+        for label in labels:
+            print(f'  {label}: {label_counts[label]}')
+        for img_name in missing[:20]:
+            print(f'  missing: {img_name}')
+        return 0
+
+    for label in labels:
+        make_folder(os.path.join(args.input_folder, label))
+    make_folder(os.path.dirname(os.path.abspath(progress_path)))
+
+    executor_class = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    errors = 0
+    finished = 0
+    progress = open(progress_path, 'a', encoding='utf-8')
+    with executor_class(max_workers=args.workers) as executor, progress:
+        pending = set()
+        task_iter = iter(tasks)
+
+        while True:
+            # limited number of tasks is submitted at once, so memory doesn't grow with the number of images
+            for img_name, ops in task_iter:
+                pending.add(executor.submit(apply_operations, img_name, ops, args.copy_method))
+                if len(pending) >= args.workers * 64:
+                    break
+            if not pending:
+                break
+
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                img_name, error = future.result()
+                finished += 1
+                if error:
+                    errors += 1
+                    print(f'{img_name}: {error}')
+                else:
+                    progress.write(img_name + '\n')
+
+            if finished % 1000 < len(completed):
+                progress.flush()
+                print(f'{finished} of {len(tasks)} images processed')
+
+    print(f'done: {finished - errors} images processed, {errors} errors, {len(missing)} missing')
+    return 1 if errors else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Copy / move / link images into label folders '
+                                                 'according to csv file with one-hot encoded labels.')
+    parser.add_argument('labels_csv', help='csv file with header "img,label1,label2,..." and 0/1 values')
+    parser.add_argument('input_folder', help='folder with images, label folders are created in it')
+    parser.add_argument('--mode', choices=('copy', 'move', 'link'), default='copy')
+    parser.add_argument('--copy-method', choices=COPY_METHODS, default='copy',
+                        help='how files are copied in copy mode')
+    parser.add_argument('--recursive', action='store_true', help='look for images in sub-folders too')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--processes', action='store_true', help='use process pool instead of thread pool')
+    parser.add_argument('--progress', help='progress file (default: input_folder/output/batch_progress_MODE.log)')
+    parser.add_argument('--restart', action='store_true', help='ignore progress of previous run')
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be done')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(run(parse_args()))
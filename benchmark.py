@@ -0,0 +1,290 @@
+"""
+Benchmarks of the hot paths of the app: folder scan, image decode, labeling in all modes and exports.
+A synthetic dataset is generated, so the results are reproducible. Runs without display (Qt offscreen platform)
+and writes results as json, so they can be compared between versions.
+
+usage: python benchmark.py --files 500 --width 4000 --height 3000 --formats jpg,png --nested 4 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+from PyQt5.QtCore import QT_VERSION_STR, Qt
+from PyQt5.QtGui import QImage
+from PyQt5.QtTest import QTest
+from PyQt5.QtWidgets import QApplication
+
+from main import LabelerWindow, get_img_paths
+
+
+def generate_dataset(folder, num_files, width, height, formats=('jpg',), nested=0, seed=0):
+    """
+    Generates folder with synthetic images (smooth gradients with noise, so they compress like photos)
+    :param folder: destination folder (created)
+    :param num_files: number of images
+    :param width: width of images
+    :param height: height of images
+    :param formats: image formats, images use them in turns
+    :param nested: number of sub-folders the images are spread into (0 = all images in folder)
+    :param seed: seed of the random generator
+    :return: list of paths of generated images
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    # a few base images are generated and saved under different names, encoding is the slow part anyway
+    y, x = np.mgrid[0:height, 0:width]
+    bases = []
+    for _ in range(min(num_files, 4)):
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        for c in range(3):
+            fx, fy = rng.uniform(0.5, 4, size=2)
+            pixels[..., c] = (127 + 100 * np.sin(x / width * fx * np.pi) * np.cos(y / height * fy * np.pi) +
+                              rng.normal(0, 12, size=(height, width))).clip(0, 255)
+        image = QImage(pixels.data, width, height, 3 * width, QImage.Format_RGB888).copy()
+        bases.append(image)
+
+    paths = []
+    for i in range(num_files):
+        sub_folder = folder if nested == 0 else os.path.join(folder, f'sub{i % nested:03d}')
+        os.makedirs(sub_folder, exist_ok=True)
+        path = os.path.join(sub_folder, f'img{i:07d}.{formats[i % len(formats)]}')
+        bases[i % len(bases)].save(path)
+        paths.append(path)
+
+    return paths
+
+
+def summarize(durations):
+    """
+    :param durations: list of durations in seconds
+    :return: dict with statistics in milliseconds
+    """
+    durations_ms = sorted(d * 1000 for d in durations)
+    return {
+        'count': len(durations_ms),
+        'total_ms': sum(durations_ms),
+        'min_ms': durations_ms[0],
+        'median_ms': statistics.median(durations_ms),
+        'mean_ms': statistics.fmean(durations_ms),
+        'p95_ms': durations_ms[min(len(durations_ms) - 1, int(0.95 * len(durations_ms)))],
+        'max_ms': durations_ms[-1],
+    }
+
+
+def measure(fn, repeat=1, setup=None):
+    """
+    :return: list of durations (in seconds) of repeated calls of fn
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def open_window(app, labels, folder, mode, recursive, prefetch=False):
+    """
+    Opens LabelerWindow and waits for the scan. Without prefetching each measured decode is a cold one.
+    """
+    if prefetch:
+        window = LabelerWindow(labels, folder, mode, recursive=recursive, duplicates='ignore')
+    else:
+        window = LabelerWindow(labels, folder, mode, recursive=recursive, prefetch_ahead=0, prefetch_behind=0,
+                               duplicates='ignore')
+    window.scanner.wait()
+    app.processEvents()
+    return window
+
+
+def close_window(app, window):
+    window.close()
+    app.processEvents()
+
+
+def bench_labeling(app, results, labels, dataset, workdir, mode, recursive, max_images):
+    """
+    Measures set_label in given mode on a fresh copy of the dataset (copy and move modes change the folder)
+    """
+    folder = os.path.join(workdir, f'label_{mode}')
+    shutil.copytree(dataset, folder)
+    window = open_window(app, labels, folder, mode, recursive)
+
+    num_images = min(max_images, window.num_images)
+    call_durations = []
+    start = time.perf_counter()
+    for i in range(num_images):
+        window.counter = i
+        for label in labels[:2]:
+            call_durations += measure(lambda: window.set_label(label))
+    # copy/move operations run in background, total time includes them
+    window.file_ops.join()
+    total = time.perf_counter() - start
+
+    results[f'set_label_{mode}'] = summarize(call_durations)
+    results[f'set_label_{mode}']['total_with_file_ops_ms'] = total * 1000
+    close_window(app, window)
+
+
+def bench_input(app, labels, dataset, workdir, recursive, rate, num_images):
+    """
+    Measures whether keyboard input at given rate is handled without loss. Synthetic annotator presses a label
+    number and the right arrow for each image at a fixed rate without waiting for the image (open loop).
+    Keys which come while the GUI thread is busy are delivered in a burst, as the window system does.
+    Input is lost when a label lands on another image than the intended one or an image is skipped.
+    Each rate runs on a fresh copy of the dataset, so labels and position of the previous run aren't resumed.
+    :param rate: images per second (two key presses per image)
+    :return: dict with results
+    """
+    folder = tempfile.mkdtemp(prefix='input_', dir=workdir)
+    # output of previous runs (journal, labels) is left out
+    shutil.copytree(dataset, folder, dirs_exist_ok=True,
+                    ignore=lambda path, names: ['output'] if path == dataset else [])
+    window = open_window(app, labels, folder, 'csv', recursive, prefetch=True)
+    window.show()
+    window.activateWindow()
+    QTest.qWaitForWindowActive(window)
+
+    num_images = min(num_images, window.num_images - 1)
+    keys = []
+    for i in range(num_images):
+        keys += [Qt.Key_1 + i % 2, Qt.Key_Right]
+
+    interval = 1 / (2 * rate)
+    sent = 0
+    start = time.perf_counter()
+    while sent < len(keys):
+        due = min(len(keys), int((time.perf_counter() - start) / interval) + 1)
+        while sent < due:
+            QTest.keyClick(window, keys[sent])
+            sent += 1
+        app.processEvents()
+        time.sleep(0.0005)
+    elapsed = time.perf_counter() - start
+
+    correct = sum(window.label_store.get_labels(window.image_index.key(i)) == [labels[i % 2]]
+                  for i in range(num_images))
+    result = {
+        'rate_images_per_s': rate,
+        'achieved_rate_images_per_s': num_images / elapsed,
+        'images': num_images,
+        'correct': correct,
+        'lossless': correct == num_images,
+        'queued_navigations': window.input_stats['queued'],
+    }
+    close_window(app, window)
+    return result
+
+
+def run(args):
+    app = QApplication.instance() or QApplication(sys.argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='annotation_benchmark_')
+    dataset = os.path.join(workdir, 'dataset')
+    labels = [f'label{i}' for i in range(args.labels)]
+    recursive = args.nested > 0
+    results = {}
+
+    start = time.perf_counter()
+    generate_dataset(dataset, args.files, args.width, args.height, args.formats.split(','), args.nested, args.seed)
+    print(f'dataset generated in {time.perf_counter() - start:.1f} s ({workdir})')
+
+    # folder scan
+    results['get_img_paths'] = summarize(measure(lambda: get_img_paths(dataset, recursive=recursive), args.repeat))
+
+    # decode + scale (cache is cleared, so every call decodes the image)
+    window = open_window(app, labels, dataset, 'csv', recursive)
+    paths = window.img_paths[:args.max_images]
+    decode_durations = []
+    for path in paths:
+        decode_durations += measure(lambda: window.set_image(path), args.repeat, setup=window.image_cache.clear)
+    results['set_image'] = summarize(decode_durations)
+
+    # cached images (as after prefetch)
+    cached_durations = []
+    for path in paths:
+        window.set_image(path)
+        cached_durations += measure(lambda: window.set_image(path), args.repeat)
+    results['set_image_cached'] = summarize(cached_durations)
+
+    # exports with synthetic labels of args.export_images images
+    rng = np.random.default_rng(args.seed)
+    for i in range(args.export_images):
+        img_name = f'synthetic{i:08d}.jpg'
+        for j in rng.choice(len(labels), size=rng.integers(1, 3), replace=False):
+            window.label_store.set(img_name, labels[j], True)
+    results['generate_csv'] = summarize(measure(lambda: window.generate_csv('benchmark'), args.repeat))
+    xlsx_path = os.path.join(dataset, 'output', 'benchmark.xlsx')
+    results['export_xlsx'] = summarize(measure(lambda: window.label_store.export_xlsx(xlsx_path), args.repeat))
+    close_window(app, window)
+
+    for mode in ('csv', 'copy', 'move'):
+        bench_labeling(app, results, labels, dataset, workdir, mode, recursive, args.max_images)
+
+    # sustained keyboard input
+    input_results = [bench_input(app, labels, dataset, workdir, recursive, float(rate), args.max_images)
+                     for rate in args.input_rates.split(',')]
+    lossless = [result['rate_images_per_s'] for result in input_results if result['lossless']]
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'platform': platform.platform(),
+            'params': vars(args),
+        },
+        'results': results,
+        'input': {
+            'max_lossless_rate_images_per_s': max(lossless) if lossless else 0.0,
+            'rates': input_results,
+        },
+    }
+
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, stats in results.items():
+        print(f'{name:20s} median {stats["median_ms"]:9.2f} ms   p95 {stats["p95_ms"]:9.2f} ms   n={stats["count"]}')
+    for result in input_results:
+        print(f'input {result["rate_images_per_s"]:6.1f} images/s: {result["correct"]} of {result["images"]} '
+              f'labeled correctly, {result["queued_navigations"]} navigations queued')
+    print(f'results saved to: {args.output}')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of scan, decode, label and export hot paths.')
+    parser.add_argument('--files', type=int, default=200, help='number of generated images')
+    parser.add_argument('--width', type=int, default=2000)
+    parser.add_argument('--height', type=int, default=1500)
+    parser.add_argument('--formats', default='jpg,png', help='comma separated image formats')
+    parser.add_argument('--nested', type=int, default=0, help='number of sub-folders (0 = flat folder)')
+    parser.add_argument('--labels', type=int, default=10, help='number of labels')
+    parser.add_argument('--max-images', type=int, default=50, help='number of images used for decode and labeling')
+    parser.add_argument('--export-images', type=int, default=100000, help='number of labeled images exported')
+    parser.add_argument('--input-rates', default='2,5,10,20,50',
+                        help='comma separated rates (images per second) of synthetic keyboard input')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='folder for generated data (default: new temporary folder)')
+    parser.add_argument('--keep', action='store_true', help="don't delete generated data")
+    parser.add_argument('--output', default='benchmark_results.json')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run(parse_args())
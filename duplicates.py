@@ -0,0 +1,337 @@
+"""
+Perceptual hashes of images and index of near duplicates.
+
+Images are decoded at a tiny size (the reader downscales while decoding), hashes of a whole batch are computed
+at once with NumPy and stored in a BK-tree, so looking up images within a hamming distance doesn't compare
+the hash with all images. Hashes are cached in output/image_hashes.npz, so they are computed only once.
+"""
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtCore import QSize, QThread, Qt, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from archives import stat_image
+from instrumentation import profiler
+from prefetch import image_reader
+
+HASH_METHODS = ('dhash', 'phash')
+# what happens with near duplicates of a labeled image
+DUPLICATE_MODES = ('ignore', 'offer', 'label automatically')
+HASHES_FILENAME = 'image_hashes.npz'
+
+# size of the decoded grayscale image for each method (width, height)
+_HASH_INPUT_SIZE = {'dhash': (9, 8), 'phash': (32, 32)}
+
+
+def _dct_matrix(n):
+    """
+    :return: orthonormal DCT-II matrix n x n
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def load_gray(path, width, height):
+    """
+    Decodes the image directly at tiny size as grayscale
+    :return: uint8 array (height x width) or None if the image can't be decoded
+    """
+    reader = image_reader(path)
+    reader.setAutoTransform(True)
+    reader.setScaledSize(QSize(width, height))
+    image = reader.read()
+    if image.isNull():
+        return None
+    if image.size() != QSize(width, height):
+        # some formats ignore scaled size
+        image = image.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+    image = image.convertToFormat(QImage.Format_Grayscale8)
+    buffer = image.constBits()
+    buffer.setsize(image.bytesPerLine() * height)
+    # rows of QImage are aligned to 4 bytes
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(height, image.bytesPerLine())[:, :width].copy()
+
+
+def _pack_bits(bits):
+    """
+    :param bits: bool array (n x 64)
+    :return: uint64 array of n hashes
+    """
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def dhash(gray):
+    """
+    Difference hash: each bit tells whether a pixel is brighter than its right neighbour
+    :param gray: uint8 array of images (n x 8 x 9)
+    :return: uint64 array of n hashes
+    """
+    bits = gray[:, :, 1:] > gray[:, :, :-1]
+    return _pack_bits(bits.reshape(len(gray), 64))
+
+
+def phash(gray):
+    """
+    Perceptual hash: each bit tells whether a low frequency DCT coefficient is above their median
+    :param gray: uint8 array of images (n x 32 x 32)
+    :return: uint64 array of n hashes
+    """
+    coefficients = _DCT_32 @ gray.astype(np.float32) @ _DCT_32.T
+    low = coefficients[:, :8, :8].reshape(len(gray), 64)
+    # the DC coefficient is left out of the median, it only says how bright the image is
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return _pack_bits(low > median)
+
+
+def hash_images(paths, method='dhash', executor=None):
+    """
+    :param paths: list of image paths
+    :param method: 'dhash' or 'phash'
+    :param executor: executor for parallel decoding (None = decode in the calling thread)
+    :return: list of hashes (int, None for images which can't be decoded)
+    """
+    width, height = _HASH_INPUT_SIZE[method]
+    with profiler.span('hash.decode'):
+        if executor is None:
+            grays = [load_gray(path, width, height) for path in paths]
+        else:
+            grays = list(executor.map(lambda path: load_gray(path, width, height), paths))
+
+    valid = [i for i, gray in enumerate(grays) if gray is not None]
+    hashes = [None] * len(paths)
+    if valid:
+        with profiler.span('hash.compute'):
+            stack = np.stack([grays[i] for i in valid])
+            values = dhash(stack) if method == 'dhash' else phash(stack)
+        for i, value in zip(valid, values.tolist()):
+            hashes[i] = value
+    return hashes
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    BK-tree of 64 bit hashes with hamming distance. Query for hashes within a small distance visits
+    only the branches whose distance from the node can contain them.
+    """
+
+    def __init__(self):
+        # node = [hash, items with this hash, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def remove(self, value, item):
+        """
+        Removes the item stored with the hash (the node is kept, it is still needed for searching)
+        """
+        node = self.root
+        while node is not None:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                if item in node[1]:
+                    node[1].remove(item)
+                    self.size -= 1
+                return
+            node = node[2].get(distance)
+
+    def query(self, value, max_distance):
+        """
+        :return: list of (distance, item) of items whose hash is within max_distance, nearest first
+        """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found += [(distance, item) for item in node[1]]
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda x: x[0])
+        return found
+
+
+class DuplicateIndex:
+    """
+    Hashes of images (identified by keys) with lookup of near duplicates
+    """
+
+    def __init__(self, max_distance=4):
+        """
+        :param max_distance: maximal hamming distance of hashes of duplicates (0 = only exact duplicates)
+        """
+        self.max_distance = max_distance
+        self.hashes = {}
+        self.tree = BKTree()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, key, value):
+        old = self.hashes.get(key)
+        if old == value:
+            return
+        if old is not None:
+            self.tree.remove(old, key)
+        self.hashes[key] = value
+        self.tree.add(value, key)
+
+    def duplicates(self, key):
+        """
+        :return: keys of near duplicates of the image (without the image itself), nearest first
+        """
+        value = self.hashes.get(key)
+        if value is None:
+            return []
+        return [other for _, other in self.tree.query(value, self.max_distance) if other != key]
+
+
+class HashCache:
+    """
+    Hashes of images saved in the output folder. Entry is valid while size and mtime of the image
+    (of the archive for archive members) don't change.
+    """
+
+    def __init__(self, path, method='dhash'):
+        self.path = path
+        self.method = method
+        self.entries = {}  # {key: (size, mtime_ns, hash)}
+        self.changed = False
+
+    def load(self):
+        try:
+            with np.load(self.path) as data:
+                if str(data['method']) != self.method:
+                    return
+                keys = data['keys'].tolist()
+                self.entries = dict(zip(keys, zip(data['sizes'].tolist(), data['mtimes'].tolist(),
+                                                  data['hashes'].tolist())))
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Can't read image hashes: {e}")
+
+    def save(self):
+        if not self.changed:
+            return
+
+        keys = list(self.entries)
+        values = list(self.entries.values())
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, method=np.array(self.method), keys=np.array(keys, dtype=str),
+                     sizes=np.array([v[0] for v in values], dtype=np.int64),
+                     mtimes=np.array([v[1] for v in values], dtype=np.int64),
+                     hashes=np.array([v[2] for v in values], dtype=np.uint64))
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def get(self, key, stat):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def put(self, key, stat, value):
+        self.entries[key] = (stat.st_size, stat.st_mtime_ns, value)
+        self.changed = True
+
+
+class HashThread(QThread):
+    """
+    Computes hashes of images in background. Images are added with enqueue() as the scanner finds them,
+    hashes are emitted in batches as list of (key, hash).
+    """
+
+    hashed = pyqtSignal(list)
+
+    def __init__(self, cache, batch_size=64, workers=4, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.workers = workers
+        self._queue = queue.Queue()
+
+    def enqueue(self, items):
+        """
+        :param items: list of (key, path) of images
+        """
+        self._queue.put(list(items))
+
+    def stop(self):
+        self.requestInterruption()
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.isInterruptionRequested():
+                items = self._queue.get()
+                if items is None:
+                    break
+
+                for start in range(0, len(items), self.batch_size):
+                    if self.isInterruptionRequested():
+                        break
+                    self.hashed.emit(self.hash_batch(items[start:start + self.batch_size], executor))
+
+    def hash_batch(self, items, executor):
+        """
+        :return: list of (key, hash) of images, cached hashes are used when possible
+        """
+        results = []
+        missing = []
+        for key, path in items:
+            try:
+                stat = stat_image(path)
+            except OSError:
+                continue
+            value = self.cache.get(key, stat)
+            if value is None:
+                missing.append((key, path, stat))
+            else:
+                results.append((key, value))
+
+        if missing:
+            hashes = hash_images([path for _, path, _ in missing], self.cache.method, executor)
+            for (key, path, stat), value in zip(missing, hashes):
+                if value is not None:
+                    self.cache.put(key, stat, value)
+                    results.append((key, value))
+        return results
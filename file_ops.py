@@ -0,0 +1,242 @@
+import os
+import queue
+import shutil
+import threading
+
+from archives import split_member_path
+from instrumentation import profiler
+from sources import remote_source
+
+COPY_METHODS = ('copy', 'hardlink', 'reflink')
+
+# ioctl request which clones file extents (linux/fs.h), supported by btrfs, xfs and others
+FICLONE = 0x40049409
+
+
+def make_folder(directory):
+    """
+    Make folder if it doesn't already exist
+    :param directory: The folder destination path
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+
+def _reflink(src, dst):
+    """
+    Clones src into dst without copying the data. Falls back to copy_file_range (in-kernel copy, which can
+    also share extents or do server-side copy on NFS) and then to the regular copy.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def copy_file(src, dst_folder, method='copy'):
+    """
+    Copies the file into the folder
+    :param src: path to the file
+    :param dst_folder: destination folder
+    :param method: 'copy' (regular copy), 'hardlink' (no data copied, the same file is in both folders) or
+        'reflink' (copy-on-write clone, no data copied until one of the files is changed).
+        hardlink and reflink fall back to regular copy if the filesystem doesn't support them.
+        Members of archives (see archives.py) are always extracted, images of a remote source are copied
+        by the source (see sources.py).
+    :return: path of the new file
+    """
+    remote = remote_source(src)
+    if remote is not None:
+        return remote.copy(src, dst_folder, method)
+
+    # label folders mirror sub-folders of the input folder, so the destination may not exist yet
+    make_folder(dst_folder)
+    dst = os.path.join(dst_folder, os.path.basename(src))
+
+    member = split_member_path(src)
+    if member is not None:
+        with open(dst, 'wb') as f:
+            f.write(member[0].read(member[1]))
+        return dst
+
+    if method == 'hardlink':
+        try:
+            os.link(src, dst)
+            return dst
+        except FileExistsError:
+            os.remove(dst)
+            os.link(src, dst)
+            return dst
+        except OSError:
+            # e.g. different filesystem or filesystem without hardlinks
+            pass
+    elif method == 'reflink':
+        _reflink(src, dst)
+        shutil.copymode(src, dst)
+        return dst
+
+    return shutil.copy(src, dst)
+
+
+def move_file(src, dst_folder):
+    remote = remote_source(src)
+    if remote is not None:
+        return remote.move(src, dst_folder)
+
+    make_folder(dst_folder)
+    return shutil.move(src, dst_folder)
+
+
+def remove_file(path):
+    remote = remote_source(path)
+    if remote is not None:
+        remote.remove(path)
+    else:
+        os.remove(path)
+
+
+OPERATIONS = {
+    'copy': copy_file,
+    'move': move_file,
+    'remove': remove_file,
+}
+
+
+class FileOpQueue:
+    """
+    Runs file operations in a background thread.
+    Operations are executed one by one in the order they were submitted, because operations on the same image
+    depend on each other (e.g. image is moved to label folder and then copied from there to another one).
+    """
+
+    def __init__(self, on_done=None):
+        """
+        :param on_done: callback called (from the worker thread) after each operation (or batch of operations)
+            with the operation tuple (list of tuples) and error message ('' if the operation succeeded)
+        """
+        self.on_done = on_done
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def submit(self, name, *args):
+        """
+        :param name: one of 'copy', 'move', 'remove'
+        :param args: arguments of the operation (see copy_file, move_file, remove_file)
+        """
+        if name not in OPERATIONS:
+            raise ValueError(f'Unknown file operation: {name}')
+
+        with self._lock:
+            self._pending += 1
+        self._queue.put((name,) + args)
+
+    def submit_batch(self, ops):
+        """
+        Submits many operations at once (e.g. when a label is assigned to many images). They are executed
+        as one queue item and on_done is called once for the whole batch.
+        :param ops: list of (name, *args) tuples
+        """
+        for op in ops:
+            if op[0] not in OPERATIONS:
+                raise ValueError(f'Unknown file operation: {op[0]}')
+        if not ops:
+            return
+
+        with self._lock:
+            self._pending += len(ops)
+        self._queue.put(list(ops))
+
+    def submit_call(self, fn, on_done=None, size=1):
+        """
+        Runs fn() in the worker thread after the operations submitted before it (e.g. execution of a commit plan,
+        which depends on them)
+        :param on_done: callback called (from the worker thread) with the return value of fn (None if it failed)
+            and error message ('' if fn succeeded)
+        :param size: number of file operations done by fn, they are counted as pending until fn returns
+        """
+        with self._lock:
+            self._pending += size
+        self._queue.put(('call', fn, on_done, size))
+
+    def join(self):
+        """
+        Waits until all submitted operations are finished
+        """
+        self._queue.join()
+
+    def close(self):
+        self.join()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _worker(self):
+        while True:
+            op = self._queue.get()
+            if op is None:
+                self._queue.task_done()
+                return
+
+            if op[0] == 'call':
+                self._call(*op[1:])
+                self._queue.task_done()
+                continue
+
+            # single operation or a batch of operations
+            ops = op if isinstance(op, list) else [op]
+            errors = []
+            for op in ops:
+                try:
+                    with profiler.span(f'file_op.{op[0]}'):
+                        OPERATIONS[op[0]](*op[1:])
+                except Exception as e:
+                    errors.append(f'{op[0]} {op[1]} failed: {e}')
+
+            with self._lock:
+                self._pending -= len(ops)
+            if self.on_done is not None:
+                error = errors[0] if errors else ''
+                if len(errors) > 1:
+                    error = f'{len(errors)} operations failed, first: {error}'
+                self.on_done(ops[0] if len(ops) == 1 else ops, error)
+            self._queue.task_done()
+
+    def _call(self, fn, on_done, size):
+        result, error = None, ''
+        try:
+            result = fn()
+        except Exception as e:
+            error = f'{getattr(fn, "__name__", "call")} failed: {e}'
+
+        with self._lock:
+            self._pending -= size
+        if on_done is not None:
+            on_done(result, error)
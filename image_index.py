@@ -0,0 +1,259 @@
+import bisect
+import os
+
+import numpy as np
+
+
+class ImageIndex:
+    """
+    Index of all images in the dataset. Image is identified by its ordinal (position in navigation order)
+    and by its key (path relative to the root folder), so images with the same name in different sub-folders
+    are different images.
+
+    The index also keeps the physical location of each image: in 'move' mode the image lives in one of its
+    label folders (root/label/key) instead of its original place.
+
+    Images deleted while the app runs (watch mode) keep their ordinal, they are only marked as removed.
+
+    Navigation follows the order in which images were found, unless a queue order is set (e.g. the most uncertain
+    images first). The queue order is a permutation of ordinals, images found later are appended to it.
+    """
+
+    def __init__(self, root, labels, capacity=1024):
+        self.root = root
+        self.labels = list(labels)
+        self.label_to_int = {label: i for i, label in enumerate(self.labels)}
+
+        self.paths = []  # original paths of images
+        self.keys = []
+        self.key_to_ordinal = {}
+        # ordinal of the label folder where the image is stored, -1 = original place
+        self.home = np.full(capacity, -1, dtype=np.int32)
+        self.removed = np.zeros(capacity, dtype=bool)
+
+        # navigation order (ordinals) and position of each ordinal in it, None = order of ordinals.
+        # order is a view of _order_buffer, which has room for images found later
+        self.order = None
+        self._order_buffer = None
+        self._positions = None
+
+        # (key, ordinal) pairs sorted by key for prefix search, rebuilt lazily
+        self._sorted_keys = None
+        self._sorted_ordinals = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def make_key(self, path):
+        """
+        :return: path relative to the root folder (with '/' as separator)
+        """
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def add(self, path):
+        """
+        :param path: original path of the image
+        :return: ordinal of the image (existing ordinal if the image is already in the index)
+        """
+        key = self.make_key(path)
+        i = self.key_to_ordinal.get(key)
+        if i is not None:
+            # image deleted before was created again
+            self.removed[i] = False
+            return i
+
+        i = len(self.paths)
+        if i == len(self.home):
+            self.home = np.concatenate([self.home, np.full_like(self.home, -1)])
+            self.removed = np.concatenate([self.removed, np.zeros_like(self.removed)])
+            if self._positions is not None:
+                self._positions = np.concatenate([self._positions, np.full_like(self._positions, -1)])
+        self.paths.append(path)
+        self.keys.append(key)
+        self.key_to_ordinal[key] = i
+        self._sorted_keys = None
+        if self.order is not None:
+            self._append_to_order(i)
+        return i
+
+    def _append_to_order(self, ordinal):
+        size = len(self.order)
+        if size == len(self._order_buffer):
+            self._order_buffer = np.concatenate([self._order_buffer, np.empty(max(size, 1024), dtype=np.int64)])
+        self._order_buffer[size] = ordinal
+        self.order = self._order_buffer[:size + 1]
+        self._positions[ordinal] = size
+
+    def ordinal(self, key):
+        return self.key_to_ordinal.get(key)
+
+    def key(self, ordinal):
+        return self.keys[ordinal]
+
+    def label_path(self, ordinal, label):
+        """
+        :return: path of the image in the folder of given label
+        """
+        return os.path.join(self.root, label, *self.keys[ordinal].split('/'))
+
+    def location(self, ordinal):
+        """
+        :return: path where the image is currently stored
+        """
+        home = self.home[ordinal]
+        if home < 0:
+            return self.paths[ordinal]
+        return self.label_path(ordinal, self.labels[home])
+
+    def set_home(self, ordinal, label):
+        """
+        :param ordinal: ordinal of the image
+        :param label: label folder where the image is stored now (None = original place)
+        """
+        self.home[ordinal] = -1 if label is None else self.label_to_int[label]
+
+    def remove(self, ordinal):
+        self.removed[ordinal] = True
+
+    def rename(self, ordinal, path):
+        """
+        Changes the original path (and the key) of the image, the image keeps its ordinal
+        :return: the new key
+        """
+        key = self.make_key(path)
+        del self.key_to_ordinal[self.keys[ordinal]]
+        self.paths[ordinal] = path
+        self.keys[ordinal] = key
+        self.key_to_ordinal[key] = ordinal
+        self._sorted_keys = None
+        return key
+
+    def set_order(self, ordinals):
+        """
+        :param ordinals: ordinals of images in the order of navigation (images left out are skipped),
+            None = all images in the order in which they were found
+        """
+        if ordinals is None:
+            self.order = None
+            self._order_buffer = None
+            self._positions = None
+            return
+
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        self._order_buffer = np.empty(max(2 * len(ordinals), 1024), dtype=np.int64)
+        self._order_buffer[:len(ordinals)] = ordinals
+        self.order = self._order_buffer[:len(ordinals)]
+        self._positions = np.full(len(self.home), -1, dtype=np.int64)
+        self._positions[self.order] = np.arange(len(self.order))
+
+    def full_order(self):
+        """
+        :return: navigation order followed by images which were left out of it (in the order they were found)
+        """
+        n = len(self.paths)
+        if self.order is None:
+            return np.arange(n)
+        return np.concatenate([self.order, np.flatnonzero(self._positions[:n] < 0)])
+
+    def queue_length(self):
+        """
+        :return: number of images in the navigation order
+        """
+        return len(self.paths) if self.order is None else len(self.order)
+
+    def position(self, ordinal):
+        """
+        :return: position of the image in the navigation order (-1 if it was left out of it)
+        """
+        return ordinal if self.order is None else int(self._positions[ordinal])
+
+    def step(self, ordinal, forward=True, accepted=None):
+        """
+        Finds the nearest image after (or before) the image in the navigation order which isn't removed
+        :param accepted: bool array over ordinals, only accepted images are found (None = all images)
+        :return: ordinal of the found image or None
+        """
+        position = self.position(ordinal)
+        length = self.queue_length()
+        # usually the adjacent image is the one
+        adjacent = position + 1 if forward else position - 1
+        if 0 <= adjacent < length:
+            candidate = adjacent if self.order is None else int(self.order[adjacent])
+            if not self.removed[candidate] and (accepted is None or accepted[candidate]):
+                return candidate
+
+        if self.order is None:
+            candidates = np.arange(position + 1, length) if forward else np.arange(position - 1, -1, -1)
+        else:
+            candidates = self.order[position + 1:] if forward else self.order[:max(position, 0)][::-1]
+        found = ~self.removed[candidates]
+        if accepted is not None:
+            found &= accepted[candidates]
+        found = np.flatnonzero(found)
+        return int(candidates[found[0]]) if len(found) else None
+
+    def neighbours(self, ordinal, ahead, behind):
+        """
+        :return: (ordinals of up to ahead images after the image, ordinals of up to behind images before it),
+            nearest first, in the navigation order. Removed images are skipped
+        """
+        position = self.position(ordinal)
+        return self._nearest(position, ahead, 1), self._nearest(position, behind, -1)
+
+    def _nearest(self, position, count, direction):
+        """
+        :param direction: 1 = images after the position, -1 = images before it
+        :return: ordinals of up to count images which aren't removed, nearest first
+        """
+        length = self.queue_length()
+        nearest = []
+        start = position + direction
+        # removed images are rare, usually one chunk is enough
+        while len(nearest) < count and 0 <= start < length:
+            end = min(max(start + direction * count, -1), length)
+            ordinals = np.arange(start, end, direction)
+            if self.order is not None:
+                ordinals = self.order[ordinals]
+            nearest += ordinals[~self.removed[ordinals]].tolist()
+            start = end
+        return nearest[:count]
+
+    def first(self, accepted=None):
+        """
+        :param accepted: bool array over ordinals, only accepted images are found (None = all images)
+        :return: ordinal of the first image in the navigation order which isn't removed or None
+        """
+        order = np.arange(len(self.paths)) if self.order is None else self.order
+        found = ~self.removed[order]
+        if accepted is not None:
+            found &= accepted[order]
+        found = np.flatnonzero(found)
+        return int(order[found[0]]) if len(found) else None
+
+    def with_prefix(self, prefix):
+        """
+        :param prefix: beginning of the key ('sub/' = images in the sub-folder)
+        :return: ordinals of images whose key starts with prefix (in the order of keys)
+        """
+        if self._sorted_keys is None:
+            order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+            self._sorted_keys = [self.keys[i] for i in order]
+            self._sorted_ordinals = np.array(order, dtype=np.int64)
+
+        lo = bisect.bisect_left(self._sorted_keys, prefix)
+        hi = bisect.bisect_left(self._sorted_keys, prefix + '￿')
+        return self._sorted_ordinals[lo:hi]
+
+    def find_prefix(self, prefix, after=-1):
+        """
+        Finds image whose key (relative path) starts with prefix
+        :param prefix: beginning of the key
+        :param after: ordinal after which the search starts (search wraps around)
+        :return: ordinal of the found image or None
+        """
+        matches = self.with_prefix(prefix)
+        if len(matches) == 0:
+            return None
+
+        following = matches[matches > after]
+        return int(following.min() if len(following) else matches.min())
@@ -0,0 +1,190 @@
+"""
+Optional instrumentation of hot paths. Disabled by default (spans cost one attribute check then).
+
+Environment variables:
+    ANNOTATION_PROFILE=1            record latency histograms and show them in the labeler window
+    ANNOTATION_TRACE=trace.json     also record trace events and save them (Chrome / Perfetto format) on exit
+"""
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets (each bucket is 5 % wider than previous one),
+    so percentiles have bounded relative error and recording is O(1).
+    """
+
+    growth = 1.05
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+    def add(self, duration_us):
+        index = int(math.log(max(duration_us, 1.0), self.growth))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total_us += duration_us
+        self.max_us = max(self.max_us, duration_us)
+
+    def percentile(self, q):
+        """
+        :param q: percentile (0 - 100)
+        :return: approximate value of the percentile in microseconds
+        """
+        if self.count == 0:
+            return 0.0
+
+        rank = q / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # middle of the bucket
+                return min(self.growth ** (index + 0.5), self.max_us)
+        return self.max_us
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total_us / self.count / 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(50) / 1000,
+            'p99_ms': self.percentile(99) / 1000,
+            'max_ms': self.max_us / 1000,
+        }
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'start_ns')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start_ns, time.perf_counter_ns())
+        return False
+
+
+class Profiler:
+    """
+    Records durations of named operations (spans) into histograms and optionally into a trace.
+    Spans can be recorded from any thread.
+    """
+
+    def __init__(self, enabled=False, trace_path=None, max_trace_events=1000000):
+        self.enabled = enabled or bool(trace_path)
+        self.trace_path = trace_path
+        self.max_trace_events = max_trace_events
+
+        self.histograms = {}
+        self.trace_events = []
+        self._lock = threading.Lock()
+        self._start_ns = time.perf_counter_ns()
+        self._thread_ids = {}
+
+    def span(self, name):
+        """
+        Context manager which records duration of the block
+        :param name: name of the operation
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def instrumented(self, name):
+        """
+        Decorator which records duration of each call of the function
+        :param name: name of the operation
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Span(self, name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, start_ns, end_ns):
+        duration_us = (end_ns - start_ns) / 1000
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(duration_us)
+
+            if self.trace_path and len(self.trace_events) < self.max_trace_events:
+                self.trace_events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': (start_ns - self._start_ns) / 1000,
+                    'dur': duration_us,
+                    'pid': os.getpid(),
+                    'tid': self._thread_id(),
+                })
+
+    def _thread_id(self):
+        thread = threading.current_thread()
+        tid = self._thread_ids.get(thread.ident)
+        if tid is None:
+            tid = self._thread_ids[thread.ident] = len(self._thread_ids) + 1
+            self.trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                                      'args': {'name': thread.name}})
+        return tid
+
+    def stats(self, name):
+        """
+        :return: summary of the operation (count, mean_ms, p50_ms, p99_ms, max_ms) or None if it wasn't recorded
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            return histogram.summary() if histogram is not None else None
+
+    def summary(self):
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def print_summary(self):
+        for name, stats in self.summary().items():
+            print(f'{name:28s} n={stats["count"]:<7d} p50 {stats["p50_ms"]:8.2f} ms   p99 {stats["p99_ms"]:8.2f} ms   '
+                  f'max {stats["max_ms"]:8.2f} ms')
+
+    def write_trace(self, path=None):
+        """
+        Saves recorded events in Chrome trace format (open in chrome://tracing or ui.perfetto.dev)
+        :param path: path to the trace file (default: trace_path)
+        """
+        path = path or self.trace_path
+        with self._lock:
+            events = list(self.trace_events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print(f'trace saved to: {path}')
+
+
+# shared profiler configured by environment variables
+profiler = Profiler(enabled=bool(os.environ.get('ANNOTATION_PROFILE')), trace_path=os.environ.get('ANNOTATION_TRACE'))
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+
+JOURNAL_FILENAME = 'labels_journal.log'
+SNAPSHOT_FILENAME = 'labels_snapshot.json'
+
+
+class LabelJournal:
+    """
+    Append-only journal of label changes, so labels survive a crash of the app.
+
+    Every change is appended as one json line. Records hold the resulting state (label added / removed),
+    not the toggle itself, so replaying a record twice gives the same result. Lines are flushed to the OS
+    immediately, but fsync is done by a background thread at most once per sync_interval seconds,
+    so labeling never waits for the disk. When the journal grows over compact_size bytes, the whole state
+    is written into a snapshot and the journal starts again from empty.
+    """
+
+    def __init__(self, folder, sync_interval=1.0, compact_size=4 * 1024 * 1024):
+        self.folder = folder
+        self.journal_path = os.path.join(folder, JOURNAL_FILENAME)
+        self.snapshot_path = os.path.join(folder, SNAPSHOT_FILENAME)
+        self.sync_interval = sync_interval
+        self.compact_size = compact_size
+
+        self._file = None
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._closed = threading.Event()
+        self._sync_thread = None
+
+    def replay(self):
+        """
+        Rebuilds the label state from the snapshot and the journal
+        :return: assigned labels {img_name: [label, ...]} and last position {'counter': int, 'img': img_name} or None
+        """
+        assigned_labels = {}
+        position = None
+
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            assigned_labels = {img_name: list(labels) for img_name, labels in snapshot['labels'].items()}
+            position = snapshot.get('position')
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            print(f"Can't read label snapshot: {e}")
+
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line can be incomplete if the app crashed while writing it
+                        continue
+
+                    if record[0] == '+':
+                        labels = assigned_labels.setdefault(record[1], [])
+                        if record[2] not in labels:
+                            labels.append(record[2])
+                    elif record[0] == '-':
+                        labels = assigned_labels.get(record[1], [])
+                        if record[2] in labels:
+                            labels.remove(record[2])
+                        if not labels:
+                            assigned_labels.pop(record[1], None)
+                    elif record[0] == '@':
+                        position = {'counter': record[1], 'img': record[2]}
+        except FileNotFoundError:
+            pass
+
+        return assigned_labels, position
+
+    def open(self):
+        """
+        Opens the journal for appending and starts the background fsync thread
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        self._file = open(self.journal_path, 'a', encoding='utf-8')
+        self._sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self._sync_thread.start()
+
+    def record_label(self, img_name, label, assigned):
+        """
+        :param img_name: name of the image
+        :param label: changed label
+        :param assigned: True if the label was added, False if it was removed
+        """
+        self._append(['+' if assigned else '-', img_name, label])
+
+    def record_position(self, counter, img_name):
+        """
+        :param counter: index of the current image
+        :param img_name: name of the current image
+        """
+        self._append(['@', counter, img_name])
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._dirty = True
+
+    def needs_compaction(self):
+        return self._file is not None and self._file.tell() > self.compact_size
+
+    def compact(self, assigned_labels, position):
+        """
+        Writes the whole state into the snapshot and empties the journal
+        :param assigned_labels: current labels {img_name: [label, ...]}
+        :param position: current position {'counter': int, 'img': img_name}
+        """
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'labels': assigned_labels, 'position': position}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        # records are idempotent, so a crash before the truncation only replays them once more
+        with self._lock:
+            self._file.truncate(0)
+            self._file.seek(0)
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def sync(self):
+        with self._lock:
+            if self._dirty and self._file is not None:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.sync_interval):
+            self.sync()
+
+    def close(self):
+        """
+        Stops the fsync thread and syncs the rest of the journal
+        """
+        if self._file is None:
+            return
+        self._closed.set()
+        self._sync_thread.join()
+        self.sync()
+        self._file.close()
+        self._file = None
@@ -0,0 +1,263 @@
+"""
+Labels shared by several annotators of one dataset, stored in a SQLite database in WAL mode.
+
+WAL mode lets annotators read while another one writes. Label changes are buffered and written in one
+transaction per flush, every change also gets a row in the change log, so the other sessions pick up new
+changes by reading rows after their cursor (sequence number of the last seen change). Images are split among
+annotators by claims: an annotator claims a batch of unlabeled images nobody else works on.
+"""
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from label_store import LabelExports
+
+LABELS_DB_FILENAME = 'labels.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    claimed_by TEXT,
+    claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS images_claimed ON images (claimed_by, id);
+CREATE TABLE IF NOT EXISTS labels (
+    image_id INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    PRIMARY KEY (image_id, label)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS labels_label ON labels (label, image_id);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_id INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    assigned INTEGER NOT NULL,
+    annotator TEXT NOT NULL,
+    time REAL NOT NULL
+);
+'''
+
+
+class LabelDatabase(LabelExports):
+    """
+    Shared labels of the dataset. Used from the GUI thread only.
+    """
+
+    def __init__(self, path, annotator, labels, claim_timeout=2 * 3600):
+        """
+        :param path: path to the database file (created when it doesn't exist)
+        :param annotator: name of the annotator of this session
+        :param labels: labels of this session (exports contain only these)
+        :param claim_timeout: claims older than this (seconds) can be taken by other annotators
+        """
+        self.path = path
+        self.annotator = annotator
+        self.labels = list(labels)
+        self.num_labels = len(self.labels)
+        self.label_to_int = {label: i for i, label in enumerate(self.labels)}
+        self.claim_timeout = claim_timeout
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode commits are durable after a checkpoint, but never corrupt the database
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+        self.cursor = 0
+        self._pending = []  # buffered changes (img_key, label, assigned)
+        self._data_version = None
+
+    def _transaction(self):
+        """
+        Starts a write transaction. The write lock is taken at once, so the transaction doesn't fail halfway.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def add_images(self, img_keys):
+        """
+        Registers images of the dataset (images registered already are skipped)
+        """
+        connection = self._transaction()
+        try:
+            connection.executemany('INSERT OR IGNORE INTO images (key) VALUES (?)', ((key,) for key in img_keys))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def load_labels(self):
+        """
+        Reads all labels and moves the change cursor to the last change, so only newer changes are polled
+        :return: {img_key: [label, ...]}
+        """
+        connection = self.connection
+        connection.execute('BEGIN')
+        try:
+            self.cursor = connection.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+            labels = {}
+            for key, label in connection.execute('SELECT images.key, labels.label FROM labels '
+                                                 'JOIN images ON images.id = labels.image_id ORDER BY labels.image_id'):
+                labels.setdefault(key, []).append(label)
+        finally:
+            connection.execute('COMMIT')
+        return labels
+
+    def record(self, img_key, label, assigned):
+        """
+        Buffers the label change, it is written by flush()
+        """
+        self._pending.append((img_key, label, assigned))
+
+    def flush(self):
+        """
+        Writes buffered label changes in one transaction
+        :return: number of written changes
+        """
+        if not self._pending:
+            return 0
+
+        pending, self._pending = self._pending, []
+        now = time.time()
+        connection = self._transaction()
+        try:
+            connection.executemany('INSERT OR IGNORE INTO images (key) VALUES (?)',
+                                   ((key,) for key in {key for key, _, _ in pending}))
+            for key, label, assigned in pending:
+                image_id = connection.execute('SELECT id FROM images WHERE key = ?', (key,)).fetchone()[0]
+                if assigned:
+                    connection.execute('INSERT OR REPLACE INTO labels VALUES (?, ?, ?)',
+                                       (image_id, label, self.annotator))
+                else:
+                    connection.execute('DELETE FROM labels WHERE image_id = ? AND label = ?', (image_id, label))
+                connection.execute('INSERT INTO changes (image_id, label, assigned, annotator, time) '
+                                   'VALUES (?, ?, ?, ?, ?)', (image_id, label, int(assigned), self.annotator, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            self._pending = pending + self._pending
+            raise
+        return len(pending)
+
+    def poll_changes(self):
+        """
+        Returns changes made by other annotators since the last poll. When nobody wrote into the database,
+        this costs only one pragma.
+        :return: list of (img_key, label, assigned, annotator), oldest first
+        """
+        # data_version changes only when another connection commits
+        data_version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return []
+        self._data_version = data_version
+
+        rows = self.connection.execute('SELECT changes.seq, images.key, changes.label, changes.assigned, '
+                                       'changes.annotator FROM changes JOIN images ON images.id = changes.image_id '
+                                       'WHERE changes.seq > ? ORDER BY changes.seq', (self.cursor,)).fetchall()
+        if rows:
+            self.cursor = rows[-1][0]
+        return [(key, label, bool(assigned), annotator) for _, key, label, assigned, annotator in rows
+                if annotator != self.annotator]
+
+    def claim_batch(self, size=100):
+        """
+        Claims unlabeled images which nobody claimed (or whose claim expired). Claims of this annotator
+        which are still unlabeled are returned first.
+        :param size: number of claimed images
+        :return: keys of claimed unlabeled images in the order of the dataset
+        """
+        now = time.time()
+        connection = self._transaction()
+        try:
+            connection.execute(
+                'UPDATE images SET claimed_by = ?, claimed_at = ? WHERE id IN ('
+                ' SELECT id FROM images WHERE (claimed_by IS NULL OR claimed_at < ?)'
+                ' AND NOT EXISTS (SELECT 1 FROM labels WHERE labels.image_id = images.id)'
+                ' ORDER BY id LIMIT ?)',
+                (self.annotator, now, now - self.claim_timeout, size))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return self.claimed()
+
+    def claimed(self):
+        """
+        :return: keys of unlabeled images claimed by this annotator
+        """
+        return [key for key, in self.connection.execute(
+            'SELECT key FROM images WHERE claimed_by = ? '
+            'AND NOT EXISTS (SELECT 1 FROM labels WHERE labels.image_id = images.id) ORDER BY id',
+            (self.annotator,))]
+
+    def claimed_by_others(self, img_keys):
+        """
+        :param img_keys: keys of images
+        :return: {img_key: annotator} of unlabeled images claimed by other annotators (expired claims don't count)
+        """
+        min_time = time.time() - self.claim_timeout
+        claims = {}
+        for key in img_keys:
+            row = self.connection.execute(
+                'SELECT claimed_by FROM images WHERE key = ? AND claimed_by != ? AND claimed_at >= ? '
+                'AND NOT EXISTS (SELECT 1 FROM labels WHERE labels.image_id = images.id)',
+                (key, self.annotator, min_time)).fetchone()
+            if row is not None:
+                claims[key] = row[0]
+        return claims
+
+    def release_claims(self):
+        """
+        Releases claimed images which this annotator didn't label
+        """
+        connection = self._transaction()
+        try:
+            connection.execute('UPDATE images SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ? '
+                               'AND NOT EXISTS (SELECT 1 FROM labels WHERE labels.image_id = images.id)',
+                               (self.annotator,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def iter_blocks(self, block_size=65536):
+        """
+        Generator of labeled images in blocks, read by a streaming query (the whole table is never in memory)
+        :return: generator of (list of image keys, one-hot uint8 matrix) tuples
+        """
+        rows = self.connection.execute('SELECT labels.image_id, images.key, labels.label FROM labels '
+                                       'JOIN images ON images.id = labels.image_id ORDER BY labels.image_id')
+        img_keys = []
+        one_hot = np.zeros((block_size, self.num_labels), dtype=np.uint8)
+        last_id = None
+        while True:
+            chunk = rows.fetchmany(4096)
+            if not chunk:
+                break
+            for image_id, key, label in chunk:
+                column = self.label_to_int.get(label)
+                if column is None:
+                    # label which isn't used in this session
+                    continue
+                if image_id != last_id:
+                    if len(img_keys) == block_size:
+                        yield img_keys, one_hot
+                        img_keys = []
+                        one_hot = np.zeros((block_size, self.num_labels), dtype=np.uint8)
+                    img_keys.append(key)
+                    last_id = image_id
+                one_hot[len(img_keys) - 1, column] = 1
+
+        if img_keys:
+            yield img_keys, one_hot[:len(img_keys)]
+
+    def close(self):
+        self.flush()
+        self.release_claims()
+        self.connection.close()
@@ -0,0 +1,193 @@
+from PyQt5.QtCore import QAbstractListModel, QEvent, QModelIndex, QSortFilterProxyModel, Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QBrush, QColor
+from PyQt5.QtWidgets import QLineEdit, QListView, QVBoxLayout, QWidget
+
+ASSIGNED_BACKGROUND = QBrush(QColor('#4CAF50'))
+ASSIGNED_FOREGROUND = QBrush(QColor('white'))
+# labels suggested by the model (see predictions.py)
+SUGGESTED_BACKGROUND = QBrush(QColor('#C8E6C9'))
+
+
+class LabelListModel(QAbstractListModel):
+    """
+    List of labels with the state of the current image (assigned or not) and labels suggested by the model.
+    When the state changes, only rows which really changed are repainted.
+    """
+
+    def __init__(self, labels, parent=None):
+        super().__init__(parent)
+        self.labels = list(labels)
+        self.assigned = set()  # ordinals of labels assigned to the current image
+        self.suggested = {}  # {ordinal of label: probability} suggested for the current image
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.labels)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = index.row()
+        if role == Qt.DisplayRole:
+            # number is the keyboard shortcut of the label
+            if row in self.suggested:
+                return f'{row + 1:>3}  {self.labels[row]}  ({self.suggested[row]:.0%})'
+            return f'{row + 1:>3}  {self.labels[row]}'
+        if role == Qt.UserRole:
+            return self.labels[row]
+        if role == Qt.BackgroundRole and row in self.assigned:
+            return ASSIGNED_BACKGROUND
+        if role == Qt.BackgroundRole and row in self.suggested:
+            return SUGGESTED_BACKGROUND
+        if role == Qt.ForegroundRole and row in self.assigned:
+            return ASSIGNED_FOREGROUND
+        return None
+
+    def set_assigned(self, assigned):
+        """
+        :param assigned: set of ordinals of labels assigned to the current image
+        """
+        changed = self.assigned ^ assigned
+        self.assigned = set(assigned)
+        for row in changed:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.BackgroundRole, Qt.ForegroundRole])
+
+    def set_suggested(self, suggested):
+        """
+        :param suggested: {ordinal of label: probability} suggested for the current image
+        """
+        changed = {row for row in self.suggested.keys() | suggested.keys()
+                   if self.suggested.get(row) != suggested.get(row)}
+        self.suggested = dict(suggested)
+        for row in changed:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.BackgroundRole])
+
+
+class LabelPanel(QWidget):
+    """
+    Virtualized list of labels with typeahead filter. Suitable for hundreds of labels.
+
+    Selection of labels:
+    - click on the label
+    - number of the label (multi-digit numbers are typed quickly one after another)
+    - type part of the label name into the filter (focus it with "/") and press Enter
+    """
+
+    label_activated = pyqtSignal(str)
+
+    def __init__(self, labels, chord_timeout=600, parent=None):
+        super().__init__(parent)
+        self.labels = list(labels)
+
+        self.model = LabelListModel(self.labels, self)
+        self.proxy = QSortFilterProxyModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.proxy.setFilterRole(Qt.UserRole)
+
+        self.filter_input = QLineEdit(self)
+        self.filter_input.setPlaceholderText('filter labels (press "/"), Enter assigns the first label')
+        self.filter_input.textChanged.connect(self.proxy.setFilterFixedString)
+        self.filter_input.returnPressed.connect(self.activate_current)
+        self.filter_input.installEventFilter(self)
+
+        self.view = QListView(self)
+        self.view.setModel(self.proxy)
+        # all rows have the same height, so the view doesn't have to measure all labels
+        self.view.setUniformItemSizes(True)
+        self.view.setEditTriggers(QListView.NoEditTriggers)
+        self.view.setFocusPolicy(Qt.NoFocus)
+        self.view.clicked.connect(self.activate_index)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.filter_input)
+        layout.addWidget(self.view)
+
+        # digits typed quickly one after another select labels with multi-digit numbers
+        self.chord = ''
+        self.chord_timer = QTimer(self)
+        self.chord_timer.setSingleShot(True)
+        self.chord_timer.setInterval(chord_timeout)
+        self.chord_timer.timeout.connect(self.finish_chord)
+
+    def set_assigned(self, ordinals):
+        """
+        :param ordinals: set of ordinals of labels assigned to the current image
+        """
+        self.model.set_assigned(ordinals)
+
+    def set_suggested(self, suggested):
+        """
+        :param suggested: {ordinal of label: probability} of labels suggested by the model for the current image
+        """
+        self.model.set_suggested(suggested)
+
+    def activate_index(self, proxy_index):
+        if proxy_index.isValid():
+            self.label_activated.emit(self.proxy.data(proxy_index, Qt.UserRole))
+
+    def activate_current(self):
+        """
+        Assigns the selected (or first) label from the filtered list and clears the filter
+        """
+        index = self.view.currentIndex()
+        if not index.isValid():
+            index = self.proxy.index(0, 0)
+        if index.isValid():
+            self.activate_index(index)
+
+        self.filter_input.clear()
+        self.filter_input.clearFocus()
+
+    def focus_filter(self):
+        self.filter_input.setFocus()
+        self.filter_input.selectAll()
+
+    def eventFilter(self, obj, event):
+        # Up / Down in the filter move the selection in the list, Escape leaves the filter
+        if obj is self.filter_input and event.type() == QEvent.KeyPress:
+            if event.key() in (Qt.Key_Up, Qt.Key_Down):
+                row = self.view.currentIndex().row()
+                row = row + 1 if event.key() == Qt.Key_Down else row - 1
+                row = max(0, min(row, self.proxy.rowCount() - 1))
+                self.view.setCurrentIndex(self.proxy.index(row, 0))
+                return True
+            if event.key() == Qt.Key_Escape:
+                self.filter_input.clear()
+                self.filter_input.clearFocus()
+                return True
+        return super().eventFilter(obj, event)
+
+    def digit_pressed(self, digit):
+        """
+        Handles number shortcut. Number is finished when no more digits come within chord_timeout
+        or when no label number can start with typed digits.
+        :param digit: pressed digit (string)
+        """
+        self.chord += digit
+        number = int(self.chord)
+
+        if number * 10 > len(self.labels):
+            self.finish_chord()
+        else:
+            self.chord_timer.start()
+
+    def flush_chord(self):
+        """
+        Finishes the number which is being typed right now (e.g. before navigation, so the label is assigned
+        to the image on which the number was typed)
+        """
+        if self.chord:
+            self.finish_chord()
+
+    def finish_chord(self):
+        self.chord_timer.stop()
+        number = int(self.chord) if self.chord else 0
+        self.chord = ''
+
+        if 1 <= number <= len(self.labels):
+            self.view.scrollTo(self.proxy.mapFromSource(self.model.index(number - 1)))
+            self.label_activated.emit(self.labels[number - 1])
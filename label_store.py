@@ -0,0 +1,339 @@
+import numpy as np
+from xlsxwriter.workbook import Workbook
+
+CSV_SPECIAL_CHARS = (',', '"', '\r', '\n')
+# columns with image metadata, written after the labels when enabled
+METADATA_COLUMNS = ('width', 'height', 'format', 'file_size', 'capture_time', 'corrupt')
+
+
+def _csv_field(value):
+    """
+    Quotes the field the same way as csv.writer with default dialect
+    """
+    if any(char in value for char in CSV_SPECIAL_CHARS):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+class LabelExports:
+    """
+    Exports of labels into csv, xlsx, npz and parquet / arrow files. Subclasses provide labels, num_labels and
+    iter_blocks() which yields labeled images in blocks.
+    """
+
+    def export_csv(self, path, block_size=65536, extra_columns=None):
+        """
+        Writes csv file with header (img, labels...) and one-hot encoded labels of each labeled image.
+        Rows are formatted and written in blocks instead of one by one.
+        :param path: path to the csv file
+        :param block_size: number of images formatted at once
+        :param extra_columns: (names of columns after the labels, function which returns their values (strings)
+            for a list of image names), None = only labels
+        """
+        comma, zero = ord(','), ord('0')
+        width = 2 * self.num_labels
+
+        with open(path, 'wb') as f:
+            names = ['img'] + self.labels + (list(extra_columns[0]) if extra_columns else [])
+            f.write(','.join(_csv_field(name) for name in names).encode('utf-8') + b'\r\n')
+
+            for img_names, one_hot in self.iter_blocks(block_size):
+                # ",0,1,0\r\n" part of each row is built for the whole block at once
+                row_tails = np.full((len(img_names), width + 2), comma, dtype=np.uint8)
+                row_tails[:, 1:width:2] = one_hot + zero
+                row_tails[:, width] = ord('\r')
+                row_tails[:, width + 1] = ord('\n')
+                row_tails = row_tails.tobytes()
+
+                row_len = width + 2
+                if extra_columns is None:
+                    f.write(b''.join(_csv_field(img_name).encode('utf-8') + row_tails[k * row_len:(k + 1) * row_len]
+                                     for k, img_name in enumerate(img_names)))
+                    continue
+
+                # extra fields go between the labels and the line end
+                extra = [(',' + ','.join(_csv_field(value) for value in values) + '\r\n').encode('utf-8')
+                         for values in extra_columns[1](img_names)]
+                f.write(b''.join(_csv_field(img_name).encode('utf-8') + row_tails[k * row_len:(k + 1) * row_len - 2]
+                                 + extra[k] for k, img_name in enumerate(img_names)))
+
+    def export_xlsx(self, path):
+        """
+        Writes xlsx file with the same content as the csv file. Workbook is in constant_memory mode,
+        so rows are flushed to disk one by one and memory usage doesn't grow with the number of images.
+        :param path: path to the xlsx file
+        """
+        workbook = Workbook(path, {'constant_memory': True})
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, ['img'] + self.labels)
+
+        r = 1
+        for img_names, one_hot in self.iter_blocks():
+            for img_name, row in zip(img_names, one_hot.tolist()):
+                worksheet.write_string(r, 0, img_name)
+                worksheet.write_row(r, 1, row)
+                r += 1
+
+        workbook.close()
+
+    def export_npz(self, path):
+        """
+        Writes labels as numpy arrays: 'labels' (uint8 one-hot matrix, one row per image),
+        'filenames' (image names) and 'label_names' (column names of 'labels').
+        The arrays are stored uncompressed, so they can be memory-mapped from the file.
+        :param path: path to the npz file
+        """
+        img_names, one_hot = [], []
+        for block_names, block in self.iter_blocks():
+            img_names += block_names
+            one_hot.append(block)
+        np.savez(path,
+                 labels=np.concatenate(one_hot) if one_hot else np.zeros((0, self.num_labels), dtype=np.uint8),
+                 filenames=np.array(img_names, dtype=str),
+                 label_names=np.array(self.labels, dtype=str))
+
+    def export_arrow(self, path, file_format='parquet', block_size=65536):
+        """
+        Writes labels as a table with 'img' column and one uint8 column per label.
+        Requires pyarrow (pip install pyarrow).
+        :param path: path to the output file
+        :param file_format: 'parquet' or 'arrow' (Arrow IPC file, can be memory-mapped)
+        :param block_size: number of images written as one row group / record batch
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError('pyarrow is required for parquet and arrow export (pip install pyarrow)')
+
+        schema = pa.schema([('img', pa.string())] + [(label, pa.uint8()) for label in self.labels])
+        if file_format == 'parquet':
+            writer = pq.ParquetWriter(path, schema)
+        elif file_format == 'arrow':
+            writer = pa.ipc.new_file(path, schema)
+        else:
+            raise ValueError(f'Unknown file format: {file_format}')
+
+        with writer:
+            for img_names, one_hot in self.iter_blocks(block_size):
+                columns = [pa.array(img_names, pa.string())] + [pa.array(column) for column in one_hot.T]
+                writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+
+class LabelStore(LabelExports):
+    """
+    Labels of all images stored as bit-packed matrix (row = image ordinal, bit = label ordinal).
+    Toggle and lookup are O(1) and per-label counts and exports are vectorized over whole blocks of images.
+    """
+
+    def __init__(self, labels, capacity=1024):
+        self.labels = list(labels)
+        self.num_labels = len(self.labels)
+        self.label_to_int = {label: i for i, label in enumerate(self.labels)}
+
+        # one row per image, label i is stored in bit (7 - i % 8) of byte i // 8 (same layout as np.packbits)
+        self.row_bytes = max(1, (self.num_labels + 7) // 8)
+        self.bits = np.zeros((capacity, self.row_bytes), dtype=np.uint8)
+        # number of labels of each image, so labeled / unlabeled images can be found without unpacking bits
+        self.counts = np.zeros(capacity, dtype=np.uint16)
+
+        self.img_names = []
+        self.img_to_int = {}
+        self.num_labeled = 0
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def __contains__(self, img_name):
+        """
+        :return: True if the image has at least one label
+        """
+        i = self.img_to_int.get(img_name)
+        return i is not None and self.counts[i] > 0
+
+    def add_image(self, img_name):
+        """
+        :param img_name: name of the image
+        :return: ordinal of the image (new row is added if the image isn't in the store yet)
+        """
+        i = self.img_to_int.get(img_name)
+        if i is None:
+            i = len(self.img_names)
+            if i == len(self.bits):
+                self.bits = np.concatenate([self.bits, np.zeros_like(self.bits)])
+                self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            self.img_names.append(img_name)
+            self.img_to_int[img_name] = i
+        return i
+
+    def add_images(self, img_names):
+        for img_name in img_names:
+            self.add_image(img_name)
+
+    def rename(self, img_name, new_name):
+        """
+        Changes the name of the image, the image keeps its row and labels
+        """
+        i = self.img_to_int.pop(img_name)
+        self.img_names[i] = new_name
+        self.img_to_int[new_name] = i
+
+    def _bit(self, label):
+        j = self.label_to_int[label]
+        return j >> 3, 0x80 >> (j & 7)
+
+    def has(self, img_name, label):
+        i = self.img_to_int.get(img_name)
+        if i is None:
+            return False
+        byte, mask = self._bit(label)
+        return bool(self.bits[i, byte] & mask)
+
+    def with_label(self, label):
+        """
+        :return: bool array over ordinals, True = the image has the label
+        """
+        byte, mask = self._bit(label)
+        return (self.bits[:, byte] & mask) != 0
+
+    def set(self, img_name, label, value):
+        """
+        :param img_name: name of the image
+        :param label: label name
+        :param value: True to assign the label, False to remove it
+        """
+        i = self.add_image(img_name)
+        byte, mask = self._bit(label)
+        if bool(self.bits[i, byte] & mask) == bool(value):
+            return
+
+        if value:
+            self.bits[i, byte] |= mask
+            self.counts[i] += 1
+            self.num_labeled += int(self.counts[i] == 1)
+        else:
+            self.bits[i, byte] &= ~mask & 0xFF
+            self.counts[i] -= 1
+            self.num_labeled -= int(self.counts[i] == 0)
+
+    def toggle(self, img_name, label):
+        """
+        :return: True if the label is assigned after the toggle
+        """
+        value = not self.has(img_name, label)
+        self.set(img_name, label, value)
+        return value
+
+    def get_labels(self, img_name):
+        """
+        :return: labels assigned to the image (in the order of self.labels)
+        """
+        i = self.img_to_int.get(img_name)
+        if i is None:
+            return []
+        row = np.unpackbits(self.bits[i], count=self.num_labels)
+        return [self.labels[j] for j in np.flatnonzero(row)]
+
+    def get_label_ordinals(self, img_name):
+        """
+        :return: set of ordinals of labels assigned to the image
+        """
+        i = self.img_to_int.get(img_name)
+        if i is None:
+            return set()
+        return set(np.flatnonzero(np.unpackbits(self.bits[i], count=self.num_labels)).tolist())
+
+    def common_label_ordinals(self, ordinals):
+        """
+        :param ordinals: array of image ordinals
+        :return: set of ordinals of labels assigned to all of the images
+        """
+        if len(ordinals) == 0:
+            return set()
+        common = np.bitwise_and.reduce(self.bits[ordinals], axis=0)
+        return set(np.flatnonzero(np.unpackbits(common, count=self.num_labels)).tolist())
+
+    def first_label(self, img_name):
+        """
+        :return: first assigned label of the image or None
+        """
+        labels = self.get_labels(img_name)
+        return labels[0] if labels else None
+
+    def label_counts(self):
+        """
+        :return: {label: number of images with this label}
+        """
+        n = len(self.img_names)
+        counts = np.unpackbits(self.bits[:n], axis=1, count=self.num_labels).sum(axis=0, dtype=np.int64)
+        return dict(zip(self.labels, counts.tolist()))
+
+    def labeled_ordinals(self):
+        """
+        :return: ordinals of images which have at least one label
+        """
+        return np.flatnonzero(self.counts[:len(self.img_names)])
+
+    def one_hot(self, ordinals):
+        """
+        :param ordinals: array of image ordinals
+        :return: uint8 matrix (len(ordinals) x num_labels) with one-hot encoded labels
+        """
+        return np.unpackbits(self.bits[ordinals], axis=1, count=self.num_labels)
+
+    def as_dict(self):
+        """
+        :return: {img_name: [label, ...]} of labeled images
+        """
+        return {self.img_names[i]: self.get_labels(self.img_names[i]) for i in self.labeled_ordinals()}
+
+    def iter_blocks(self, block_size=65536):
+        """
+        Generator of labeled images in blocks
+        :return: generator of (list of image names, one-hot uint8 matrix) tuples
+        """
+        ordinals = self.labeled_ordinals()
+        for start in range(0, len(ordinals), block_size):
+            block = ordinals[start:start + block_size]
+            yield [self.img_names[i] for i in block], self.one_hot(block)
+
+    def _find(self, matches, start, forward, excluded=None, chunk_size=65536):
+        """
+        Finds the nearest image (from start, excluding it) for which matches(lo, hi) is True.
+        The images are checked in vectorized chunks, so the search stops early when a match is near.
+        :param matches: function returning bool array for images lo..hi-1
+        :param excluded: bool array over ordinals, excluded images (e.g. removed ones) aren't found
+        :return: ordinal of the found image or None
+        """
+        if excluded is not None:
+            found = matches
+            matches = lambda lo, hi: found(lo, hi) & ~excluded[lo:hi]
+        n = len(self.img_names)
+        if forward:
+            for lo in range(start + 1, n, chunk_size):
+                hi = min(n, lo + chunk_size)
+                found = np.flatnonzero(matches(lo, hi))
+                if len(found):
+                    return lo + int(found[0])
+        else:
+            for hi in range(min(start, n), 0, -chunk_size):
+                lo = max(0, hi - chunk_size)
+                found = np.flatnonzero(matches(lo, hi))
+                if len(found):
+                    return lo + int(found[-1])
+        return None
+
+    def find_unlabeled(self, start, forward=True, excluded=None):
+        """
+        :param excluded: bool array over ordinals of images which are skipped (None = no image is skipped)
+        :return: ordinal of the nearest image without labels after (or before) start, or None
+        """
+        return self._find(lambda lo, hi: self.counts[lo:hi] == 0, start, forward, excluded)
+
+    def find_with_label(self, label, start, forward=True, excluded=None):
+        """
+        :param excluded: bool array over ordinals of images which are skipped (None = no image is skipped)
+        :return: ordinal of the nearest image with given label after (or before) start, or None
+        """
+        byte, mask = self._bit(label)
+        return self._find(lambda lo, hi: (self.bits[lo:hi, byte] & mask) != 0, start, forward, excluded)
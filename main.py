@@ -1,40 +1,135 @@
-import csv
+import getpass
 import os
-import shutil
+import sqlite3
 import sys
+import tarfile
+import time
 
 import numpy as np
+
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal
 from PyQt5.QtGui import QPixmap, QIntValidator, QKeySequence
 from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QCheckBox, QFileDialog, QDesktopWidget, QLineEdit, \
-    QRadioButton, QShortcut, QScrollArea, QVBoxLayout, QGroupBox, QFormLayout
-from xlsxwriter.workbook import Workbook
-
-
-def get_img_paths(dir, extensions=('.jpg', '.png', '.jpeg')):
+    QRadioButton, QShortcut, QScrollArea, QVBoxLayout, QGroupBox, QFormLayout, QComboBox, QInputDialog
+
+from archives import ARCHIVE_EXTENSIONS, close_archives, expand_archives, split_member_path, write_label_shards
+from duplicates import DUPLICATE_MODES, HASHES_FILENAME, DuplicateIndex, HashCache, HashThread
+from file_ops import COPY_METHODS, FileOpQueue, make_folder
+from instrumentation import profiler
+from image_index import ImageIndex
+from journal import LabelJournal
+from label_db import LABELS_DB_FILENAME, LabelDatabase
+from label_panel import LabelPanel
+from label_store import LabelStore
+from manifest import Manifest
+from metadata import METADATA_COLUMNS, METADATA_FILENAME, METADATA_ORDERS, MetadataCache, MetadataIndex, \
+    MetadataThread, format_metadata, metadata_fields, parse_filter
+from predictions import PREDICTIONS_FILENAME, PredictionCache, PredictionIndex, PredictionThread, model_id
+from prefetch import ImageCache, PrefetchEngine
+from scanning import IMG_EXTENSIONS, scan_img_paths
+from similarity import DESCRIPTORS_FILENAME, DescriptorCache, DescriptorThread
+from sources import close_sources, open_source, path_exists
+from thumbnail_grid import ThumbnailCache, ThumbnailGrid
+from tile_viewer import TileViewer
+from transactions import CommitLog, LabelHistory, plan_commit
+from watcher import FolderWatcher
+
+# order in which images are shown ('most uncertain first' requires a model)
+QUEUE_ORDERS = ('folder order', 'most uncertain first', 'similar images together') + tuple(METADATA_ORDERS)
+
+
+def get_img_paths(dir, extensions=IMG_EXTENSIONS, recursive=False):
     '''
     :param dir: folder with files
     :param extensions: tuple with file endings. e.g. ('.jpg', '.png'). Files with these endings will be added to img_paths
+    :param recursive: include images from sub-folders
     :return: list of all filenames
     '''
+    return list(scan_img_paths(dir, extensions, recursive))
+
+
+class ScanThread(QThread):
+    """
+    Scans the input folder in background and sends found image paths to the GUI in batches
+    """
+    found = pyqtSignal(list)
+
+    def __init__(self, folder, recursive=False, exclude_dirs=(), manifest_path=None, batch_size=1000,
+                 batch_interval=0.1, archive_index_folder=None, source=None, parent=None):
+        """
+        :param archive_index_folder: if set, images inside .zip / .tar archives are included as well
+            and offset tables of archives are saved into this folder
+        :param source: remote source of images (see sources.py), None = local folder
+        """
+        super().__init__(parent)
+        self.folder = folder
+        self.source = source
+        self.recursive = recursive
+        self.exclude_dirs = exclude_dirs
+        self.manifest_path = manifest_path
+        self.archive_index_folder = archive_index_folder
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+    def run(self):
+        with profiler.span('scan'):
+            self.scan()
+
+    def scan(self):
+        batch = []
+        first_sent = False
+        last_emit = time.monotonic()
+
+        # with manifest only folders changed since the last session are listed again
+        extensions = IMG_EXTENSIONS
+        if self.archive_index_folder:
+            extensions += ARCHIVE_EXTENSIONS
+
+        manifest = None
+        if self.source is not None and self.source.remote:
+            paths = self.source.list_images(extensions, recursive=self.recursive, exclude_dirs=self.exclude_dirs)
+        elif self.manifest_path:
+            manifest = Manifest(self.folder, extensions, recursive=self.recursive, exclude_dirs=self.exclude_dirs)
+            manifest.load(self.manifest_path)
+            paths = manifest.scan()
+        else:
+            paths = scan_img_paths(self.folder, extensions, recursive=self.recursive, exclude_dirs=self.exclude_dirs)
+
+        if self.archive_index_folder:
+            paths = expand_archives(paths, self.archive_index_folder)
 
-    img_paths = []
+        for path in paths:
+            if self.isInterruptionRequested():
+                return
 
-    for filename in os.listdir(dir):
-        if filename.lower().endswith(extensions):
-            img_paths.append(os.path.join(dir, filename))
+            batch.append(path)
+            # first image is sent immediately so it can be shown while the rest of the folder is scanned
+            if not first_sent or len(batch) >= self.batch_size or time.monotonic() - last_emit > self.batch_interval:
+                self.found.emit(batch)
+                first_sent = True
+                batch = []
+                last_emit = time.monotonic()
 
-    return img_paths
+        if batch:
+            self.found.emit(batch)
 
+        if manifest is not None:
+            try:
+                make_folder(os.path.dirname(self.manifest_path))
+                manifest.save(self.manifest_path)
+            except OSError as e:
+                print(f"Can't save manifest: {e}")
 
-def make_folder(directory):
+
+class FileOpSignals(QObject):
     """
-    Make folder if it doesn't already exist
-    :param directory: The folder destination path
+    Delivers results of background file operations to the GUI thread
     """
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    # error message ('' if the operation succeeded)
+    done = pyqtSignal(str)
+    # commit plan was executed
+    committed = pyqtSignal()
 
 
 class SetupWindow(QWidget):
@@ -52,6 +147,14 @@ class SetupWindow(QWidget):
         self.label_inputs = []
         self.label_headlines = []
         self.mode = 'csv'  # default option
+        self.recursive = False
+        self.copy_method = 'copy'
+        self.deferred = False
+        self.archives = False
+        self.label_shards = False
+        self.shared = False
+        self.watch = False
+        self.model = ''
 
         # Labels
         self.headline_folder = QLabel('1. Select folder containing images you want to label', self)
@@ -65,11 +168,23 @@ class SetupWindow(QWidget):
         self.selected_folder_label = QLabel(self)
         self.error_message = QLabel(self)
 
+        # Checkboxes
+        self.recursive_checkbox = QCheckBox('Include images from sub-folders', self)
+        self.archives_checkbox = QCheckBox('Read images in .zip / .tar archives', self)
+        self.label_shards_checkbox = QCheckBox('copy archive images into label shards', self)
+        self.shared_checkbox = QCheckBox('Shared labels (several annotators), annotator:', self)
+        self.annotator_input = QLineEdit(getpass.getuser(), self)
+        self.watch_checkbox = QCheckBox('Watch the folder for new, renamed and deleted images', self)
+        self.model_label = QLabel('Model suggesting labels (.onnx or module:function):', self)
+        self.model_input = QLineEdit(self)
+
         # Buttons
         self.browse_button = QtWidgets.QPushButton("Browse", self)
+        self.url_button = QtWidgets.QPushButton("URL", self)
         self.confirm_num_labels = QtWidgets.QPushButton("Ok", self)
         self.next_button = QtWidgets.QPushButton("Next", self)
         self.browse_labels_button = QtWidgets.QPushButton("Select labels", self)
+        self.browse_model_button = QtWidgets.QPushButton("Browse", self)
 
         # Inputs
         self.numLabelsInput = QLineEdit(self)
@@ -103,6 +218,11 @@ class SetupWindow(QWidget):
 
         self.browse_button.setGeometry(611, 59, 80, 28)
         self.browse_button.clicked.connect(self.pick_new)
+        self.url_button.setGeometry(695, 59, 60, 28)
+        self.url_button.clicked.connect(self.pick_url)
+
+        self.recursive_checkbox.setGeometry(60, 90, 400, 20)
+        self.recursive_checkbox.toggled.connect(self.recursive_changed)
 
         # Input number of labels
         top_margin_num_labels = 260
@@ -124,6 +244,26 @@ class SetupWindow(QWidget):
         self.confirm_num_labels.setGeometry(136, top_margin_num_labels + 89, 80, 28)
         self.confirm_num_labels.clicked.connect(self.generate_label_inputs)
 
+        # labels are stored in a database shared by all annotators of the folder
+        self.shared_checkbox.setGeometry(60, 680, 330, 20)
+        self.shared_checkbox.toggled.connect(self.shared_changed)
+        self.annotator_input.setGeometry(390, 677, 150, 26)
+        self.watch_checkbox.setGeometry(60, 710, 450, 20)
+        self.watch_checkbox.toggled.connect(self.watch_changed)
+
+        # optional model which pre-labels images in background
+        self.model_label.setGeometry(60, 743, 330, 20)
+        self.model_input.setGeometry(390, 740, 250, 26)
+        self.browse_model_button.setGeometry(645, 739, 80, 28)
+        self.browse_model_button.clicked.connect(self.pick_model)
+
+        # images inside archives are read without extracting them, in copy mode they can be written
+        # into per-label .tar shards instead of loose files
+        self.archives_checkbox.setGeometry(60, 775, 330, 20)
+        self.archives_checkbox.toggled.connect(self.archives_changed)
+        self.label_shards_checkbox.setGeometry(390, 775, 360, 20)
+        self.label_shards_checkbox.toggled.connect(self.label_shards_changed)
+
         # Next Button
         self.next_button.move(360, 630)
         self.next_button.clicked.connect(self.continue_app)
@@ -178,6 +318,19 @@ class SetupWindow(QWidget):
         radiobutton.toggled.connect(self.mode_changed)
         radiobutton.move(60, top_margin + 95)
 
+        # hardlink / reflink don't copy any data if the label folders are on the same filesystem
+        copy_method_label = QLabel('copy method:', self)
+        copy_method_label.move(80, top_margin + 122)
+        copy_method_combo = QComboBox(self)
+        copy_method_combo.addItems(COPY_METHODS)
+        copy_method_combo.setGeometry(180, top_margin + 118, 100, 24)
+        copy_method_combo.currentTextChanged.connect(self.copy_method_changed)
+
+        # file operations are planned and done at once when the changes are committed
+        deferred_checkbox = QCheckBox('defer file operations until commit', self)
+        deferred_checkbox.setGeometry(300, top_margin + 120, 400, 20)
+        deferred_checkbox.toggled.connect(self.deferred_changed)
+
     def mode_changed(self):
         """
         Sets new mode (one of: csv, copy, move)
@@ -186,6 +339,48 @@ class SetupWindow(QWidget):
         if radioButton.isChecked():
             self.mode = radioButton.mode
 
+    def copy_method_changed(self, method):
+        """
+        Sets how images are copied to label folders (one of: copy, hardlink, reflink)
+        """
+        self.copy_method = method
+
+    def deferred_changed(self, checked):
+        """
+        Sets whether file operations are done when the labels are committed instead of immediately
+        """
+        self.deferred = checked
+
+    def recursive_changed(self, checked):
+        """
+        Sets whether images from sub-folders are labeled too
+        """
+        self.recursive = checked
+
+    def archives_changed(self, checked):
+        """
+        Sets whether images inside .zip / .tar archives are labeled too
+        """
+        self.archives = checked
+
+    def label_shards_changed(self, checked):
+        """
+        Sets whether labeled images from archives are written into per-label shards (copy mode)
+        """
+        self.label_shards = checked
+
+    def shared_changed(self, checked):
+        """
+        Sets whether labels are shared with other annotators
+        """
+        self.shared = checked
+
+    def watch_changed(self, checked):
+        """
+        Sets whether images created in the folder while the app runs are added
+        """
+        self.watch = checked
+
     def pick_new(self):
         """
         shows a dialog to choose folder with images to label
@@ -196,6 +391,23 @@ class SetupWindow(QWidget):
         self.selected_folder_label.setText(folder_path)
         self.selected_folder = folder_path
 
+    def pick_model(self):
+        """
+        shows a dialog to choose an ONNX model which suggests labels
+        """
+        path, _ = QFileDialog.getOpenFileName(self, 'Select model', '', 'ONNX models (*.onnx)')
+        if path:
+            self.model_input.setText(path)
+
+    def pick_url(self):
+        """
+        shows a dialog to enter URL of a folder in an object store (e.g. http://localhost:9000/bucket/images)
+        """
+        url, ok = QInputDialog.getText(self, 'Object store', 'URL of the folder (http(s)://host/bucket/prefix):')
+        if ok and url.strip():
+            self.selected_folder_label.setText(url.strip())
+            self.selected_folder = url.strip()
+
     def pick_labels_file(self):
         options = QFileDialog.Options()
         # options |= QFileDialog.DontUseNativeDialog
@@ -276,6 +488,24 @@ class SetupWindow(QWidget):
             if label.text().strip() == '':
                 return False, 'All label fields has to be filled (step 4).'
 
+        if self.archives and self.selected_folder.startswith(('http://', 'https://')):
+            return False, 'Archives can be read only from a local folder (step 1).'
+
+        if self.shared and not self.annotator_input.text().strip():
+            return False, 'Annotator name has to be filled for shared labels.'
+
+        if self.shared and self.deferred:
+            return False, "Shared labels can't be used with deferred file operations (step 2)."
+
+        if self.watch and self.selected_folder.startswith(('http://', 'https://')):
+            return False, 'Only a local folder can be watched (step 1).'
+
+        if self.archives and self.mode == 'move':
+            return False, "Images in archives can't be moved, select csv or copy mode (step 2)."
+
+        if self.label_shards and not (self.archives and self.mode == 'copy'):
+            return False, 'Label shards are written only in copy mode from archives (step 1 and 2).'
+
         return True, 'Form ok'
 
     def continue_app(self):
@@ -291,13 +521,20 @@ class SetupWindow(QWidget):
 
             self.close()
             # show window in full-screen mode (window is maximized)
-            LabelerWindow(label_values, self.selected_folder, self.mode).showMaximized()
+            LabelerWindow(label_values, self.selected_folder, self.mode, recursive=self.recursive,
+                          copy_method=self.copy_method, deferred=self.deferred, archives=self.archives,
+                          label_shards=self.label_shards,
+                          annotator=self.annotator_input.text().strip() if self.shared else None,
+                          watch=self.watch, model=self.model_input.text().strip() or None).showMaximized()
         else:
             self.error_message.setText(message)
 
 
 class LabelerWindow(QWidget):
-    def __init__(self, labels, input_folder, mode):
+    def __init__(self, labels, input_folder, mode, recursive=False, copy_method='copy', prefetch_ahead=3,
+                 prefetch_behind=1, cache_size_mb=256, cache_policy='lru', duplicates='offer', duplicate_distance=4,
+                 hash_method='dhash', deferred=False, archives=False, label_shards=False, annotator=None,
+                 watch=False, tile_cache_mb=256, model=None):
         super().__init__()
 
         # init UI state
@@ -305,7 +542,7 @@ class LabelerWindow(QWidget):
         self.left = 200
         self.top = 100
         self.width = 1100
-        self.height = 770
+        self.height = 800
         # img panal size should be square-like to prevent some problems with different aspect ratios
         self.img_panel_width = 650
         self.img_panel_height = 650
@@ -313,15 +550,138 @@ class LabelerWindow(QWidget):
         # state variables
         self.counter = 0
         self.input_folder = input_folder
-        self.img_paths = get_img_paths(input_folder)
         self.labels = labels
         self.num_labels = len(self.labels)
-        self.num_images = len(self.img_paths)
-        self.assigned_labels = {}
+        self.num_images = 0
+        self.scanning = True
+        # images are in a local folder or in an object store, csv, journal and caches are always local
+        self.source = open_source(input_folder)
+        self.output_folder = self.source.output_folder()
+        # images are filled in background by self.scanner. Ordinals of the index and of the label store are the same
+        self.image_index = ImageIndex(self.input_folder, self.labels)
+        self.img_paths = self.image_index.paths
+        self.label_store = LabelStore(self.labels)
+        self.restored_labels = {}  # labels from previous session of images which weren't found by the scanner yet
         self.mode = mode
-
-        # initialize list to save all label buttons
-        self.label_buttons = []
+        self.copy_method = copy_method
+        # images inside archives are labeled too, in copy mode labeled ones can be written into label shards
+        self.archives = archives
+        self.label_shards = label_shards and archives and mode == 'copy'
+
+        # copying/moving images into label folders runs in background, so labeling doesn't wait for the disk
+        self.file_op_signals = FileOpSignals(self)
+        self.file_op_signals.done.connect(self.file_op_done)
+        self.file_op_signals.committed.connect(self.commit_done)
+        self.file_ops = FileOpQueue(on_done=lambda op, error: self.file_op_signals.done.emit(error))
+
+        # with annotator, labels are shared with other annotators of the folder in a database and the journal
+        # keeps only the position (and labels for crash recovery) of this annotator
+        self.label_db = None
+        journal_folder = self.output_folder
+        if annotator is not None:
+            self.label_db = LabelDatabase(os.path.join(self.output_folder, LABELS_DB_FILENAME), annotator, self.labels)
+            journal_folder = os.path.join(self.output_folder, 'annotators', annotator)
+        self.claimed = []  # keys of images claimed by this annotator
+
+        # every label change is journaled, so labels and position can be restored after a crash
+        self.journal = LabelJournal(journal_folder)
+        self.resume_position = None
+        self.load_journal()
+        self.journal.open()
+        if self.label_db is not None:
+            self.load_shared_labels()
+
+        # label changes can be undone. In deferred mode label folders are updated only when changes are committed,
+        # committed_store holds labels which are in label folders already
+        self.history = LabelHistory()
+        self.commit_log = CommitLog(self.output_folder)
+        self.committed_store = LabelStore(self.labels)
+        self.deferred_requested = deferred and mode in ('copy', 'move') and self.label_db is None
+        self.deferred = self.deferred_requested
+        self.committed_labels = {}  # committed labels of images which weren't found by the scanner yet
+        # current image wasn't found because a file operation on it is pending
+        self.waiting_for_file_ops = False
+        # commit executed by the file operation thread: (changes, plan, changed ordinals) and its result
+        self.committing = None
+        self.commit_result = None
+        if mode in ('copy', 'move'):
+            self.load_committed()
+
+        # decoded images around the current one are prepared in background threads
+        self.image_cache = ImageCache(max_bytes=cache_size_mb * 1024 * 1024, policy=cache_policy)
+        # remote images are fetched over parallel connections, so more of them are decoded at once
+        self.prefetcher = PrefetchEngine(self.image_cache, self.img_panel_width, self.img_panel_height,
+                                         ahead=prefetch_ahead, behind=prefetch_behind,
+                                         max_threads=self.source.max_connections if self.source.remote else 2,
+                                         parent=self)
+        self.prefetcher.ready.connect(self.image_ready)
+
+        # navigation never waits for the decoder: the requested image is shown when it is decoded, until then
+        # the current image stays on screen and labels are assigned to it. Navigation requested while another
+        # image is being loaded is queued (pending_steps: + next, - previous) and replayed after the image is
+        # shown, so no key press is lost and no image is skipped before it was seen.
+        self.pending_index = None
+        self.pending_since = 0
+        self.pending_steps = 0
+        self.input_stats = {'labels': 0, 'navigations': 0, 'queued': 0}
+
+        # list of labels with state of the current image
+        self.label_panel = LabelPanel(self.labels, parent=self)
+
+        # grid of thumbnails (cached on disk) for labeling many images at once
+        self.thumbnail_cache = ThumbnailCache(os.path.join(self.output_folder, 'thumbnails'))
+        self.thumbnail_grid = ThumbnailGrid(self.image_index, self.label_store, self.thumbnail_cache, parent=self)
+        self.grid_checkbox = QCheckBox('Grid view (G)', self)
+
+        # huge images are zoomed and panned in a viewer which decodes only visible tiles
+        self.tile_viewer = TileViewer(cache_size_mb=tile_cache_mb, parent=self)
+        self.zoom_checkbox = QCheckBox('Zoom (Z)', self)
+
+        # perceptual hashes are computed in background, labels can be propagated to near duplicates
+        self.duplicate_index = DuplicateIndex(max_distance=duplicate_distance)
+        self.duplicate_offer = None  # (label, ordinals of duplicates) which can be labeled by pressing D
+        self.duplicates_combo = QComboBox(self)
+        self.duplicates_combo.addItems(DUPLICATE_MODES)
+        self.duplicates_combo.setCurrentText(duplicates)
+        self.hash_cache = HashCache(os.path.join(self.output_folder, HASHES_FILENAME), hash_method)
+        self.hash_cache.load()
+        self.hasher = HashThread(self.hash_cache, parent=self)
+        self.hasher.hashed.connect(self.add_hashes)
+
+        # the model predicts labels ahead of the annotator, suggested labels are highlighted in the label panel.
+        # The queue can be ordered so images the model is least sure about come first
+        self.predictions = PredictionIndex(len(self.labels))
+        self.predictor = None
+        if model:
+            self.prediction_cache = PredictionCache(os.path.join(self.output_folder, PREDICTIONS_FILENAME),
+                                                    model_id(model))
+            self.prediction_cache.load()
+            self.predictor = PredictionThread(model, self.labels, self.prediction_cache, parent=self)
+            self.predictor.predicted.connect(self.add_predictions)
+            self.predictor.failed.connect(self.prediction_failed)
+        self.queue_combo = QComboBox(self)
+        self.queue_combo.addItems([order for order in QUEUE_ORDERS if model or order != 'most uncertain first'])
+        # descriptors for similarity order are computed only when the order is selected for the first time
+        self.descriptor_cache = DescriptorCache(os.path.join(self.output_folder, DESCRIPTORS_FILENAME))
+        self.describer = None
+
+        # metadata (dimensions, format, size, capture time) is read from headers of images in background,
+        # the queue can be sorted and filtered by it
+        self.metadata = MetadataIndex()
+        self.metadata_cache = MetadataCache(os.path.join(self.output_folder, METADATA_FILENAME))
+        self.metadata_cache.load()
+        self.metadata_reader = MetadataThread(self.metadata_cache, parent=self)
+        self.metadata_reader.read.connect(self.add_metadata)
+        self.metadata_reader.idle.connect(self.metadata_ready)
+        self.queue_filter = []
+        self.queue_filter_input = QLineEdit(self)
+        self.img_info_label = QLabel(self)
+        self.csv_metadata_checkbox = QCheckBox('image metadata columns', self)
+        # the queue ahead of the annotator is reordered at most once a second while predictions arrive
+        self.reorder_timer = QTimer(self)
+        self.reorder_timer.setSingleShot(True)
+        self.reorder_timer.setInterval(1000)
+        self.reorder_timer.timeout.connect(self.apply_queue_order)
 
         # Initialize Labels
         self.image_box = QLabel(self)
@@ -330,15 +690,51 @@ class LabelerWindow(QWidget):
         self.curr_image_headline = QLabel('Current image', self)
         self.csv_note = QLabel('(csv will be also generated automatically after closing the app)', self)
         self.csv_generated_message = QLabel(self)
+        self.profiler_stats_label = QLabel(self)
+        self.file_ops_message = QLabel(self)
+        self.file_ops_error_message = QLabel(self)
         self.show_next_checkbox = QCheckBox("Automatically show next image when labeled", self)
         self.generate_xlsx_checkbox = QCheckBox("Also generate .xlsx file", self)
+        self.generate_npz_checkbox = QCheckBox(".npz", self)
+        self.generate_parquet_checkbox = QCheckBox(".parquet", self)
 
         # create label folders
-        if mode == 'copy' or mode == 'move':
+        if (mode == 'copy' or mode == 'move') and not self.source.remote:
             self.create_label_folders(labels, self.input_folder)
 
+        # label folders and output folder are not scanned, they contain already labeled images
+        manifest_path = os.path.join(self.output_folder, 'image_manifest.bin')
+        # offset tables of archives, so members of an archive are listed only once
+        archive_index_folder = os.path.join(self.output_folder, 'archive_index') if archives else None
+        self.scanner = ScanThread(self.input_folder, recursive, exclude_dirs=labels + ['output'],
+                                  manifest_path=manifest_path, archive_index_folder=archive_index_folder,
+                                  source=self.source, parent=self)
+        self.scanner.found.connect(self.add_img_paths)
+        self.scanner.finished.connect(self.scan_finished)
+
+        # images created, renamed and deleted while the app runs are picked up. The watcher starts before the scan,
+        # so no image created during the scan is missed (images found by both are added once)
+        self.watcher = None
+        if watch and not self.source.remote:
+            self.watcher = FolderWatcher(self.input_folder, recursive=recursive, exclude_dirs=labels + ['output'],
+                                         parent=self)
+            self.watcher.changed.connect(self.folder_changed)
+            self.watcher.overflowed.connect(self.rescan)
+
         # init UI
         self.init_ui()
+        if self.watcher is not None:
+            # the scan starts when the folders are watched, so no image created during the scan is missed
+            self.watcher.ready.connect(self.scanner.start)
+            if not self.watcher.start_watching():
+                print('Watch mode requires inotify (Linux), the folder is not watched.')
+                self.watcher = None
+        if self.watcher is None:
+            self.scanner.start()
+        self.hasher.start()
+        self.metadata_reader.start()
+        if self.predictor is not None:
+            self.predictor.start()
 
     def init_ui(self):
 
@@ -355,7 +751,17 @@ class LabelerWindow(QWidget):
 
         # "create xlsx" checkbox
         self.generate_xlsx_checkbox.setChecked(False)
-        self.generate_xlsx_checkbox.setGeometry(self.img_panel_width + 140, 606, 300, 20)
+        self.generate_xlsx_checkbox.setGeometry(self.img_panel_width + 140, 606, 170, 20)
+
+        # columnar formats which can be loaded by training pipelines without parsing the csv
+        self.generate_npz_checkbox.setChecked(False)
+        self.generate_npz_checkbox.setGeometry(self.img_panel_width + 310, 606, 60, 20)
+        self.generate_parquet_checkbox.setChecked(False)
+        self.generate_parquet_checkbox.setGeometry(self.img_panel_width + 370, 606, 80, 20)
+
+        # csv gets metadata of images as extra columns
+        self.csv_metadata_checkbox.setChecked(False)
+        self.csv_metadata_checkbox.setGeometry(self.img_panel_width + 450, 606, 200, 20)
 
         # image headline
         self.curr_image_headline.setGeometry(20, 10, 300, 20)
@@ -364,6 +770,10 @@ class LabelerWindow(QWidget):
         # image name label
         self.img_name_label.setGeometry(20, 40, self.img_panel_width, 20)
 
+        # dimensions, format, size and capture time of the image
+        self.img_info_label.setGeometry(300, 65, self.img_panel_width - 280, 20)
+        self.img_info_label.setAlignment(Qt.AlignRight)
+
         # progress bar (how many images have I labeled so far)
         self.progress_bar.setGeometry(20, 65, self.img_panel_width, 20)
 
@@ -374,16 +784,61 @@ class LabelerWindow(QWidget):
         self.csv_generated_message.setGeometry(self.img_panel_width + 20, 660, 800, 20)
         self.csv_generated_message.setStyleSheet('color: #43A047')
 
-        # show image
-        self.set_image(self.img_paths[0])
+        # latency statistics (only when profiling is enabled)
+        if profiler.enabled:
+            self.profiler_stats_label.setGeometry(self.img_panel_width + 20, 720, 800, 20)
+            self.profiler_stats_label.setStyleSheet('color: #757575')
+            self.profiler_timer = QTimer(self)
+            self.profiler_timer.timeout.connect(self.update_profiler_stats)
+            self.profiler_timer.start(1000)
+
+        # label changes are written into the shared database and changes of others are read once per second
+        if self.label_db is not None:
+            self.sync_timer = QTimer(self)
+            self.sync_timer.timeout.connect(self.sync_labels)
+            self.sync_timer.start(1000)
+
+        # pending file operations and errors of file operations
+        self.file_ops_message.setGeometry(self.img_panel_width + 20, 680, 800, 20)
+        self.file_ops_error_message.setGeometry(self.img_panel_width + 20, 700, 800, 20)
+        self.file_ops_error_message.setStyleSheet('color: red')
+
+        # image is shown as soon as the scanner finds the first one
         self.image_box.setGeometry(20, 120, self.img_panel_width, self.img_panel_height)
         self.image_box.setAlignment(Qt.AlignTop)
 
-        # image name
-        self.img_name_label.setText(self.img_paths[self.counter])
+        # grid view replaces the image when turned on, label is then applied to all selected images
+        self.thumbnail_grid.setGeometry(20, 120, self.img_panel_width, self.img_panel_height)
+        self.thumbnail_grid.hide()
+        self.thumbnail_grid.image_activated.connect(self.open_image)
+        self.thumbnail_grid.selectionModel().selectionChanged.connect(self.selection_changed)
+        self.grid_checkbox.setGeometry(self.img_panel_width - 110, 10, 130, 20)
+        self.grid_checkbox.toggled.connect(self.toggle_grid)
+
+        # zoom view replaces the image when turned on: wheel zooms, dragging pans, double click fits
+        self.tile_viewer.setGeometry(20, 120, self.img_panel_width, self.img_panel_height)
+        self.tile_viewer.hide()
+        self.zoom_checkbox.setGeometry(self.img_panel_width - 200, 10, 90, 20)
+        self.zoom_checkbox.toggled.connect(self.toggle_zoom)
+
+        # what happens with near duplicates of labeled image
+        duplicates_label = QLabel('Duplicates:', self)
+        duplicates_label.setGeometry(self.img_panel_width + 20, 744, 80, 20)
+        self.duplicates_combo.setGeometry(self.img_panel_width + 100, 742, 100, 24)
+
+        # order of the images
+        queue_label = QLabel('Queue:', self)
+        queue_label.setGeometry(self.img_panel_width + 220, 744, 50, 20)
+        self.queue_combo.setGeometry(self.img_panel_width + 270, 742, 160, 24)
+        self.queue_combo.currentTextChanged.connect(self.apply_queue_order)
+        queue_filter_label = QLabel('Filter:', self)
+        queue_filter_label.setGeometry(self.img_panel_width + 220, 774, 50, 20)
+        self.queue_filter_input.setGeometry(self.img_panel_width + 270, 772, 300, 24)
+        self.queue_filter_input.setPlaceholderText('e.g. width>=3840, size<5M, format=jpeg, !corrupt')
+        self.queue_filter_input.returnPressed.connect(self.apply_queue_filter)
 
         # progress bar
-        self.progress_bar.setText(f'image 1 of {self.num_images}')
+        self.update_progress_bar()
 
         # draw line to for better UX
         ui_line = QLabel(self)
@@ -410,12 +865,58 @@ class LabelerWindow(QWidget):
         next_im_btn.move(self.img_panel_width + 140, next_prev_top_margin)
         next_im_btn.clicked.connect(self.show_next_image)
 
-        # Add "Prev Image" and "Next Image" keyboard shortcuts
-        prev_im_kbs = QShortcut(QKeySequence("left"), self)
-        prev_im_kbs.activated.connect(self.show_prev_image)
+        # Add "Prev Image" and "Next Image" keyboard shortcuts (arrows move in the grid when it is shown)
+        self.prev_im_kbs = QShortcut(QKeySequence("left"), self)
+        self.prev_im_kbs.activated.connect(self.show_prev_image)
+
+        self.next_im_kbs = QShortcut(QKeySequence("right"), self)
+        self.next_im_kbs.activated.connect(self.show_next_image)
+
+        grid_kbs = QShortcut(QKeySequence("g"), self)
+        grid_kbs.activated.connect(self.grid_checkbox.toggle)
+
+        zoom_kbs = QShortcut(QKeySequence("z"), self)
+        zoom_kbs.activated.connect(self.zoom_checkbox.toggle)
 
-        next_im_kbs = QShortcut(QKeySequence("right"), self)
-        next_im_kbs.activated.connect(self.show_next_image)
+        duplicates_kbs = QShortcut(QKeySequence("d"), self)
+        duplicates_kbs.activated.connect(self.accept_duplicate_offer)
+
+        # undo / redo of label changes
+        undo_kbs = QShortcut(QKeySequence("ctrl+z"), self)
+        undo_kbs.activated.connect(self.undo)
+
+        for sequence in ("ctrl+shift+z", "ctrl+y"):
+            redo_kbs = QShortcut(QKeySequence(sequence), self)
+            redo_kbs.activated.connect(self.redo)
+
+        # deferred mode: file operations are done when labels are committed
+        if self.deferred:
+            commit_btn = QtWidgets.QPushButton("Commit", self)
+            commit_btn.move(self.img_panel_width + 220, 738)
+            commit_btn.clicked.connect(self.commit)
+
+            commit_kbs = QShortcut(QKeySequence("ctrl+s"), self)
+            commit_kbs.activated.connect(self.commit)
+
+        # jump to the next / previous image without labels
+        next_unlabeled_kbs = QShortcut(QKeySequence("n"), self)
+        next_unlabeled_kbs.activated.connect(self.show_next_unlabeled)
+
+        prev_unlabeled_kbs = QShortcut(QKeySequence("shift+n"), self)
+        prev_unlabeled_kbs.activated.connect(self.show_prev_unlabeled)
+
+        # go to image by its number, path (or its beginning) or label
+        self.go_to_input = QLineEdit(self)
+        self.go_to_input.setGeometry(self.img_panel_width + 260, 52, 160, 26)
+        self.go_to_input.setPlaceholderText('go to: 42, sub/img, label:cat')
+        self.go_to_input.returnPressed.connect(lambda: self.go_to(self.go_to_input.text()))
+
+        go_to_kbs = QShortcut(QKeySequence("ctrl+g"), self)
+        go_to_kbs.activated.connect(self.go_to_input.setFocus)
+
+        self.navigation_message = QLabel(self)
+        self.navigation_message.setGeometry(self.img_panel_width + 20, 84, 400, 20)
+        self.navigation_message.setStyleSheet('color: #757575')
 
         # Add "generate csv file" button
         next_im_btn = QtWidgets.QPushButton("Generate csv", self)
@@ -423,150 +924,1168 @@ class LabelerWindow(QWidget):
         next_im_btn.clicked.connect(lambda state, filename='assigned_classes': self.generate_csv(filename))
         next_im_btn.setObjectName("blueButton")
 
-        # Create button for each label
-        x_shift = 0  # variable that helps to compute x-coordinate of button in UI
-        for i, label in enumerate(self.labels):
-            self.label_buttons.append(QtWidgets.QPushButton(label, self))
-            button = self.label_buttons[i]
+        # Create list of labels (click on label sets the label)
+        self.label_panel.setGeometry(self.img_panel_width + 20, 110, 400, 470)
+        self.label_panel.label_activated.connect(self.label_activated)
 
-            # create click event (set label)
+        # create keyboard shortcut events (set label). Labels above 9 are selected by typing the number quickly
+        for digit in '0123456789':
+            label_kbs = QShortcut(QKeySequence(digit), self)
             # https://stackoverflow.com/questions/35819538/using-lambda-expression-to-connect-slots-in-pyqt
-            button.clicked.connect(lambda state, x=label: self.set_label(x))
+            label_kbs.activated.connect(lambda x=digit: self.label_panel.digit_pressed(x))
+
+        # typeahead filter of labels
+        filter_kbs = QShortcut(QKeySequence("/"), self)
+        filter_kbs.activated.connect(self.label_panel.focus_filter)
+
+    def add_img_paths(self, paths):
+        """
+        Appends image paths found by the scanner. The first image is shown as soon as it is found.
+        :param paths: list of image paths
+        """
+        first_batch = self.num_images == 0
+        ordinals = [self.register_image(path) for path in paths]
+        self.num_images = len(self.image_index)
+        if self.label_db is not None:
+            self.label_db.add_images(self.image_index.key(i) for i in ordinals)
+        self.thumbnail_grid.grid_model.set_row_count(self.num_images)
+        self.hash_images(ordinals)
+        self.predict_images(ordinals)
+        self.describe_images(ordinals)
+        self.read_image_metadata(ordinals)
+
+        resume_index = self.find_resume_index(ordinals)
+        if resume_index is not None:
+            self.show_image_at(resume_index)
+        elif first_batch:
+            path = self.get_img_location(self.counter)
+            self.set_image(path)
+            self.img_name_label.setText(path)
+            self.show_image_info()
+            self.set_button_color(self.image_index.key(self.counter))
+        elif self.image_index.position(self.counter) + self.prefetcher.ahead >= self.num_images - len(paths):
+            # new images are close to the current one
+            self.prefetch_neighbours()
+
+        self.update_progress_bar()
+
+    def folder_changed(self, events):
+        """
+        Applies changes of the watched folder in the order they happened
+        :param events: list of ('created', path), ('deleted', path), ('renamed', old path, new path)
+            and ('folder_deleted', path)
+        """
+        created = []
+        for event in events:
+            if event[0] == 'created':
+                created.append(event[1])
+                continue
+
+            if created:
+                self.add_img_paths(created)
+                created = []
+            if event[0] == 'deleted':
+                self.image_deleted(event[1])
+            elif event[0] == 'folder_deleted':
+                self.folder_deleted(event[1])
+            else:
+                self.image_renamed(event[1], event[2])
+
+        if created:
+            self.add_img_paths(created)
+
+    def image_deleted(self, path):
+        """
+        Marks the deleted image as removed, it keeps its ordinal and labels but navigation skips it
+        """
+        ordinal = self.image_index.ordinal(self.image_index.make_key(path))
+        # in 'move' mode the app itself moves labeled images into label folders
+        if ordinal is None or self.image_index.home[ordinal] >= 0:
+            return
+
+        self.image_index.remove(ordinal)
+        self.thumbnail_grid.grid_model.refresh_rows([ordinal])
+        if ordinal == self.counter:
+            self.navigation_message.setText('The image was deleted.')
+
+    def folder_deleted(self, folder):
+        """
+        Marks images of the sub-folder which was moved out of the input folder as removed
+        """
+        prefix = self.image_index.make_key(folder) + '/'
+        for ordinal in self.image_index.with_prefix(prefix).tolist():
+            self.image_deleted(self.image_index.paths[ordinal])
+
+    def image_renamed(self, old_path, new_path):
+        """
+        The renamed image keeps its ordinal and labels. In copy mode the copies in label folders are renamed too.
+        """
+        ordinal = self.image_index.ordinal(self.image_index.make_key(old_path))
+        if ordinal is None or self.image_index.ordinal(self.image_index.make_key(new_path)) is not None:
+            # unknown image, or it replaced another image
+            if ordinal is not None:
+                self.image_deleted(old_path)
+            self.add_img_paths([new_path])
+            return
+
+        old_key = self.image_index.key(ordinal)
+        labels = self.label_store.get_labels(old_key)
+        old_label_paths = [self.image_index.label_path(ordinal, label) for label in labels]
+        new_key = self.image_index.rename(ordinal, new_path)
+        self.label_store.rename(old_key, new_key)
+        self.committed_store.rename(old_key, new_key)
+
+        for label in labels:
+            self.journal.record_label(old_key, label, False)
+            if self.label_db is not None:
+                self.label_db.record(old_key, label, False)
+            self.record_label(new_key, label)
+
+        if self.mode == 'copy' and not self.deferred and labels:
+            ops = [('remove', path) for path in old_label_paths]
+            ops += [('copy', new_path, os.path.dirname(self.image_index.label_path(ordinal, label)), self.copy_method)
+                    for label in labels]
+            self.file_ops.submit_batch(ops)
+            self.update_file_ops_message()
+
+        self.thumbnail_grid.grid_model.refresh_rows([ordinal])
+        if ordinal == self.counter:
+            self.img_name_label.setText(new_path)
+
+    def rescan(self):
+        """
+        Scans the folder again (watch mode lost some events), images found already are skipped
+        """
+        if not self.scanner.isRunning():
+            self.scanning = True
+            self.scanner.start()
+
+    def register_image(self, path):
+        """
+        Adds the image to the image index and to the label store (rows of the label store and csv follow
+        the order of images in the folder) and restores its labels from previous session.
+        :param path: original path of the image
+        :return: ordinal of the image
+        """
+        ordinal = self.image_index.add(path)
+        key = self.image_index.key(ordinal)
+        self.label_store.add_image(key)
+        self.committed_store.add_image(key)
+
+        for label in self.restored_labels.pop(key, ()):
+            self.label_store.set(key, label, True)
 
-            # create keyboard shortcut event (set label)
-            # shortcuts start getting overwritten when number of labels >9
-            label_kbs = QShortcut(QKeySequence(f"{i+1 % 10}"), self)
-            label_kbs.activated.connect(lambda x=label: self.set_label(x))
+        committed = self.committed_labels.pop(key, ())
+        for label in committed:
+            self.committed_store.set(key, label, True)
+
+        # in 'move' mode the image is in the folder of its first committed label (unless the move didn't happen)
+        if self.mode == 'move' and committed:
+            first_label = self.committed_store.first_label(key)
+            if path_exists(self.image_index.label_path(ordinal, first_label)):
+                self.image_index.set_home(ordinal, first_label)
+
+        return ordinal
+
+    def hash_images(self, ordinals):
+        """
+        Queues images for computing of perceptual hashes
+        :param ordinals: ordinals of images
+        """
+        self.hasher.enqueue((self.image_index.key(i), self.image_index.location(i)) for i in ordinals)
+
+    def add_hashes(self, hashes):
+        """
+        Called when the hash thread computed a batch of hashes
+        :param hashes: list of (img_key, hash)
+        """
+        for img_key, value in hashes:
+            self.duplicate_index.add(img_key, value)
+
+    def predict_images(self, ordinals):
+        """
+        Queues images for prediction of their labels (if there is a model)
+        :param ordinals: ordinals of images
+        """
+        if self.predictor is not None:
+            self.predictor.enqueue((self.image_index.key(i), self.image_index.location(i)) for i in ordinals)
+
+    def add_predictions(self, predictions):
+        """
+        Called when the prediction thread predicted a batch of images
+        :param predictions: list of (img_key, probabilities of labels)
+        """
+        for img_key, probabilities in predictions:
+            ordinal = self.image_index.ordinal(img_key)
+            if ordinal is not None:
+                self.predictions.set(ordinal, probabilities)
+                if ordinal == self.counter and not self.grid_checkbox.isChecked():
+                    self.label_panel.set_suggested(self.predictions.suggested(ordinal))
+
+        if self.queue_combo.currentText() == 'most uncertain first' and not self.reorder_timer.isActive():
+            self.reorder_timer.start()
+
+    def describe_images(self, ordinals):
+        """
+        Queues images for computing of similarity descriptors (once the similarity order was selected)
+        :param ordinals: ordinals of images
+        """
+        if self.describer is not None:
+            self.describer.enqueue((i, self.image_index.key(i), self.image_index.location(i)) for i in ordinals)
+
+    def descriptors_ready(self):
+        """
+        Called when all queued images are described, the queue is clustered again with new images
+        """
+        if self.queue_combo.currentText() == 'similar images together':
+            self.apply_queue_order()
+
+    def similar_order_ready(self, ordered):
+        """
+        Called when the descriptor thread clustered the queue. Images after the current one are put in the
+        similarity order, the user could go on while the queue was clustered.
+        :param ordered: ordinals in similarity order
+        """
+        if self.queue_combo.currentText() != 'similar images together' or self.num_images == 0:
+            return
+
+        current = self.image_index.full_order()
+        position = int(np.flatnonzero(current == self.counter)[0])
+        ahead = current[position + 1:]
+        ordered = ordered[np.isin(ordered, ahead)]
+        # images found after the order was requested follow in the current order
+        self.set_queue(np.concatenate([current[:position + 1], ordered, ahead[~np.isin(ahead, ordered)]]))
+        self.update_progress_bar()
+        self.prefetch_neighbours()
+
+    def read_image_metadata(self, ordinals):
+        """
+        Queues images for reading of their metadata
+        :param ordinals: ordinals of images
+        """
+        self.metadata_reader.enqueue((self.image_index.key(i), self.image_index.location(i)) for i in ordinals)
+
+    def add_metadata(self, records):
+        """
+        Called when the metadata thread read a batch of images
+        :param records: list of (img_key, metadata record)
+        """
+        for img_key, record in records:
+            ordinal = self.image_index.ordinal(img_key)
+            if ordinal is not None:
+                self.metadata.set(ordinal, record)
+                if ordinal == self.counter:
+                    self.show_image_info()
+
+    def metadata_ready(self):
+        """
+        Called when metadata of all queued images is read, images are sorted and filtered again with new images
+        """
+        if self.queue_combo.currentText() in METADATA_ORDERS or self.queue_filter:
+            self.apply_queue_order()
+
+    def show_image_info(self):
+        """
+        shows metadata of the current image
+        """
+        record = self.metadata.get(self.counter) if self.num_images > 0 else None
+        self.img_info_label.setText(format_metadata(record) if record is not None else '')
+
+    def apply_queue_filter(self):
+        """
+        Leaves images which don't match the filter out of the queue (empty filter = all images)
+        """
+        try:
+            self.queue_filter = parse_filter(self.queue_filter_input.text())
+        except ValueError as e:
+            self.navigation_message.setText(f'Filter: {e}')
+            return
+
+        self.queue_filter_input.clearFocus()
+        self.apply_queue_order()
+        self.navigation_message.setText(f'{self.image_index.queue_length()} images in the queue'
+                                        if self.queue_filter else '')
+
+    def prediction_failed(self, message):
+        print(message)
+        self.navigation_message.setText(message)
+
+    def apply_queue_order(self):
+        """
+        Orders images after the current one as selected in the queue combo (images before it keep their order)
+        and leaves images which don't match the filter out
+        """
+        order = self.queue_combo.currentText()
+        if order == 'similar images together' and self.describer is None:
+            self.descriptor_cache.load()
+            self.describer = DescriptorThread(self.descriptor_cache, parent=self)
+            self.describer.idle.connect(self.descriptors_ready)
+            self.describer.ordered.connect(self.similar_order_ready)
+            self.describer.start()
+            self.describe_images(range(self.num_images))
+
+        if order == 'folder order' and not self.queue_filter:
+            self.image_index.set_order(None)
+        elif self.num_images > 0:
+            # images left out by the previous filter are included again, the filter is applied to all images
+            current = np.arange(self.num_images) if order == 'folder order' else self.image_index.full_order()
+            position = int(np.flatnonzero(current == self.counter)[0])
+            ahead = current[position + 1:]
+            if order == 'most uncertain first':
+                labeled = self.label_store.counts[:self.num_images] > 0
+                ahead = self.predictions.uncertain_first(ahead, labeled)
+            elif order == 'similar images together':
+                # clustered in the descriptor thread, images keep their order until similar_order_ready().
+                # Clusters start with the cluster of the current image, so the next image is similar to it
+                self.describer.request_order(current[position:])
+            elif order in METADATA_ORDERS:
+                ahead = self.metadata.sorted(ahead, *METADATA_ORDERS[order])
+            self.set_queue(np.concatenate([current[:position + 1], ahead]))
+
+        self.update_progress_bar()
+        self.prefetch_neighbours()
+
+    def set_queue(self, queue):
+        """
+        Sets navigation order, images which don't match the queue filter are left out
+        :param queue: ordinals of all images in the new order
+        """
+        if self.queue_filter:
+            # the current image stays in the queue, so navigation continues from it
+            queue = queue[self.metadata.matches(queue, self.queue_filter) | (queue == self.counter)]
+        self.image_index.set_order(queue)
+
+    def file_op_done(self, error):
+        """
+        Called when background file operation is finished
+        :param error: error message ('' if the operation succeeded)
+        """
+        if error:
+            print(error)
+            self.file_ops_error_message.setText(error)
+        self.update_file_ops_message()
+        self.reload_waiting_image()
+
+        # thumbnails of moved images which weren't in place yet are loaded again
+        if self.grid_checkbox.isChecked():
+            self.thumbnail_grid.viewport().update()
+
+    def reload_waiting_image(self):
+        """
+        shows the current image again if it wasn't there when it was shown (it was being moved)
+        """
+        if self.waiting_for_file_ops and self.pending_index is None:
+            self.set_image(self.get_img_location(self.counter))
+
+    def update_file_ops_message(self):
+        pending = self.file_ops.pending
+        self.file_ops_message.setText(f'{pending} file operations pending' if pending else '')
+
+    def update_profiler_stats(self):
+        """
+        shows navigation latency and image cache hit rate
+        """
+        text = f'cache hit rate {self.image_cache.hit_rate():.0%}'
+        navigate = profiler.stats('navigate')
+        if navigate is not None:
+            text = f'navigation p50 {navigate["p50_ms"]:.1f} ms, p99 {navigate["p99_ms"]:.1f} ms | ' + text
+        decode = profiler.stats('decode.read')
+        if decode is not None:
+            text += f' | decode p50 {decode["p50_ms"]:.1f} ms'
+        self.profiler_stats_label.setText(text)
+
+    def scan_finished(self):
+        self.scanning = False
+
+        # labeled images from previous session which weren't found (e.g. they are in label folders in 'move' mode)
+        # are added at the end, so their labels are kept
+        if self.restored_labels or self.committed_labels:
+            first_batch = self.num_images == 0
+            img_keys = list(self.restored_labels) + [key for key in self.committed_labels
+                                                     if key not in self.restored_labels]
+            ordinals = [self.register_image(os.path.join(self.input_folder, *img_key.split('/')))
+                        for img_key in img_keys]
+            self.num_images = len(self.image_index)
+            self.thumbnail_grid.grid_model.set_row_count(self.num_images)
+            self.hash_images(ordinals)
+            self.predict_images(ordinals)
+            self.describe_images(ordinals)
+            self.read_image_metadata(ordinals)
+            if first_batch and self.resume_position is None:
+                self.show_image_at(0)
+
+        # the last image of previous session wasn't found (e.g. it was moved), continue at the same index
+        if self.resume_position is not None and self.num_images > 0:
+            self.show_image_at(min(self.resume_position['counter'], self.num_images - 1))
+            self.resume_position = None
+
+        self.update_progress_bar()
+
+    def load_journal(self):
+        """
+        Restores labels and position saved in the journal by previous session
+        """
+        assigned_labels, self.resume_position = self.journal.replay()
 
-            # place button in GUI (create multiple columns if there is more than 10 button)
-            y_shift = (30 + 10) * (i % 10)
-            if (i != 0 and i % 10 == 0):
-                x_shift += 120
-                y_shift = 0
+        for img_key, labels in assigned_labels.items():
+            # labels which are not used in this session are dropped
+            labels = [label for label in labels if label in self.label_store.label_to_int]
+            if labels:
+                self.restored_labels[img_key] = labels
 
-            button.move(self.img_panel_width + 20 + x_shift, y_shift + 120)
+        if self.restored_labels:
+            print(f'Restored labels of {len(self.restored_labels)} images from previous session.')
 
+    def load_shared_labels(self):
+        """
+        Labels in the shared database replace labels from the journal, they include changes of other annotators
+        """
+        self.restored_labels = {}
+        for img_key, labels in self.label_db.load_labels().items():
+            labels = [label for label in labels if label in self.label_store.label_to_int]
+            if labels:
+                self.restored_labels[img_key] = labels
+        print(f'Loaded labels of {len(self.restored_labels)} images from the shared database.')
+
+    def record_label(self, img_key, label):
+        """
+        Journals the new state of the label of the image (and writes it into the shared database)
+        """
+        assigned = self.label_store.has(img_key, label)
+        self.journal.record_label(img_key, label, assigned)
+        if self.label_db is not None:
+            self.label_db.record(img_key, label, assigned)
+
+    def sync_labels(self):
+        """
+        Writes label changes into the shared database and applies label changes of other annotators
+        """
+        try:
+            self.label_db.flush()
+            changes = self.label_db.poll_changes()
+        except sqlite3.Error as e:
+            print(f"Can't sync labels: {e}")
+            return
+
+        changed = []
+        for img_key, label, assigned, annotator in changes:
+            if label not in self.label_store.label_to_int:
+                continue
+
+            ordinal = self.image_index.ordinal(img_key)
+            if ordinal is None:
+                # image wasn't found by the scanner yet, labels are set when it is
+                labels = self.restored_labels.setdefault(img_key, [])
+                if assigned and label not in labels:
+                    labels.append(label)
+                elif not assigned and label in labels:
+                    labels.remove(label)
+                if not labels:
+                    del self.restored_labels[img_key]
+                continue
+
+            if self.label_store.has(img_key, label) != assigned:
+                # the other annotator did the file operations already
+                self.label_store.set(img_key, label, assigned)
+                if self.mode == 'move':
+                    self.image_index.set_home(ordinal, self.label_store.first_label(img_key))
+                changed.append(ordinal)
+
+        if changed:
+            self.thumbnail_grid.grid_model.refresh_rows(changed)
+            if self.counter in changed:
+                self.set_button_color(self.image_index.key(self.counter))
+            self.navigation_message.setText(f'{len(changed)} labels changed by other annotators')
+
+    def load_committed(self):
+        """
+        Finishes commit interrupted in previous session and loads labels which are in label folders
+        """
+        plan, done = self.commit_log.load_plan()
+        committed = self.commit_log.load_committed()
+
+        if plan is not None:
+            print(f'Resuming interrupted commit ({done} of {len(plan["ops"])} file operations done).')
+            self.commit_log.execute(plan, done)
+            committed = committed if committed is not None else {}
+            committed.update(plan['labels'])
+            committed = {img_key: labels for img_key, labels in committed.items() if labels}
+            self.commit_log.save_committed(committed)
+            self.commit_log.finish()
+
+        if committed is None:
+            # label folders were kept in sync with labels (no deferred session yet)
+            committed = dict(self.restored_labels)
+            if self.deferred:
+                self.commit_log.save_committed(committed)
+        elif not self.deferred:
+            # previous deferred session wasn't committed, file operations are deferred until they are
+            print('Labels of previous session were not committed, file operations are deferred until commit.')
+            self.deferred = True
+
+        for img_key, labels in committed.items():
+            labels = [label for label in labels if label in self.label_store.label_to_int]
+            if labels:
+                self.committed_labels[img_key] = labels
+
+    def find_resume_index(self, ordinals):
+        """
+        :param ordinals: ordinals of newly found images
+        :return: index of the image where the previous session ended, if it is in ordinals
+        """
+        if self.resume_position is None:
+            return None
+
+        for ordinal in ordinals:
+            if self.image_index.key(ordinal) == self.resume_position['img']:
+                self.resume_position = None
+                return ordinal
+
+        return None
+
+    def update_progress_bar(self):
+        """
+        shows position of the current image (and the state of the folder scan)
+        """
+        if self.num_images == 0:
+            text = 'scanning…' if self.scanning else 'No images found in the selected folder'
+        else:
+            queue_length = self.image_index.queue_length()
+            text = f'image {self.image_index.position(self.counter) + 1} of {queue_length}'
+            if queue_length < self.num_images:
+                text += f' ({self.num_images - queue_length} filtered out)'
+            if self.scanning:
+                text += f' (scanning… {self.num_images} found)'
+
+        self.progress_bar.setText(text)
+
+    def label_activated(self, label):
+        """
+        Called when label is selected in the label panel (click, number or filter)
+        :param label: selected label
+        """
+        if self.grid_checkbox.isChecked():
+            self.set_label_selected(label)
+        else:
+            self.set_label(label)
+
+    @profiler.instrumented('set_label')
     def set_label(self, label):
         """
         Sets the label for just loaded image
         :param label: selected label
         """
+        if self.num_images == 0:
+            return
+
+        index = self.counter
+        claims = self.claimed_by_others([index])
+        if claims:
+            self.navigation_message.setText(f'This image is claimed by {claims[index]}.')
+            return
+
+        self.input_stats['labels'] += 1
+        ops = []
+        img_key = self.image_index.key(index)
+        self.label_image(index, label, ops)
+        self.history.record(label, [index], self.label_store.has(img_key, label))
+        if ops:
+            self.file_ops.submit_batch(ops)
+            self.update_file_ops_message()
+
+        if self.journal.needs_compaction():
+            self.journal.compact(self.label_store.as_dict(), {'counter': self.counter, 'img': img_key})
+        self.thumbnail_grid.grid_model.refresh_rows([index])
+
+        # load next image
+        if self.show_next_checkbox.isChecked():
+            self.show_next_image()
+        else:
+            self.set_button_color(img_key)
+
+        if self.label_store.has(img_key, label):
+            self.handle_duplicates([index], label)
+
+    def label_image(self, index, label, ops):
+        """
+        Toggles the label of the image and plans file operations which keep label folders in sync
+        :param index: index of the image
+        :param label: selected label
+        :param ops: list where planned file operations are appended
+        """
+        # image is identified by its path relative to the input folder (img1.jpg, sub/img1.jpg, ...)
+        img_path = self.img_paths[index]
+        img_key = self.image_index.key(index)
 
-        # get image filename from path (./data/images/img1.jpg → img1.jpg)
-        img_path = self.img_paths[self.counter]
-        img_name = os.path.split(img_path)[-1]
+        # label folders are updated when the changes are committed, label shards when the app is closed
+        if self.deferred or self.in_label_shard(img_path):
+            self.label_store.toggle(img_key, label)
+            self.record_label(img_key, label)
+            return
+
+        # path where the image is stored now and its path in the label folder
+        img_location = self.image_index.location(index)
+        label_path = self.image_index.label_path(index, label)
+        copy_to = os.path.dirname(label_path)
 
         # if the img has some label already
-        if img_name in self.assigned_labels.keys():
+        if img_key in self.label_store:
 
             # label is already there = means tht user want's to remove label
-            if label in self.assigned_labels[img_name]:
-                self.assigned_labels[img_name].remove(label)
-
-                # remove key from dictionary if no labels are assigned to this image
-                if len(self.assigned_labels[img_name]) == 0:
-                    self.assigned_labels.pop(img_name, None)
+            if self.label_store.has(img_key, label):
+                self.label_store.set(img_key, label, False)
 
                 # remove image from appropriate folder
                 if self.mode == 'copy':
-                    os.remove(os.path.join(self.input_folder, label, img_name))
+                    ops.append(('remove', label_path))
 
                 elif self.mode == 'move':
                     # label was in assigned labels, so I want to remove it from label folder,
-                    # but this was the last label, so move the image to input folder.
+                    # but this was the last label, so move the image to its original folder.
                     # Don't remove it, because it it not save anywehre else
-                    if img_name not in self.assigned_labels.keys():
-                        shutil.move(os.path.join(self.input_folder, label, img_name), self.input_folder)
+                    if img_key not in self.label_store:
+                        ops.append(('move', label_path, os.path.dirname(img_path)))
                     else:
                         # label was in assigned labels and the image is store in another label folder,
                         # so I want to remove it from current label folder
-                        os.remove(os.path.join(self.input_folder, label, img_name))
+                        ops.append(('remove', label_path))
 
             # label is not there yet. But the image has some labels already
             else:
-                self.assigned_labels[img_name].append(label)
-
-                # path to copy/move images
-                copy_to = os.path.join(self.input_folder, label)
+                self.label_store.set(img_key, label, True)
 
                 # copy/move the image into appropriate label folder
                 if self.mode == 'copy':
                     # the image is stored in input_folder, so i can copy it from there (differs from 'move' option)
-                    shutil.copy(img_path, copy_to)
+                    ops.append(('copy', img_path, copy_to, self.copy_method))
 
                 elif self.mode == 'move':
                     # the image doesn't have to be stored in input_folder anymore.
-                    # get the path where the image is stored
-                    copy_from = os.path.join(self.input_folder, self.assigned_labels[img_name][0], img_name)
-                    shutil.copy(copy_from, copy_to)
+                    ops.append(('copy', img_location, copy_to, self.copy_method))
 
         else:
             # Image has no labels yet. Set new label and copy/move
 
-            self.assigned_labels[img_name] = [label]
+            self.label_store.set(img_key, label, True)
             # move copy images to appropriate directories
-            copy_to = os.path.join(self.input_folder, label)
-
             if self.mode == 'copy':
-                shutil.copy(img_path, copy_to)
+                ops.append(('copy', img_path, copy_to, self.copy_method))
             elif self.mode == 'move':
-                shutil.move(img_path, copy_to)
+                ops.append(('move', img_path, copy_to))
 
-        # load next image
-        if self.show_next_checkbox.isChecked():
-            self.show_next_image()
+        # in 'move' mode the image is stored in folders of all its labels, it is read from the first one
+        if self.mode == 'move':
+            self.image_index.set_home(index, self.label_store.first_label(img_key))
+
+        self.record_label(img_key, label)
+
+    @profiler.instrumented('set_label_selected')
+    def set_label_selected(self, label):
+        """
+        Assigns the label to all images selected in the grid (or removes it, if all of them have it already).
+        File operations of all images are submitted as one batch.
+        :param label: selected label
+        """
+        ordinals = self.thumbnail_grid.selected_ordinals()
+        if not ordinals:
+            return
+
+        assign = label not in [self.labels[i] for i in self.label_store.common_label_ordinals(ordinals)]
+        changed = self.apply_label(ordinals, label, assign)
+        self.selection_changed()
+        action = 'assigned to' if assign else 'removed from'
+        self.navigation_message.setText(f'{label} {action} {len(changed)} images')
+        if assign:
+            self.handle_duplicates(changed, label)
+
+    def apply_label(self, ordinals, label, assign, record=True):
+        """
+        Assigns (or removes) the label to all images which don't have it (have it).
+        File operations of all images are submitted as one batch.
+        :param ordinals: ordinals of images
+        :param label: label
+        :param assign: True = assign, False = remove
+        :param record: record the change for undo
+        :return: ordinals of images which changed
+        """
+        ops = []
+        changed = []
+        claims = self.claimed_by_others(ordinals) if assign else {}
+        for index in ordinals:
+            if index not in claims and self.label_store.has(self.image_index.key(index), label) != assign:
+                self.label_image(index, label, ops)
+                changed.append(index)
+        if record:
+            self.history.record(label, changed, assign)
+
+        if ops:
+            self.file_ops.submit_batch(ops)
+            self.update_file_ops_message()
+
+        if self.journal.needs_compaction():
+            self.journal.compact(self.label_store.as_dict(),
+                                 {'counter': self.counter, 'img': self.image_index.key(self.counter)})
+
+        self.thumbnail_grid.grid_model.refresh_rows(changed)
+        return changed
+
+    def claimed_by_others(self, ordinals):
+        """
+        Shared labels: images claimed by other annotators aren't labeled, so annotators don't collide
+        :param ordinals: ordinals of images
+        :return: {ordinal: annotator} of images claimed by other annotators
+        """
+        if self.label_db is None:
+            return {}
+        try:
+            claims = self.label_db.claimed_by_others(self.image_index.key(i) for i in ordinals)
+        except sqlite3.Error as e:
+            print(f"Can't read claims: {e}")
+            return {}
+        return {self.image_index.ordinal(img_key): annotator for img_key, annotator in claims.items()}
+
+    def handle_duplicates(self, ordinals, label):
+        """
+        Finds near duplicates of just labeled images which don't have the label yet. Depending on the duplicates
+        setting, they are labeled automatically or offered for labeling (key D).
+        :param ordinals: ordinals of labeled images
+        :param label: assigned label
+        """
+        mode = self.duplicates_combo.currentText()
+        if mode == 'ignore':
+            return
+
+        labeled = set(ordinals)
+        duplicates = set()
+        for index in ordinals:
+            for img_key in self.duplicate_index.duplicates(self.image_index.key(index)):
+                ordinal = self.image_index.ordinal(img_key)
+                if ordinal is not None and ordinal not in labeled and not self.label_store.has(img_key, label):
+                    duplicates.add(ordinal)
+        if not duplicates:
+            return
+
+        duplicates = sorted(duplicates)
+        if mode == 'label automatically':
+            changed = self.apply_label(duplicates, label, True)
+            self.navigation_message.setText(f'{label} also assigned to {len(changed)} duplicates')
         else:
-            self.set_button_color(img_name)
+            self.duplicate_offer = (label, duplicates)
+            self.navigation_message.setText(f'{len(duplicates)} duplicates found, press D to label them {label}')
 
-    def show_next_image(self):
+    def accept_duplicate_offer(self):
         """
-        loads and shows next image in dataset
+        Labels duplicates found by the last labeling (key D)
         """
-        if self.counter < self.num_images - 1:
-            self.counter += 1
+        if self.duplicate_offer is None:
+            return
+
+        label, duplicates = self.duplicate_offer
+        self.duplicate_offer = None
+        changed = self.apply_label(duplicates, label, True)
+        self.navigation_message.setText(f'{label} assigned to {len(changed)} duplicates')
+        if self.grid_checkbox.isChecked():
+            self.selection_changed()
+        else:
+            self.set_button_color(self.image_index.key(self.counter))
 
-            path = self.img_paths[self.counter]
-            filename = os.path.split(path)[-1]
+    def undo(self):
+        """
+        reverts the last label change (Ctrl+Z)
+        """
+        command = self.history.undo()
+        if command is not None:
+            label, ordinals, assigned = command
+            self.replay_command(label, ordinals, not assigned, 'undone')
 
-            # If we have already assigned label to this image and mode is 'move', change the input path.
-            # The reason is that the image was moved from '.../input_folder' to '.../input_folder/label'
-            if self.mode == 'move' and filename in self.assigned_labels.keys():
-                path = os.path.join(self.input_folder, self.assigned_labels[filename][0], filename)
+    def redo(self):
+        """
+        applies the last undone label change again (Ctrl+Shift+Z)
+        """
+        command = self.history.redo()
+        if command is not None:
+            label, ordinals, assigned = command
+            self.replay_command(label, ordinals, assigned, 'redone')
 
-            self.set_image(path)
-            self.img_name_label.setText(path)
-            self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
-            self.set_button_color(filename)
-            self.csv_generated_message.setText('')
+    def replay_command(self, label, ordinals, assign, action):
+        """
+        applies the label change of undo / redo and shows the changed image
+        """
+        self.apply_label(ordinals, label, assign, record=False)
+        self.duplicate_offer = None
+        self.navigation_message.setText(f'{action}: {label} {"assigned to" if assign else "removed from"} '
+                                        f'{len(ordinals)} images')
+
+        if self.grid_checkbox.isChecked():
+            self.selection_changed()
+        elif len(ordinals) == 1 and ordinals[0] != self.counter:
+            self.show_image_at(ordinals[0])
+        else:
+            self.set_button_color(self.image_index.key(self.counter))
 
+    def commit(self):
+        """
+        Deferred mode: plans file operations which bring label folders in sync with labels and executes them
+        in the file operation thread. Label changes which cancel each other out (e.g. label assigned and removed
+        again) cost nothing.
+        """
+        if not self.deferred or self.num_images == 0:
+            return
+        if self.committing is not None:
+            self.navigation_message.setText('Previous commit is still in progress.')
+            return
+
+        n = self.num_images
+        changed = np.flatnonzero((self.label_store.bits[:n] != self.committed_store.bits[:n]).any(axis=1))
+        if len(changed) == 0:
+            self.navigation_message.setText('Nothing to commit.')
+            return
+
+        changes = []
+        for ordinal in changed.tolist():
+            img_key = self.image_index.key(ordinal)
+            changes.append((ordinal, self.committed_store.get_labels(img_key), self.label_store.get_labels(img_key)))
+
+        # archive images are written into label shards instead
+        copied = [change for change in changes if not self.in_label_shard(self.img_paths[change[0]])]
+        plan = {
+            'ops': plan_commit(self.image_index, copied, self.mode, self.copy_method),
+            'labels': {self.image_index.key(ordinal): after for ordinal, _, after in changes},
+        }
+
+        def execute():
+            with profiler.span('commit'):
+                return self.commit_log.execute(plan, on_error=self.file_op_signals.done.emit)
+
+        def executed(errors, error):
+            # called from the file operation thread
+            self.commit_result = (errors, error)
+            self.file_op_signals.committed.emit()
+
+        self.committing = (changes, plan, changed)
+        self.file_ops.submit_call(execute, on_done=executed, size=len(plan['ops']))
+        self.update_file_ops_message()
+        self.navigation_message.setText(f'committing {len(plan["ops"])} file operations of {len(changes)} images…')
+
+    def commit_done(self):
+        """
+        Called when the commit plan was executed, labels of the commit are in label folders now
+        """
+        if self.committing is None:
+            return
+        changes, plan, changed = self.committing
+        errors, error = self.commit_result
+        self.committing = None
+        self.commit_result = None
+        self.update_file_ops_message()
+        if error:
+            # the plan stays saved, the commit is resumed when the folder is opened again
+            print(error)
+            self.navigation_message.setText(error)
+            return
+
+        for ordinal, before, after in changes:
+            img_key = self.image_index.key(ordinal)
+            for label in set(before) ^ set(after):
+                self.committed_store.set(img_key, label, label in after)
+            if self.mode == 'move':
+                self.image_index.set_home(ordinal, after[0] if after else None)
+
+        self.commit_log.save_committed(self.committed_store.as_dict())
+        self.commit_log.finish()
+        self.thumbnail_grid.grid_model.refresh_rows(changed)
+        self.reload_waiting_image()
+
+        message = f'{len(plan["ops"])} file operations of {len(changes)} images committed'
+        if errors:
+            message += f', {errors} failed'
+        self.navigation_message.setText(message)
+        print(message)
+
+    def toggle_grid(self, checked):
+        """
+        switches between the grid of thumbnails and the current image
+        :param checked: True = show the grid
+        """
+        self.prev_im_kbs.setEnabled(not checked)
+        self.next_im_kbs.setEnabled(not checked)
+        self.image_box.setVisible(not checked and not self.zoom_checkbox.isChecked())
+        self.tile_viewer.setVisible(not checked and self.zoom_checkbox.isChecked())
+        self.zoom_checkbox.setEnabled(not checked)
+        self.thumbnail_grid.setVisible(checked)
+
+        if checked:
+            self.thumbnail_grid.select_ordinal(self.counter)
+            self.thumbnail_grid.setFocus()
+        else:
+            # continue with the image which was current in the grid
+            current = self.thumbnail_grid.currentIndex()
+            if current.isValid():
+                self.counter = current.row()
+            if self.num_images > 0:
+                self.show_image_at(self.counter)
+
+    def toggle_zoom(self, checked):
+        """
+        switches between the image scaled to the panel and the zoomable viewer
+        :param checked: True = show the zoomable viewer
+        """
+        if self.grid_checkbox.isChecked():
+            return
+        self.image_box.setVisible(not checked)
+        self.tile_viewer.setVisible(checked)
+        if checked and self.num_images > 0:
+            self.tile_viewer.open(self.get_img_location(self.counter))
+
+    def open_image(self, index):
+        """
+        leaves the grid and shows the image (double click in the grid)
+        :param index: index of the image
+        """
+        self.thumbnail_grid.select_ordinal(index)
+        self.grid_checkbox.setChecked(False)
+
+    def selection_changed(self):
+        """
+        shows labels which all selected images have
+        """
+        if not self.grid_checkbox.isChecked():
+            return
+
+        ordinals = self.thumbnail_grid.selected_ordinals()
+        self.label_panel.set_assigned(self.label_store.common_label_ordinals(ordinals))
+        self.img_name_label.setText(f'{len(ordinals)} images selected')
+
+    def show_next_image(self):
+        """
+        loads and shows next image in dataset
+        """
+        if self.pending_index is not None:
+            self.queue_step(forward=True)
+            return
+
+        # images deleted in watch mode are skipped
+        index = self.image_index.step(self.counter)
+        if index is not None:
+            self.resume_position = None
+            self.show_image_at(index)
 
         # change button color if this is last image in dataset
-        elif self.counter == self.num_images - 1:
-            path = self.img_paths[self.counter]
-            self.set_button_color(os.path.split(path)[-1])
+        elif self.image_index.position(self.counter) == self.image_index.queue_length() - 1:
+            self.set_button_color(self.image_index.key(self.counter))
 
     def show_prev_image(self):
         """
         loads and shows previous image in dataset
         """
-        if self.counter > 0:
-            self.counter -= 1
+        if self.pending_index is not None:
+            self.queue_step(forward=False)
+            return
+
+        index = self.image_index.step(self.counter, forward=False)
+        if index is not None:
+            self.resume_position = None
+            self.show_image_at(index)
+
+    def queue_step(self, forward):
+        """
+        remembers navigation which came while an image is being loaded, it is replayed one image at a time
+        after the image is shown, so no image is skipped before it was seen
+        :param forward: True = next image, False = previous image
+        """
+        self.pending_steps += 1 if forward else -1
+        self.input_stats['queued'] += 1
+
+    def replay_steps(self):
+        """
+        replays queued navigation until an image has to be loaded again
+        """
+        while self.pending_steps and self.pending_index is None:
+            forward = self.pending_steps > 0
+            remaining = self.pending_steps - (1 if forward else -1)
+            index = self.image_index.step(self.counter, forward=forward)
+            if index is None:
+                remaining = 0
+            else:
+                self.show_image_at(index)
+            self.pending_steps = remaining
+
+    def show_next_unlabeled(self):
+        """
+        shows the next image which has no labels yet
+        """
+        if self.label_db is not None:
+            self.jump_to(self.claimed_image(), 'No unlabeled image is left for you.')
+            return
+
+        if self.image_index.order is None:
+            index = self.label_store.find_unlabeled(self.counter, excluded=self.image_index.removed)
+        else:
+            index = self.image_index.step(self.counter, accepted=self.label_store.counts == 0)
+        self.jump_to(index, 'No unlabeled image after this one.')
+
+    def claimed_image(self, forward=True):
+        """
+        Shared labels: finds an unlabeled image claimed by this annotator, a new batch of images is claimed
+        when there is none
+        :param forward: True = the first claimed image, False = the nearest claimed image before the current one
+        :return: index of the image or None
+        """
+        for claim in (False, True):
+            try:
+                self.label_db.flush()
+                self.claimed = self.label_db.claim_batch() if claim else self.label_db.claimed()
+            except sqlite3.Error as e:
+                print(f"Can't claim images: {e}")
+                return None
+
+            # images labeled by others meanwhile and images which weren't scanned yet are skipped
+            ordinals = [self.image_index.ordinal(img_key) for img_key in self.claimed]
+            ordinals = [ordinal for ordinal in ordinals if ordinal is not None and not self.label_store.counts[ordinal]]
+            if forward:
+                if ordinals:
+                    return ordinals[0]
+                continue
+
+            accepted = np.zeros(len(self.image_index), dtype=bool)
+            accepted[ordinals] = True
+            index = self.image_index.step(self.counter, forward=False, accepted=accepted)
+            if index is not None:
+                return index
+        return None
+
+    def show_prev_unlabeled(self):
+        """
+        shows the previous image which has no labels yet
+        """
+        if self.label_db is not None:
+            self.jump_to(self.claimed_image(forward=False), 'No unlabeled image of yours before this one.')
+            return
+
+        if self.image_index.order is None:
+            index = self.label_store.find_unlabeled(self.counter, forward=False, excluded=self.image_index.removed)
+        else:
+            index = self.image_index.step(self.counter, forward=False, accepted=self.label_store.counts == 0)
+        self.jump_to(index, 'No unlabeled image before this one.')
+
+    def go_to(self, text):
+        """
+        shows image described by text:
+        - number of the image (as in the progress bar)
+        - 'label:<label>' = next image with the label (search wraps around)
+        - path of the image relative to input folder or its beginning
+        :param text: text from the "go to" input
+        """
+        text = text.strip()
+        if not text:
+            return
+
+        if text.isdigit():
+            # the number is the position in the queue, as in the progress bar
+            position = int(text) - 1
+            index = None
+            if 0 <= position < self.image_index.queue_length():
+                index = position if self.image_index.order is None else int(self.image_index.order[position])
+            self.jump_to(index, f'There is no image number {text}.')
+        elif text.startswith('label:'):
+            label = text[len('label:'):].strip()
+            if label not in self.label_store.label_to_int:
+                self.navigation_message.setText(f'Unknown label: {label}')
+                return
+            if self.image_index.order is None:
+                removed = self.image_index.removed
+                index = self.label_store.find_with_label(label, self.counter, excluded=removed)
+                if index is None:
+                    index = self.label_store.find_with_label(label, -1, excluded=removed)
+            else:
+                # images left out of the queue by the filter aren't found
+                with_label = self.label_store.with_label(label)
+                index = self.image_index.step(self.counter, accepted=with_label)
+                if index is None:
+                    index = self.image_index.first(accepted=with_label)
+            self.jump_to(index, f'No image with label {label}.')
+        else:
+            index = self.image_index.find_prefix(text.replace(os.sep, '/'), after=self.counter)
+            self.jump_to(index, f'No image matches {text}.')
+
+        self.go_to_input.clearFocus()
+
+    def jump_to(self, index, not_found_message):
+        """
+        shows image with given index or a message when the image wasn't found
+        :param index: index of the image or None
+        :param not_found_message: message shown when index is None
+        """
+        if index is None or index >= self.num_images:
+            self.navigation_message.setText(not_found_message)
+            return
+
+        self.navigation_message.setText('')
+        self.resume_position = None
+        self.show_image_at(index)
+        if self.grid_checkbox.isChecked():
+            self.thumbnail_grid.select_ordinal(index)
+
+    def show_image_at(self, index):
+        """
+        shows image with given index. If the image isn't decoded yet, it is shown as soon as it is decoded.
+        :param index: index of the image in img_paths
+        """
+        # number typed on the current image belongs to it
+        self.label_panel.flush_chord()
+        self.input_stats['navigations'] += 1
+        self.pending_steps = 0
+        if self.duplicate_offer is not None:
+            self.duplicate_offer = None
+            self.navigation_message.setText('')
+
+        if self.prefetcher.request(self.get_img_location(index)) is None:
+            self.pending_index = index
+            self.pending_since = time.perf_counter_ns()
+            self.img_name_label.setText(f'{self.get_img_location(index)} (loading…)')
+            return
+        self.display_image(index)
+
+    def image_ready(self, path):
+        """
+        Called when the prefetcher decoded an image, shows it if it is the requested one
+        """
+        if self.pending_index is not None and self.get_img_location(self.pending_index) == path:
+            # time the user waited for the image
+            if profiler.enabled:
+                profiler.record('navigate.wait', self.pending_since, time.perf_counter_ns())
+            self.display_image(self.pending_index)
+            self.replay_steps()
+
+    def display_image(self, index):
+        """
+        shows image with given index (the image is decoded or can't be decoded at all)
+        :param index: index of the image in img_paths
+        """
+        self.pending_index = None
+        self.counter = index
 
-            if self.counter < self.num_images:
-                path = self.img_paths[self.counter]
-                filename = os.path.split(path)[-1]
+        with profiler.span('navigate'):
+            path = self.get_img_location(self.counter)
+            img_key = self.image_index.key(self.counter)
 
-                # If we have already assigned label to this image and mode is 'move', change the input path.
-                # The reason is that the image was moved from '.../input_folder' to '.../input_folder/label'
-                if self.mode == 'move' and filename in self.assigned_labels.keys():
-                    path = os.path.join(self.input_folder, self.assigned_labels[filename][0], filename)
+            self.set_image(path)
+            self.img_name_label.setText(path)
+            self.show_image_info()
+            self.update_progress_bar()
+            self.set_button_color(img_key)
+            self.csv_generated_message.setText('')
 
-                self.set_image(path)
-                self.img_name_label.setText(path)
-                self.progress_bar.setText(f'image {self.counter + 1} of {self.num_images}')
+        self.journal.record_position(self.counter, img_key)
 
-                self.set_button_color(filename)
-                self.csv_generated_message.setText('')
+    def get_img_location(self, index):
+        """
+        :param index: index of the image in img_paths
+        :return: path where the image is currently stored
+        """
+        # If we have already assigned label to this image and mode is 'move', the image was moved
+        # from '.../input_folder' to '.../input_folder/label'
+        return self.image_index.location(index)
 
     def set_image(self, path):
         """
@@ -574,21 +2093,30 @@ class LabelerWindow(QWidget):
         :param path: relative path to the image that should be show
         """
 
-        pixmap = QPixmap(path)
+        # image is already decoded and scaled to fit into the image window if it was prefetched
+        with profiler.span('set_image.load'):
+            image = self.prefetcher.load(path)
+        # the image may be still on its way to the label folder, it is loaded again when file operations finish
+        self.waiting_for_file_ops = image.isNull() and self.file_ops.pending > 0
 
-        # get original image dimensions
-        img_width = pixmap.width()
-        img_height = pixmap.height()
+        with profiler.span('set_image.set_pixmap'):
+            if self.waiting_for_file_ops:
+                self.image_box.setText('waiting for file operations…')
+            else:
+                self.image_box.setPixmap(QPixmap.fromImage(image))
+        if self.zoom_checkbox.isChecked():
+            self.tile_viewer.open(path)
 
-        # scale the image properly so it fits into the image window ()
-        margin = 20
-        if img_width >= img_height:
-            pixmap = pixmap.scaledToWidth(self.img_panel_width - margin)
+        self.prefetch_neighbours()
 
-        else:
-            pixmap = pixmap.scaledToHeight(self.img_panel_height - margin)
-
-        self.image_box.setPixmap(pixmap)
+    def prefetch_neighbours(self):
+        """
+        starts decoding of images around the current one in background
+        """
+        ahead, behind = self.image_index.neighbours(self.counter, self.prefetcher.ahead, self.prefetcher.behind)
+        paths_ahead = [self.get_img_location(i) for i in ahead]
+        paths_behind = [self.get_img_location(i) for i in behind]
+        self.prefetcher.prefetch(paths_ahead, paths_behind)
 
     def generate_csv(self, out_filename):
         """
@@ -596,63 +2124,67 @@ class LabelerWindow(QWidget):
         Assigned label is represented as one-hot vector.
         :param out_filename: name of csv file to be generated
         """
-        path_to_save = os.path.join(self.input_folder, 'output')
+        path_to_save = self.output_folder
         make_folder(path_to_save)
         csv_file_path = os.path.join(path_to_save, out_filename) + '.csv'
 
-        with open(csv_file_path, "w", newline='') as csv_file:
-            writer = csv.writer(csv_file, delimiter=',')
-
-            # write header
-            writer.writerow(['img'] + self.labels)
-
-            # write one-hot labels
-            for img_name, labels in self.assigned_labels.items():
-                labels_one_hot = self.labels_to_zero_one(labels)
-                writer.writerow([img_name] + list(labels_one_hot))
+        # shared labels are exported from the database, so the files contain labels of all annotators.
+        # The csv is written under temporary name, so annotators exporting at once don't mix their files
+        exporter = self.label_store if self.label_db is None else self.label_db
+        if self.label_db is not None:
+            self.label_db.flush()
+
+        # write header and one-hot labels
+        with profiler.span('export.csv'):
+            tmp_path = f'{csv_file_path}.{os.getpid()}.tmp'
+            extra_columns = None
+            if self.csv_metadata_checkbox.isChecked():
+                extra_columns = (METADATA_COLUMNS, self.metadata_columns)
+            exporter.export_csv(tmp_path, extra_columns=extra_columns)
+            os.replace(tmp_path, csv_file_path)
 
         message = f'csv saved to: {csv_file_path}'
         self.csv_generated_message.setText(message)
         print(message)
 
+        # other formats are written directly from the label store, not converted from the csv
+        out_path = os.path.join(path_to_save, out_filename)
         if self.generate_xlsx_checkbox.isChecked():
-            try:
-                self.csv_to_xlsx(csv_file_path)
-            except:
-                print('Generating xlsx file failed.')
+            self.export_labels('xlsx', lambda: exporter.export_xlsx(out_path + '.xlsx'))
+        if self.generate_npz_checkbox.isChecked():
+            self.export_labels('npz', lambda: exporter.export_npz(out_path + '.npz'))
+        if self.generate_parquet_checkbox.isChecked():
+            self.export_labels('parquet', lambda: exporter.export_arrow(out_path + '.parquet'))
 
-    def csv_to_xlsx(self, csv_file_path):
+    def metadata_columns(self, img_keys):
         """
-        converts csv file to xlsx file
-        :param csv_file_path: path to csv file which we want to convert to lsx
+        :return: values of metadata columns of the images for the csv
         """
-        workbook = Workbook(csv_file_path[:-4] + '.xlsx')
-        worksheet = workbook.add_worksheet()
-
-        with open(csv_file_path, 'rt', encoding='utf8') as f:
-            reader = csv.reader(f)
-            for r, row in enumerate(reader):
-                for c, col in enumerate(row):
-                    worksheet.write(r, c, col)
+        ordinals = [self.image_index.ordinal(img_key) for img_key in img_keys]
+        return [metadata_fields(self.metadata.get(ordinal) if ordinal is not None else None) for ordinal in ordinals]
 
-        workbook.close()
-
-    def set_button_color(self, filename):
+    @staticmethod
+    def export_labels(file_format, export):
         """
-        changes color of button which corresponds to selected label
-        :filename filename of loaded image:
+        Runs the export and reports its failure
+        :param file_format: name of the format (for error message)
+        :param export: function which writes the file
         """
+        try:
+            with profiler.span(f'export.{file_format}'):
+                export()
+        except Exception as e:
+            print(f'Generating {file_format} file failed: {e}')
 
-        if filename in self.assigned_labels.keys():
-            assigned_labels = self.assigned_labels[filename]
-        else:
-            assigned_labels = []
-
-        for button in self.label_buttons:
-            if button.text() in assigned_labels:
-                button.setStyleSheet('border: 1px solid #43A047; background-color: #4CAF50; color: white')
-            else:
-                button.setStyleSheet('background-color: None')
+    @profiler.instrumented('set_button_color')
+    def set_button_color(self, img_key):
+        """
+        changes color of labels assigned to the image (only labels whose state changed are repainted)
+        :param img_key: key of loaded image (path relative to input folder)
+        """
+        self.label_panel.set_assigned(self.label_store.get_label_ordinals(img_key))
+        ordinal = self.image_index.ordinal(img_key)
+        self.label_panel.set_suggested(self.predictions.suggested(ordinal) if ordinal is not None else {})
 
     def closeEvent(self, event):
         """
@@ -660,25 +2192,78 @@ class LabelerWindow(QWidget):
         It automatically generates csv file in case the user forgot to do that
         """
         print("closing the App..")
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.scanner.requestInterruption()
+        self.scanner.wait()
+        self.prefetcher.shutdown()
+        self.tile_viewer.shutdown()
+        self.pending_index = None
+        self.pending_steps = 0
+        self.thumbnail_grid.grid_model.shutdown()
+        self.hasher.stop()
+        self.hash_cache.save()
+        if self.predictor is not None:
+            self.reorder_timer.stop()
+            self.predictor.stop()
+            self.prediction_cache.save()
+        if self.describer is not None:
+            self.describer.stop()
+            self.descriptor_cache.save()
+        self.metadata_reader.stop()
+        self.metadata_cache.save()
+        # signals of the file operation thread aren't delivered any more, commit in progress is finished here
+        self.file_ops.join()
+        self.commit_done()
+        if self.deferred:
+            self.commit()
+        self.file_ops.close()
+        self.commit_done()
+        if self.deferred:
+            if not self.deferred_requested:
+                # label folders are in sync again, next session can do file operations immediately
+                self.commit_log.remove_committed()
+        if self.label_shards:
+            self.write_label_shards()
+        close_archives()
+        close_sources()
+        if self.label_db is not None:
+            self.sync_timer.stop()
+            self.label_db.flush()
+        print(f'image cache: {self.image_cache.hits} hits, {self.image_cache.misses} misses')
         self.generate_csv('assigned_classes_automatically_generated')
+        if self.label_db is not None:
+            self.label_db.close()
+        self.journal.close()
 
-    def labels_to_zero_one(self, labels):
+        if profiler.enabled:
+            profiler.print_summary()
+        if profiler.trace_path:
+            profiler.write_trace()
+
+    def in_label_shard(self, img_path):
         """
-        Convert number to one-hot vector
-        :param number: number which represents for example class index
-        :param num_classes: number of classes in dataset so I know how long the vector should be
-        :return:
+        :return: True if labels of the image are written into label shards instead of label folders
         """
+        return self.label_shards and split_member_path(img_path) is not None
 
-        # create mapping from label name to its index for better efficiency {label : int}
-        label_to_int = dict((c, i) for i, c in enumerate(self.labels))
-
-        # initialize array to save selected labels
-        zero_one_arr = np.zeros([self.num_labels], dtype=int)
-        for label in labels:
-            zero_one_arr[label_to_int[label]] = 1
+    def write_label_shards(self):
+        """
+        Writes labeled images from archives into per-label .tar shards in label folders
+        """
+        items = []
+        for ordinal in np.flatnonzero(self.label_store.counts[:self.num_images]).tolist():
+            img_path = self.img_paths[ordinal]
+            if self.in_label_shard(img_path):
+                img_key = self.image_index.key(ordinal)
+                items.append((img_key, img_path, self.label_store.get_labels(img_key)))
 
-        return zero_one_arr
+        try:
+            with profiler.span('export.shards'):
+                written = write_label_shards(self.input_folder, self.labels, items)
+            print(f'{written} archive images written into label shards')
+        except (OSError, KeyError, tarfile.TarError) as e:
+            print(f"Can't write label shards: {e}")
 
     @staticmethod
     def create_label_folders(labels, folder):
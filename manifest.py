@@ -0,0 +1,206 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from scanning import IMG_EXTENSIONS
+
+MANIFEST_MAGIC = b'IMGMANI1'
+MANIFEST_VERSION = 2
+# mtime of a folder which couldn't be scanned, it never matches, so the folder is scanned next time
+DIRTY_MTIME = -2 ** 63
+
+
+def _pack_strings(strings):
+    return '\0'.join(strings).encode('utf-8', 'surrogateescape')
+
+
+def _unpack_strings(blob, count):
+    if count == 0:
+        return []
+    return blob.decode('utf-8', 'surrogateescape').split('\0')
+
+
+class Manifest:
+    """
+    Persistent listing of images in the input folder.
+
+    The manifest stores every scanned folder with its mtime and names of the images it contains.
+    When the folder is opened again, only folders whose mtime changed are listed again, the rest is taken
+    from the manifest. Adding, removing or renaming a file changes the mtime of its parent folder, so
+    an unchanged dataset costs one read of the manifest file and one stat per folder. Editing an image in place
+    doesn't change the listing, caches of image data (metadata, hashes, ...) check size and mtime of the image.
+
+    File format: magic, length of json header, json header (scan parameters and table sizes),
+    packed string table of folder paths (relative to root), folder mtimes, number of images per folder,
+    packed string table of image names.
+    """
+
+    def __init__(self, root, extensions=IMG_EXTENSIONS, recursive=False, exclude_dirs=()):
+        self.root = root
+        self.extensions = tuple(extensions)
+        self.recursive = recursive
+        self.exclude_dirs = sorted(exclude_dirs)
+
+        # {relative folder path: (mtime_ns, [image names], [sub-folder names])}
+        self.dirs = {}
+        self.rescanned_dirs = 0
+
+    def params(self):
+        return {'extensions': list(self.extensions), 'recursive': self.recursive, 'exclude_dirs': self.exclude_dirs}
+
+    def load(self, path):
+        """
+        Loads manifest saved by previous session. Manifest created with different scan parameters is ignored.
+        :param path: path to the manifest file
+        :return: True if the manifest was loaded
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+
+        try:
+            if data[:len(MANIFEST_MAGIC)] != MANIFEST_MAGIC:
+                return False
+            offset = len(MANIFEST_MAGIC)
+            header_len, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            header = json.loads(data[offset:offset + header_len])
+            offset += header_len
+
+            if header['version'] != MANIFEST_VERSION or header['params'] != self.params():
+                return False
+
+            num_dirs = header['num_dirs']
+            num_files = header['num_files']
+
+            def read_blob(length):
+                nonlocal offset
+                blob = data[offset:offset + length]
+                offset += length
+                return blob
+
+            def read_array(dtype, count):
+                nonlocal offset
+                array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+                offset += array.nbytes
+                return array
+
+            dir_paths = _unpack_strings(read_blob(header['dir_strings_len']), num_dirs)
+            dir_mtimes = read_array('<i8', num_dirs)
+            dir_file_counts = read_array('<i8', num_dirs)
+            file_names = _unpack_strings(read_blob(header['file_strings_len']), num_files)
+        except (ValueError, KeyError, struct.error) as e:
+            print(f"Can't read manifest {path}: {e}")
+            return False
+
+        self.dirs = {}
+        start = 0
+        for rel_dir, mtime, count in zip(dir_paths, dir_mtimes.tolist(), dir_file_counts.tolist()):
+            self.dirs[rel_dir] = (mtime, file_names[start:start + count], [])
+            start += count
+
+        # sub-folder lists are derived from folder paths
+        for rel_dir in dir_paths:
+            if rel_dir != '':
+                parent, name = os.path.split(rel_dir)
+                if parent in self.dirs:
+                    self.dirs[parent][2].append(name)
+        for _, _, sub_dirs in self.dirs.values():
+            sub_dirs.sort()
+
+        return True
+
+    def save(self, path):
+        """
+        Writes the manifest (atomically, so a crash can't leave a broken manifest behind)
+        :param path: path to the manifest file
+        """
+        dir_paths = list(self.dirs)
+        files = [file for rel_dir in dir_paths for file in self.dirs[rel_dir][1]]
+
+        dir_blob = _pack_strings(dir_paths)
+        file_blob = _pack_strings(files)
+        header = json.dumps({
+            'version': MANIFEST_VERSION,
+            'params': self.params(),
+            'num_dirs': len(dir_paths),
+            'num_files': len(files),
+            'dir_strings_len': len(dir_blob),
+            'file_strings_len': len(file_blob),
+        }).encode('utf-8')
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MANIFEST_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(dir_blob)
+            f.write(np.array([self.dirs[d][0] for d in dir_paths], dtype='<i8').tobytes())
+            f.write(np.array([len(self.dirs[d][1]) for d in dir_paths], dtype='<i8').tobytes())
+            f.write(file_blob)
+        os.replace(tmp_path, path)
+
+    def scan(self):
+        """
+        Generator of image paths (same order as scanning.scan_img_paths). Folders which didn't change since
+        the manifest was saved are not listed again. The manifest is updated during the scan.
+        :return: generator of image paths
+        """
+        old_dirs = self.dirs
+        self.dirs = {}
+        self.rescanned_dirs = 0
+        stack = ['']
+
+        while stack:
+            rel_dir = stack.pop()
+            folder = os.path.join(self.root, rel_dir) if rel_dir else self.root
+
+            try:
+                # mtime is read before listing, so changes made during the listing are caught next time
+                mtime = os.stat(folder).st_mtime_ns
+                old = old_dirs.get(rel_dir)
+                if old is not None and old[0] == mtime:
+                    files, sub_dirs = old[1], old[2]
+                else:
+                    files, sub_dirs = self._scan_dir(folder, rel_dir)
+                    self.rescanned_dirs += 1
+            except OSError as e:
+                print(f"Can't scan folder {folder}: {e}")
+                # the folder stays in the list of its parent and it's scanned again next time
+                self.dirs[rel_dir] = (DIRTY_MTIME, [], [])
+                continue
+
+            self.dirs[rel_dir] = (mtime, files, sub_dirs)
+            for name in files:
+                yield os.path.join(folder, name)
+
+            if self.recursive:
+                stack.extend(os.path.join(rel_dir, name) for name in reversed(sub_dirs))
+
+    def _scan_dir(self, folder, rel_dir):
+        """
+        :return: names of images and sub-folders of the folder, both sorted by name
+        :raises OSError: when the folder can't be listed
+        """
+        files = []
+        sub_dirs = []
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.name.lower().endswith(self.extensions):
+                    files.append(entry.name)
+                elif self.recursive and entry.is_dir(follow_symlinks=False):
+                    if rel_dir == '' and entry.name in self.exclude_dirs:
+                        continue
+                    sub_dirs.append(entry.name)
+            except OSError:
+                # file was removed during the scan
+                continue
+
+        return files, sub_dirs
@@ -0,0 +1,448 @@
+"""
+Metadata of images: dimensions, format, file size, capture time and whether the image can be read at all.
+
+Only the beginning of each file is read (dimensions are in the header, capture time in the EXIF segment),
+images are never decoded. Metadata is read in parallel by a background thread and cached in columns
+(one array per field) in output/image_metadata.npz, next to the manifest. The queue can be sorted and filtered
+by these fields and the csv can include them as extra columns.
+"""
+import calendar
+import os
+import queue
+import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtGui import QImageIOHandler
+
+from archives import read_head, stat_image
+from instrumentation import profiler
+from label_store import METADATA_COLUMNS
+from prefetch import image_reader, reader_from_bytes
+
+METADATA_FILENAME = 'image_metadata.npz'
+# queue orders by metadata: (field, descending)
+METADATA_ORDERS = {
+    'highest resolution first': ('pixels', True),
+    'largest files first': ('file_size', True),
+    'oldest capture first': ('capture_time', False),
+}
+# JPEG headers with EXIF (which can contain a thumbnail) fit into this, the image data isn't read
+HEAD_SIZE = 128 * 1024
+
+_EXIF_DATE = re.compile(rb'(\d{4}):(\d{2}):(\d{2}) (\d{2}):(\d{2}):(\d{2})')
+_TAG_DATE_TIME = 0x0132
+_TAG_EXIF_IFD = 0x8769
+_TAG_DATE_TIME_ORIGINAL = 0x9003
+
+
+def _parse_exif_date(value):
+    """
+    :return: seconds since epoch (EXIF time has no time zone, it is taken as UTC) or None
+    """
+    match = _EXIF_DATE.match(value)
+    if match is None:
+        return None
+    try:
+        return float(calendar.timegm(tuple(int(part) for part in match.groups()) + (0, 0, 0)))
+    except (ValueError, OverflowError):
+        return None
+
+
+def _read_ifd(tiff, offset, endian):
+    """
+    :return: {tag: (type, count, value or offset field)} of the IFD
+    """
+    entries = {}
+    count, = struct.unpack_from(endian + 'H', tiff, offset)
+    for i in range(count):
+        tag, value_type, value_count = struct.unpack_from(endian + 'HHI', tiff, offset + 2 + 12 * i)
+        entries[tag] = (value_type, value_count, offset + 2 + 12 * i + 8)
+    return entries
+
+
+def tiff_capture_time(tiff):
+    """
+    :param tiff: TIFF structure (a TIFF file or the EXIF segment of a JPEG after 'Exif\\0\\0')
+    :return: DateTimeOriginal (or DateTime) as seconds since epoch, None if it isn't there
+    """
+    try:
+        endian = {b'II': '<', b'MM': '>'}[tiff[:2]]
+        ifd0 = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian)
+        exif = {}
+        if _TAG_EXIF_IFD in ifd0:
+            exif = _read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, ifd0[_TAG_EXIF_IFD][2])[0], endian)
+
+        for ifd, tag in ((exif, _TAG_DATE_TIME_ORIGINAL), (ifd0, _TAG_DATE_TIME)):
+            if tag in ifd:
+                _, count, field = ifd[tag]
+                # ASCII value longer than 4 bytes is stored at an offset
+                start = struct.unpack_from(endian + 'I', tiff, field)[0] if count > 4 else field
+                capture_time = _parse_exif_date(tiff[start:start + count])
+                if capture_time is not None:
+                    return capture_time
+    except (KeyError, struct.error):
+        pass
+    return None
+
+
+def exif_capture_time(data):
+    """
+    :param data: beginning of a JPEG or TIFF file
+    :return: capture time as seconds since epoch, None if it isn't known
+    """
+    if data[:4] in (b'II*\0', b'MM\0*'):
+        return tiff_capture_time(data)
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    # JPEG segments up to the start of the image data
+    offset = 2
+    while offset + 4 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        if marker == 0xDA:
+            break
+        length, = struct.unpack_from('>H', data, offset + 2)
+        if marker == 0xE1 and data[offset + 4:offset + 10] == b'Exif\0\0':
+            return tiff_capture_time(data[offset + 10:offset + 2 + length])
+        offset += 2 + length
+    return None
+
+
+def read_metadata(path, stat):
+    """
+    Reads metadata from the header of the image
+    :param stat: stat of the image (see stat_image())
+    :return: (width, height, format, file size, capture time (None = unknown), corrupt)
+    """
+    try:
+        head = read_head(path, HEAD_SIZE)
+    except OSError:
+        return 0, 0, '', stat.st_size, None, True
+
+    reader = reader_from_bytes(head)
+    size = reader.size()
+    if not size.isValid() and len(head) < stat.st_size:
+        # the header is longer (e.g. big metadata segments), the reader reads only as far as it needs
+        reader = image_reader(path)
+        size = reader.size()
+
+    image_format = bytes(reader.format()).decode('ascii', 'replace')
+    corrupt = not size.isValid() or size.isEmpty()
+    width, height = (0, 0) if corrupt else (size.width(), size.height())
+    # dimensions are stored before any EXIF rotation, the displayed image is rotated
+    if reader.transformation() & QImageIOHandler.TransformationRotate90:
+        width, height = height, width
+    return width, height, image_format, stat.st_size, exif_capture_time(head), corrupt
+
+
+class MetadataIndex:
+    """
+    Metadata of images by ordinal, one array per field
+    """
+
+    def __init__(self, capacity=1024):
+        self.width = np.zeros(capacity, dtype=np.int32)
+        self.height = np.zeros(capacity, dtype=np.int32)
+        self.format = np.zeros(capacity, dtype=np.int16)  # index into formats
+        self.file_size = np.zeros(capacity, dtype=np.int64)
+        self.capture_time = np.full(capacity, np.nan, dtype=np.float64)
+        self.corrupt = np.zeros(capacity, dtype=bool)
+        self.known = np.zeros(capacity, dtype=bool)
+        self.formats = ['']
+        self._format_to_int = {'': 0}
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def _grow(self, capacity):
+        for name, fill in (('width', 0), ('height', 0), ('format', 0), ('file_size', 0), ('capture_time', np.nan),
+                           ('corrupt', False), ('known', False)):
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column, np.full(capacity - len(column), fill, dtype=column.dtype)]))
+
+    def set(self, ordinal, record):
+        """
+        :param record: (width, height, format, file size, capture time, corrupt)
+        """
+        if ordinal >= len(self.known):
+            self._grow(max(ordinal + 1, 2 * len(self.known)))
+        width, height, image_format, file_size, capture_time, corrupt = record
+        if image_format not in self._format_to_int:
+            self._format_to_int[image_format] = len(self.formats)
+            self.formats.append(image_format)
+
+        self.width[ordinal] = width
+        self.height[ordinal] = height
+        self.format[ordinal] = self._format_to_int[image_format]
+        self.file_size[ordinal] = file_size
+        self.capture_time[ordinal] = np.nan if capture_time is None else capture_time
+        self.corrupt[ordinal] = corrupt
+        self.known[ordinal] = True
+
+    def get(self, ordinal):
+        """
+        :return: record of the image or None if its metadata wasn't read yet
+        """
+        if ordinal >= len(self.known) or not self.known[ordinal]:
+            return None
+        capture_time = self.capture_time[ordinal]
+        return (int(self.width[ordinal]), int(self.height[ordinal]), self.formats[self.format[ordinal]],
+                int(self.file_size[ordinal]), None if np.isnan(capture_time) else float(capture_time),
+                bool(self.corrupt[ordinal]))
+
+    def column(self, field, ordinals):
+        """
+        :return: values of the field (width, height, pixels, file_size, capture_time, format, corrupt) of the images
+        """
+        if field == 'pixels':
+            return self.width[ordinals].astype(np.int64) * self.height[ordinals]
+        if field == 'format':
+            return np.array(self.formats, dtype=object)[self.format[ordinals]]
+        return getattr(self, field)[ordinals]
+
+    def sorted(self, ordinals, field, descending=False):
+        """
+        :return: ordinals sorted by the field (stable), images with unknown value go to the end
+        """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        self._ensure(ordinals)
+        values = self.column(field, ordinals).astype(np.float64)
+        unknown = ~self.known[ordinals] | np.isnan(values)
+        values = np.nan_to_num(-values if descending else values)
+        return ordinals[np.lexsort((values, unknown))]
+
+    def matches(self, ordinals, conditions):
+        """
+        :param conditions: list of (field, operator, value) from parse_filter()
+        :return: bool array, True for images which satisfy all conditions. Images whose metadata wasn't read
+            yet pass, they are filtered when it is read.
+        """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        self._ensure(ordinals)
+        result = np.ones(len(ordinals), dtype=bool)
+        for field, operator, value in conditions:
+            values = self.column(field, ordinals)
+            with np.errstate(invalid='ignore'):
+                if operator == '=':
+                    result &= values == value
+                elif operator == '!=':
+                    result &= values != value
+                elif operator == '>':
+                    result &= values > value
+                elif operator == '>=':
+                    result &= values >= value
+                elif operator == '<':
+                    result &= values < value
+                else:
+                    result &= values <= value
+        return result | ~self.known[ordinals]
+
+    def _ensure(self, ordinals):
+        if len(ordinals) and ordinals.max() >= len(self.known):
+            self._grow(int(ordinals.max()) + 1)
+
+
+_SUFFIXES = {'k': 1e3, 'm': 1e6, 'g': 1e9}
+_CONDITION = re.compile(r'^\s*(!?)\s*([a-z_]+)\s*(?:(>=|<=|!=|=|>|<)\s*(.+?))?\s*$')
+FILTER_FIELDS = ('width', 'height', 'pixels', 'size', 'format', 'date', 'corrupt')
+
+
+def parse_filter(text):
+    """
+    Parses queue filter: comma separated conditions, e.g. 'width>=3840, size<5M, format=jpeg, date>=2021-06-01,
+    !corrupt'. Numbers can have suffix k, M or G (thousands, millions, billions).
+    :return: list of (field, operator, value), ValueError if the filter is invalid
+    """
+    conditions = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        match = _CONDITION.match(part.lower())
+        if match is None or match.group(2) not in FILTER_FIELDS:
+            raise ValueError(f'invalid filter condition "{part.strip()}", fields: {", ".join(FILTER_FIELDS)}')
+        negated, field, operator, value = match.groups()
+
+        if field == 'corrupt':
+            if operator is not None:
+                raise ValueError('corrupt is used alone: "corrupt" or "!corrupt"')
+            conditions.append(('corrupt', '=', not negated))
+            continue
+        if operator is None or negated:
+            raise ValueError(f'condition "{part.strip()}" needs an operator (=, !=, <, <=, >, >=)')
+
+        if field == 'format':
+            conditions.append(('format', operator, value.strip()))
+        elif field == 'date':
+            try:
+                conditions.append(('capture_time', operator, float(calendar.timegm(
+                    time.strptime(value.strip(), '%Y-%m-%d' if len(value.strip()) <= 10 else '%Y-%m-%d %H:%M')))))
+            except ValueError:
+                raise ValueError(f'invalid date "{value.strip()}", use YYYY-MM-DD or YYYY-MM-DD HH:MM')
+        else:
+            number = value.strip()
+            multiplier = _SUFFIXES.get(number[-1:], 1)
+            try:
+                number = float(number[:-1] if multiplier != 1 else number) * multiplier
+            except ValueError:
+                raise ValueError(f'invalid number "{value.strip()}"')
+            conditions.append(('file_size' if field == 'size' else field, operator, number))
+    return conditions
+
+
+def _format_size(size):
+    return f'{size / 1e6:.1f} MB' if size >= 1e6 else f'{size / 1e3:.0f} kB'
+
+
+def format_metadata(record):
+    """
+    :return: short description of the image, e.g. '6000 x 4000 jpeg, 5.2 MB, 2021-06-01 12:30'
+    """
+    width, height, image_format, file_size, capture_time, corrupt = record
+    if corrupt:
+        return f"can't be read, {_format_size(file_size)}"
+    text = f'{width} x {height} {image_format}, {_format_size(file_size)}'
+    if capture_time is not None:
+        text += ', ' + time.strftime('%Y-%m-%d %H:%M', time.gmtime(capture_time))
+    return text
+
+
+def metadata_fields(record):
+    """
+    :return: values of METADATA_COLUMNS as strings for the csv (empty if metadata isn't known)
+    """
+    if record is None:
+        return [''] * len(METADATA_COLUMNS)
+    width, height, image_format, file_size, capture_time, corrupt = record
+    capture = '' if capture_time is None else time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(capture_time))
+    return [str(width), str(height), image_format, str(file_size), capture, str(int(corrupt))]
+
+
+class MetadataCache:
+    """
+    Metadata of images saved in the output folder as columns. Entry is valid while size and mtime of the image
+    don't change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # {key: (size, mtime_ns, record)}
+        self.changed = False
+
+    def load(self):
+        try:
+            with np.load(self.path) as data:
+                formats = data['formats'].tolist()
+                capture_times = [None if np.isnan(value) else value for value in data['capture_times'].tolist()]
+                records = zip(data['widths'].tolist(), data['heights'].tolist(),
+                              [formats[i] for i in data['format_codes'].tolist()], data['sizes'].tolist(),
+                              capture_times, data['corrupt'].tolist())
+                self.entries = {key: (size, mtime, record) for key, size, mtime, record in zip(
+                    data['keys'].tolist(), data['sizes'].tolist(), data['mtimes'].tolist(), records)}
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError, IndexError) as e:
+            print(f"Can't read image metadata: {e}")
+
+    def save(self):
+        if not self.changed:
+            return
+
+        keys = list(self.entries)
+        values = list(self.entries.values())
+        records = [v[2] for v in values]
+        formats = sorted({record[2] for record in records})
+        format_to_int = {image_format: i for i, image_format in enumerate(formats)}
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=np.array(keys, dtype=str), sizes=np.array([v[0] for v in values], dtype=np.int64),
+                     mtimes=np.array([v[1] for v in values], dtype=np.int64),
+                     widths=np.array([r[0] for r in records], dtype=np.int32),
+                     heights=np.array([r[1] for r in records], dtype=np.int32),
+                     formats=np.array(formats, dtype=str),
+                     format_codes=np.array([format_to_int[r[2]] for r in records], dtype=np.int16),
+                     capture_times=np.array([np.nan if r[4] is None else r[4] for r in records], dtype=np.float64),
+                     corrupt=np.array([r[5] for r in records], dtype=bool))
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def get(self, key, stat):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def put(self, key, stat, record):
+        self.entries[key] = (stat.st_size, stat.st_mtime_ns, record)
+        self.changed = True
+
+
+class MetadataThread(QThread):
+    """
+    Reads metadata of images in background. Images are added with enqueue() as the scanner finds them,
+    metadata is emitted in batches as list of (key, record), idle is emitted when all queued images are read.
+    """
+
+    read = pyqtSignal(list)
+    idle = pyqtSignal()
+
+    def __init__(self, cache, batch_size=256, workers=8, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.workers = workers
+        self._queue = queue.Queue()
+
+    def enqueue(self, items):
+        """
+        :param items: list of (key, path) of images
+        """
+        self._queue.put(list(items))
+
+    def stop(self):
+        self.requestInterruption()
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.isInterruptionRequested():
+                items = self._queue.get()
+                if items is None:
+                    break
+
+                for start in range(0, len(items), self.batch_size):
+                    if self.isInterruptionRequested():
+                        break
+                    self.read.emit(self.read_batch(items[start:start + self.batch_size], executor))
+                if self._queue.empty():
+                    self.idle.emit()
+
+    def read_batch(self, items, executor):
+        """
+        :return: list of (key, record) of images, cached metadata is used when possible
+        """
+        results = []
+        missing = []
+        for key, path in items:
+            try:
+                stat = stat_image(path)
+            except OSError:
+                continue
+            record = self.cache.get(key, stat)
+            if record is None:
+                missing.append((key, path, stat))
+            else:
+                results.append((key, record))
+
+        if missing:
+            with profiler.span('metadata.read'):
+                records = list(executor.map(lambda item: read_metadata(item[1], item[2]), missing))
+            for (key, path, stat), record in zip(missing, records):
+                self.cache.put(key, stat, record)
+                results.append((key, record))
+        return results
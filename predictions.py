@@ -0,0 +1,431 @@
+"""
+Model-assisted pre-labeling: a model suggests labels of images before the annotator gets to them.
+
+A predictor is a callable which takes a batch of images (uint8 array n x height x width x 3, RGB) and returns
+probabilities of its labels (float array n x number of labels). It has attributes labels (names of its outputs)
+and input_size ((width, height) of images it expects). ONNX models are run by ONNX Runtime on CPU
+(pip install onnxruntime), any other predictor is given as 'module:function' which returns the predictor.
+
+Images are decoded by threads of the app (so archive members and remote images work too), the predictor runs
+in a pool of worker processes. Predictions are cached in output/predictions.npz, so no image is predicted twice.
+"""
+import importlib
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtCore import QSize, QThread, Qt, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from archives import stat_image
+from instrumentation import profiler
+from prefetch import image_reader
+
+PREDICTIONS_FILENAME = 'predictions.npz'
+
+
+def load_rgb(path, width, height):
+    """
+    Decodes the image directly at the input size of the model
+    :return: uint8 array (height x width x 3) or None if the image can't be decoded
+    """
+    reader = image_reader(path)
+    reader.setAutoTransform(True)
+    reader.setScaledSize(QSize(width, height))
+    image = reader.read()
+    if image.isNull():
+        return None
+    if image.size() != QSize(width, height):
+        # some formats ignore scaled size
+        image = image.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+    image = image.convertToFormat(QImage.Format_RGB888)
+    buffer = image.constBits()
+    buffer.setsize(image.bytesPerLine() * height)
+    # rows of QImage are aligned to 4 bytes
+    rows = np.frombuffer(buffer, dtype=np.uint8).reshape(height, image.bytesPerLine())
+    return rows[:, :width * 3].reshape(height, width, 3).copy()
+
+
+class OnnxPredictor:
+    """
+    Image classifier in an ONNX model, run by ONNX Runtime on CPU. Labels are read from a text file next to
+    the model (model.onnx -> model.txt, one label on each line). Images are passed as float32 scaled to 0..1
+    (NCHW or NHWC, as the model input says), outputs which aren't probabilities are converted by softmax.
+    """
+
+    def __init__(self, model_path, threads=1):
+        """
+        :param threads: number of threads of one inference (several worker processes run at once)
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError('onnxruntime is required for ONNX models (pip install onnxruntime)')
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_type = model_input.type
+        shape = model_input.shape
+        # dimensions can be symbolic (e.g. 'batch'), the usual 224 x 224 is used then
+        self.channels_first = shape[1] == 3
+        height, width = (shape[2], shape[3]) if self.channels_first else (shape[1], shape[2])
+        self.input_size = (width if isinstance(width, int) else 224, height if isinstance(height, int) else 224)
+
+        labels_path = os.path.splitext(model_path)[0] + '.txt'
+        with open(labels_path, encoding='utf-8') as f:
+            self.labels = [line.strip() for line in f if line.strip()]
+
+    def __call__(self, images):
+        if self.input_type == 'tensor(uint8)':
+            batch = images
+        else:
+            batch = images.astype(np.float32) / 255
+        if self.channels_first:
+            batch = batch.transpose(0, 3, 1, 2)
+
+        outputs = np.asarray(self.session.run(None, {self.input_name: np.ascontiguousarray(batch)})[0],
+                             dtype=np.float32).reshape(len(images), -1)
+        if outputs.min() < 0 or outputs.max() > 1:
+            outputs = np.exp(outputs - outputs.max(axis=1, keepdims=True))
+            outputs /= outputs.sum(axis=1, keepdims=True)
+        return outputs
+
+
+def load_predictor(spec):
+    """
+    :param spec: path to an .onnx model or 'module:function' which returns the predictor
+    :return: predictor
+    """
+    if spec.lower().endswith('.onnx'):
+        return OnnxPredictor(spec)
+
+    module_name, _, function_name = spec.partition(':')
+    if not function_name:
+        raise ValueError(f'predictor has to be an .onnx file or module:function, got {spec}')
+    return getattr(importlib.import_module(module_name), function_name)()
+
+
+def model_id(spec):
+    """
+    :return: identification of the model, cached predictions of another model (or changed model file) are invalid
+    """
+    if not spec.lower().endswith('.onnx'):
+        return spec
+    try:
+        stat = os.stat(spec)
+        return f'{spec}|{stat.st_size}|{stat.st_mtime_ns}'
+    except OSError:
+        return spec
+
+
+# predictor of the worker process, loaded by the first task
+_worker_predictor = None
+
+
+def _worker_load(spec):
+    global _worker_predictor
+    if _worker_predictor is None:
+        _worker_predictor = load_predictor(spec)
+    return _worker_predictor
+
+
+def _worker_describe(spec):
+    predictor = _worker_load(spec)
+    return list(predictor.labels), tuple(getattr(predictor, 'input_size', (224, 224)))
+
+
+def _worker_predict(spec, images):
+    return np.asarray(_worker_load(spec)(images), dtype=np.float32)
+
+
+class PredictionCache:
+    """
+    Predicted probabilities (in columns of the model labels) saved in the output folder. Entry is valid while
+    size and mtime of the image don't change and the model is the same.
+    """
+
+    def __init__(self, path, model):
+        """
+        :param model: identification of the model (see model_id())
+        """
+        self.path = path
+        self.model = model
+        self.labels = []
+        self.entries = {}  # {key: (size, mtime_ns, probabilities)}
+        self.changed = False
+
+    def load(self):
+        try:
+            with np.load(self.path) as data:
+                if str(data['model']) != self.model:
+                    return
+                self.labels = data['labels'].tolist()
+                self.entries = dict(zip(data['keys'].tolist(), zip(data['sizes'].tolist(), data['mtimes'].tolist(),
+                                                                    data['probabilities'])))
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Can't read predictions: {e}")
+
+    def set_labels(self, labels):
+        """
+        Sets labels of the model, predictions of other labels are dropped
+        """
+        if labels != self.labels:
+            self.labels = list(labels)
+            self.entries = {}
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+
+        keys = list(self.entries)
+        values = list(self.entries.values())
+        probabilities = (np.stack([v[2] for v in values]) if values
+                         else np.zeros((0, len(self.labels)), dtype=np.float32))
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, model=np.array(self.model), labels=np.array(self.labels, dtype=str),
+                     keys=np.array(keys, dtype=str), sizes=np.array([v[0] for v in values], dtype=np.int64),
+                     mtimes=np.array([v[1] for v in values], dtype=np.int64),
+                     probabilities=probabilities.astype(np.float32))
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def get(self, key, stat):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def put(self, key, stat, probabilities):
+        self.entries[key] = (stat.st_size, stat.st_mtime_ns, probabilities)
+        self.changed = True
+
+
+class PredictionThread(QThread):
+    """
+    Predicts labels of images in background. Images are added with enqueue() as the scanner finds them,
+    predictions are emitted in batches as list of (key, probabilities of labels of the session).
+    Several batches are in the worker processes at once, so the model doesn't wait for decoding.
+    """
+
+    predicted = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, spec, labels, cache, batch_size=32, workers=None, decode_threads=4, parent=None):
+        """
+        :param spec: predictor (see load_predictor())
+        :param labels: labels of the session, labels the model doesn't know get probability 0
+        :param workers: number of worker processes
+        """
+        super().__init__(parent)
+        self.spec = spec
+        self.labels = list(labels)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.decode_threads = decode_threads
+        self._queue = queue.Queue()
+        self._unfinished = []  # lists of (key, path) which weren't predicted when the thread stopped
+        self._columns = None
+        self._input_size = None
+
+    def enqueue(self, items):
+        """
+        :param items: list of (key, path) of images
+        """
+        self._queue.put(list(items))
+
+    def stop(self):
+        """
+        Stops the thread, images which weren't predicted stay queued and are predicted when it's started again
+        """
+        self.requestInterruption()
+        self._queue.put(None)
+        self.wait()
+
+        unfinished, self._unfinished = self._unfinished, []
+        while True:
+            try:
+                items = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if items is not None:
+                unfinished.append(items)
+        for items in unfinished:
+            self._queue.put(items)
+
+    def run(self):
+        # worker processes are started from scratch, forking a process with running Qt threads isn't safe
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            try:
+                model_labels, self._input_size = pool.submit(_worker_describe, self.spec).result()
+            except Exception as e:
+                # errors of the model code are reported, the app works without predictions
+                self.failed.emit(f"Can't load model {self.spec}: {e}")
+                return
+
+            self.cache.set_labels(model_labels)
+            # column of the model output for each label of the session (-1 = the model doesn't know the label)
+            label_to_column = {label: i for i, label in enumerate(model_labels)}
+            self._columns = np.array([label_to_column.get(label, -1) for label in self.labels], dtype=np.int64)
+
+            with ThreadPoolExecutor(max_workers=self.decode_threads) as decoders:
+                in_flight = []  # (items, submitted batch)
+                while not self.isInterruptionRequested():
+                    try:
+                        items = self._queue.get(timeout=0.05 if in_flight else None)
+                    except queue.Empty:
+                        # no new images, results of the oldest batch are delivered
+                        self.finish_batch(*in_flight.pop(0)[1])
+                        continue
+                    if items is None:
+                        break
+
+                    for start in range(0, len(items), self.batch_size):
+                        if self.isInterruptionRequested():
+                            self._unfinished.append(items[start:])
+                            break
+                        batch = items[start:start + self.batch_size]
+                        in_flight.append((batch, self.submit_batch(batch, pool, decoders)))
+                        # each worker has one batch to predict and one waiting
+                        while len(in_flight) > 2 * self.workers:
+                            self.finish_batch(*in_flight.pop(0)[1])
+
+                # results of batches in the worker processes are thrown away, the images are submitted again
+                self._unfinished[:0] = [batch for batch, _ in in_flight]
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def submit_batch(self, items, pool, decoders):
+        """
+        Decodes images which aren't cached and sends them to a worker process
+        :return: (cached results, list of (key, stat) of predicted images, future of their probabilities)
+        """
+        results = []
+        missing = []
+        for key, path in items:
+            try:
+                stat = stat_image(path)
+            except OSError:
+                continue
+            probabilities = self.cache.get(key, stat)
+            if probabilities is None:
+                missing.append((key, path, stat))
+            else:
+                results.append((key, probabilities))
+
+        width, height = self._input_size
+        with profiler.span('predict.decode'):
+            images = list(decoders.map(lambda item: load_rgb(item[1], width, height), missing))
+        decoded = [(key, stat) for (key, _, stat), image in zip(missing, images) if image is not None]
+        future = None
+        if decoded:
+            future = pool.submit(_worker_predict, self.spec, np.stack([image for image in images if image is not None]))
+        return results, decoded, future
+
+    def finish_batch(self, results, decoded, future):
+        if future is not None:
+            try:
+                probabilities = future.result()
+            except Exception as e:
+                print(f"Prediction failed: {e}")
+                probabilities = None
+            if probabilities is not None:
+                for (key, stat), row in zip(decoded, probabilities):
+                    self.cache.put(key, stat, row)
+                    results.append((key, row))
+
+        if results:
+            self.predicted.emit([(key, self.to_session_labels(row)) for key, row in results])
+
+    def to_session_labels(self, row):
+        """
+        :param row: probabilities of the model labels
+        :return: probabilities of the labels of the session
+        """
+        return np.where(self._columns >= 0, row[np.maximum(self._columns, 0)], 0).astype(np.float32)
+
+
+class PredictionIndex:
+    """
+    Predicted probabilities of images by ordinal. Suggested labels are the labels with probability above
+    the threshold, or the most probable label when no label reaches it.
+    """
+
+    def __init__(self, num_labels, threshold=0.5, capacity=1024):
+        self.num_labels = num_labels
+        self.threshold = threshold
+        self.probabilities = np.zeros((capacity, num_labels), dtype=np.float32)
+        self.known = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def set(self, ordinal, probabilities):
+        if ordinal >= len(self.known):
+            capacity = max(ordinal + 1, 2 * len(self.known))
+            self.probabilities = np.concatenate([self.probabilities, np.zeros(
+                (capacity - len(self.known), self.num_labels), dtype=np.float32)])
+            self.known = np.concatenate([self.known, np.zeros(capacity - len(self.known), dtype=bool)])
+        self.probabilities[ordinal] = probabilities
+        self.known[ordinal] = True
+
+    def suggested(self, ordinal):
+        """
+        :return: {label ordinal: probability} of suggested labels of the image (empty if it isn't predicted)
+        """
+        if ordinal >= len(self.known) or not self.known[ordinal] or self.num_labels == 0:
+            return {}
+        row = self.probabilities[ordinal]
+        labels = np.flatnonzero(row >= self.threshold)
+        if not len(labels):
+            labels = [int(row.argmax())]
+        return {int(i): float(row[i]) for i in labels}
+
+    def uncertainty(self, ordinals):
+        """
+        Margin uncertainty: 1 - (difference of the two highest probabilities), 1 = the model can't decide
+        :return: float array, NaN for images which aren't predicted
+        """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        inside = ordinals < len(self.known)
+        known = np.zeros(len(ordinals), dtype=bool)
+        known[inside] = self.known[ordinals[inside]]
+        result = np.full(len(ordinals), np.nan, dtype=np.float32)
+
+        rows = self.probabilities[ordinals[known]]
+        if self.num_labels == 1:
+            # probability of the only label against its absence
+            rows = np.concatenate([rows, 1 - rows], axis=1)
+        if len(rows) and rows.shape[1] >= 2:
+            top = np.sort(rows, axis=1)[:, -2:]
+            result[known] = 1 - (top[:, 1] - top[:, 0])
+        return result
+
+    def uncertain_first(self, ordinals, labeled):
+        """
+        :param ordinals: ordinals of images in the current order
+        :param labeled: bool array over ordinals, labeled images go to the end
+        :return: ordinals reordered: unlabeled predicted images from the most uncertain, then unlabeled images which
+            aren't predicted yet and labeled images (both in the current order)
+        """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        uncertainty = self.uncertainty(ordinals)
+        predicted = ~np.isnan(uncertainty)
+        done = labeled[ordinals]
+        # lexsort sorts by the last key first and is stable
+        order = np.lexsort((-np.nan_to_num(uncertainty), ~predicted, done))
+        return ordinals[order]
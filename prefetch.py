@@ -0,0 +1,307 @@
+from collections import OrderedDict
+
+from PyQt5.QtCore import QBuffer, QByteArray, QIODevice, QObject, QRunnable, QSize, QThreadPool, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QImageIOHandler, QImageReader
+
+from archives import split_member_path
+from instrumentation import profiler
+from sources import get_source
+
+
+def reader_from_bytes(data):
+    """
+    :return: QImageReader of the image in memory
+    """
+    buffer = QBuffer()
+    buffer.setData(QByteArray(data))
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    # the reader doesn't own the buffer
+    reader.buffer = buffer
+    return reader
+
+
+def image_reader(path):
+    """
+    :return: QImageReader of the file, archive members and remote images are decoded from memory
+    """
+    member = split_member_path(path)
+    if member is not None:
+        return reader_from_bytes(member[0].read(member[1]))
+
+    source = get_source(path)
+    if not source.remote:
+        return QImageReader(path)
+    try:
+        data = source.read_bytes(path)
+    except OSError as e:
+        print(f"Can't read {path}: {e}")
+        data = b''
+    return reader_from_bytes(data)
+
+
+def fit_to_panel(size, panel_width, panel_height, margin=20):
+    """
+    Computes size of the image scaled so it fits into the image panel (keeps aspect ratio).
+    :param size: QSize of the image
+    :return: QSize of the scaled image
+    """
+    if size.width() >= size.height():
+        width = panel_width - margin
+        return QSize(width, max(1, int(size.height() * width / size.width() + 0.5)))
+    height = panel_height - margin
+    return QSize(max(1, int(size.width() * height / size.height() + 0.5)), height)
+
+
+def decode_image(path, panel_width, panel_height, margin=20):
+    """
+    Decodes the image directly at the size of the image panel. Only the header is read to get the image size,
+    so the reader can downscale while decoding (e.g. DCT-domain scaling for JPEGs) and the full resolution
+    bitmap is never allocated. EXIF orientation is applied by the reader.
+    Safe to call from worker threads (QImage is used instead of QPixmap).
+    :param path: path to the image
+    :param panel_width: width of the image panel
+    :param panel_height: height of the image panel
+    :param margin: space left around the image in the panel
+    :return: scaled QImage (null QImage if the file can't be decoded)
+    """
+    reader = image_reader(path)
+    reader.setAutoTransform(True)
+
+    with profiler.span('decode.header'):
+        size = reader.size()
+    if not size.isValid():
+        # the format doesn't provide size without decoding, scale after the full decode
+        with profiler.span('decode.read'):
+            image = reader.read()
+        if image.isNull():
+            return image
+        with profiler.span('decode.scale'):
+            return image.scaled(fit_to_panel(image.size(), panel_width, panel_height, margin),
+                                Qt.IgnoreAspectRatio, Qt.FastTransformation)
+
+    # the size in the header is before rotation, but the image is shown rotated
+    rotated = bool(reader.transformation() & QImageIOHandler.TransformationRotate90)
+    if rotated:
+        size.transpose()
+
+    scaled_size = fit_to_panel(size, panel_width, panel_height, margin)
+    if rotated:
+        scaled_size.transpose()
+
+    # file read, decode and scale happen in one pass
+    reader.setScaledSize(scaled_size)
+    with profiler.span('decode.read'):
+        return reader.read()
+
+
+class ImageCache:
+    """
+    Size-bounded cache of decoded images.
+    Supported eviction policies: 'lru' (least recently used) and 'fifo' (oldest inserted).
+    """
+
+    policies = ('lru', 'fifo')
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, policy='lru'):
+        if policy not in self.policies:
+            raise ValueError(f'Unknown eviction policy: {policy}')
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: cached image or None. Hit/miss counters are updated.
+        """
+        image = self._entries.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if self.policy == 'lru':
+            self._entries.move_to_end(key)
+        return image
+
+    def peek(self, key):
+        """
+        :param key: cache key
+        :return: cached image or None. Counters aren't updated, the lookup was already counted by get().
+        """
+        image = self._entries.get(key)
+        if image is not None and self.policy == 'lru':
+            self._entries.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        """
+        Stores the image and evicts old entries until the cache fits into max_bytes.
+        The newest entry is always kept, even if it is bigger than the limit.
+        """
+        if key in self._entries:
+            self.size_bytes -= self._entries.pop(key).sizeInBytes()
+
+        self._entries[key] = image
+        self.size_bytes += image.sizeInBytes()
+
+        while self.size_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= evicted.sizeInBytes()
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class _DecodeSignals(QObject):
+    # path, panel width, panel height, decoded image
+    decoded = pyqtSignal(str, int, int, QImage)
+
+
+class _DecodeTask(QRunnable):
+    def __init__(self, path, panel_width, panel_height, signals, token):
+        super().__init__()
+        self.path = path
+        self.panel_width = panel_width
+        self.panel_height = panel_height
+        self.signals = signals
+        self.token = token
+
+    def run(self):
+        if self.token['cancelled']:
+            return
+        self.token['started'] = True
+        image = decode_image(self.path, self.panel_width, self.panel_height)
+        self.signals.decoded.emit(self.path, self.panel_width, self.panel_height, image)
+
+
+class PrefetchEngine(QObject):
+    """
+    Decodes images around the current position on a QThreadPool and stores them in ImageCache,
+    so navigation only has to swap in an already decoded and scaled image.
+    """
+
+    # path of decoded image (emitted also when the image can't be decoded)
+    ready = pyqtSignal(str)
+
+    # priority of the image requested for display, it goes before all prefetched images
+    requested_priority = 1000
+
+    def __init__(self, cache, panel_width, panel_height, ahead=3, behind=1, max_threads=2, parent=None):
+        super().__init__(parent)
+
+        self.cache = cache
+        self.panel_width = panel_width
+        self.panel_height = panel_height
+        self.ahead = ahead
+        self.behind = behind
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+
+        # {cache key: token} of images which are queued or being decoded
+        self._pending = {}
+        self._requested = None  # cache key of the image waiting for display
+        self._signals = _DecodeSignals(self)
+        self._signals.decoded.connect(self._on_decoded)
+
+    def key(self, path):
+        return path, self.panel_width, self.panel_height
+
+    def load(self, path):
+        """
+        Returns decoded image from the cache. On cache miss the image is decoded synchronously.
+        Hits and misses are counted by request(), which comes before load() on navigation.
+        :param path: path to the image
+        :return: QImage scaled to the panel size
+        """
+        key = self.key(path)
+        image = self.cache.peek(key)
+        if image is None:
+            image = decode_image(path, self.panel_width, self.panel_height)
+            if not image.isNull():
+                self.cache.put(key, image)
+        return image
+
+    def request(self, path):
+        """
+        Returns decoded image from the cache. On cache miss the decoding is scheduled before all prefetched images
+        and ready is emitted when it is done, so the caller never waits for the decoder.
+        :param path: path to the image
+        :return: QImage or None if the image isn't decoded yet
+        """
+        key = self.key(path)
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+
+        self._requested = key
+        self._schedule(path, priority=self.requested_priority)
+        return None
+
+    def prefetch(self, paths_ahead, paths_behind):
+        """
+        Schedules decoding of images around the current one. Queued tasks which didn't start yet are dropped,
+        so fast navigation doesn't build up a backlog of images nobody will look at.
+        :param paths_ahead: paths of the following images, nearest first
+        :param paths_behind: paths of the previous images, nearest first
+        """
+        self.pool.clear()
+        self._pending = {key: token for key, token in self._pending.items() if token['started']}
+        # requested image must not be dropped
+        if self._requested is not None:
+            self._schedule(self._requested[0], priority=self.requested_priority)
+
+        # nearest images get the highest priority, following images are preferred over previous ones
+        for distance, path in enumerate(paths_ahead[:self.ahead]):
+            self._schedule(path, priority=2 * (self.ahead - distance))
+        for distance, path in enumerate(paths_behind[:self.behind]):
+            self._schedule(path, priority=2 * (self.behind - distance) - 1)
+
+    def _schedule(self, path, priority):
+        key = self.key(path)
+        if key in self.cache:
+            return
+        token = self._pending.get(key)
+        if token is not None:
+            if token['started'] or token['priority'] >= priority:
+                return
+            # queued at lower priority (e.g. prefetched neighbour which is displayed now), the queued task
+            # is skipped and the image is queued again before the others
+            token['cancelled'] = True
+
+        token = {'started': False, 'cancelled': False, 'priority': priority}
+        self._pending[key] = token
+        self.pool.start(_DecodeTask(path, self.panel_width, self.panel_height, self._signals, token), priority)
+
+    def _on_decoded(self, path, panel_width, panel_height, image):
+        key = (path, panel_width, panel_height)
+        self._pending.pop(key, None)
+        if not image.isNull():
+            self.cache.put(key, image)
+        if key == self._requested:
+            self._requested = None
+        self.ready.emit(path)
+
+    def shutdown(self):
+        """
+        Drops queued tasks and waits for running ones to finish
+        """
+        self.pool.clear()
+        self.pool.waitForDone()
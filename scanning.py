@@ -0,0 +1,40 @@
+import os
+
+IMG_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+
+
+def scan_img_paths(dir, extensions=IMG_EXTENSIONS, recursive=False, exclude_dirs=()):
+    '''
+    Generator of image paths in the folder. Results are yielded while the folder is being scanned.
+    Entries of each folder are sorted by name and files of a folder come before its sub-folders,
+    so the order is deterministic.
+    :param dir: folder with files
+    :param extensions: tuple with file endings. e.g. ('.jpg', '.png'). Files with these endings will be yielded
+    :param recursive: scan sub-folders as well
+    :param exclude_dirs: names of sub-folders of dir which are skipped (e.g. label folders and output folder)
+    :return: generator of image paths
+    '''
+    exclude_dirs = set(exclude_dirs)
+    stack = [dir]
+
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Can't scan folder {folder}: {e}")
+            continue
+
+        sub_folders = []
+        for entry in entries:
+            # d_type from scandir is used, so no extra stat call is needed for most filesystems
+            if entry.is_file() and entry.name.lower().endswith(extensions):
+                yield entry.path
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                if folder == dir and entry.name in exclude_dirs:
+                    continue
+                sub_folders.append(entry.path)
+
+        # reversed, because the stack is processed from the end
+        stack.extend(reversed(sub_folders))
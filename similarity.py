@@ -0,0 +1,370 @@
+"""
+Similarity ordering of the queue: similar images are shown one after another, so the annotator doesn't switch
+context with every image.
+
+Each image is decoded at 32 x 32 pixels and described by a color histogram, a tiny grayscale image and
+histograms of gradient orientations (HOG-like), all computed for a whole batch at once with NumPy.
+Descriptors are cached in output/image_descriptors.npz and computed only for images which are new or changed.
+Images are clustered by mini-batch k-means, clusters are visited in a chain from each cluster to the nearest
+unvisited one and images of a cluster are ordered from the most typical one.
+"""
+import math
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from archives import stat_image
+from instrumentation import profiler
+from predictions import load_rgb
+
+DESCRIPTORS_FILENAME = 'image_descriptors.npz'
+DESCRIPTOR_INPUT_SIZE = 32
+HISTOGRAM_BINS = 4  # per channel, 4 x 4 x 4 colors
+TINY_SIZE = 8
+CELL_SIZE = 8
+ORIENTATIONS = 8
+DESCRIPTOR_SIZE = (HISTOGRAM_BINS ** 3 + TINY_SIZE ** 2
+                   + (DESCRIPTOR_INPUT_SIZE // CELL_SIZE) ** 2 * ORIENTATIONS)
+_ORDER_REQUEST = 'order'  # item of the thread queue, requested order is computed when it's taken
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-6)
+
+
+def color_histograms(images):
+    """
+    :param images: uint8 array (n x height x width x 3)
+    :return: float32 array (n x 64) with joint RGB histograms
+    """
+    n = len(images)
+    quantized = (images // (256 // HISTOGRAM_BINS)).astype(np.int64)
+    colors = (quantized[..., 0] * HISTOGRAM_BINS + quantized[..., 1]) * HISTOGRAM_BINS + quantized[..., 2]
+    # one bincount for the whole batch, each image has its own range of bins
+    colors = colors.reshape(n, -1) + np.arange(n)[:, None] * HISTOGRAM_BINS ** 3
+    histograms = np.bincount(colors.ravel(), minlength=n * HISTOGRAM_BINS ** 3).reshape(n, -1)
+    return _normalize(histograms.astype(np.float32))
+
+
+def tiny_images(gray):
+    """
+    :param gray: float32 array (n x 32 x 32)
+    :return: float32 array (n x 64) with 8 x 8 images, zero mean, so only the layout of brightness counts
+    """
+    n, height, width = gray.shape
+    block = height // TINY_SIZE
+    tiny = gray.reshape(n, TINY_SIZE, block, TINY_SIZE, block).mean(axis=(2, 4)).reshape(n, -1)
+    return _normalize(tiny - tiny.mean(axis=1, keepdims=True))
+
+
+def gradient_histograms(gray):
+    """
+    :param gray: float32 array (n x 32 x 32)
+    :return: float32 array (n x 128) with histograms of unsigned gradient orientations (weighted by magnitude)
+        in cells of 8 x 8 pixels
+    """
+    n, height, width = gray.shape
+    gx = np.zeros_like(gray)
+    gy = np.zeros_like(gray)
+    gx[:, :, 1:-1] = gray[:, :, 2:] - gray[:, :, :-2]
+    gy[:, 1:-1, :] = gray[:, 2:, :] - gray[:, :-2, :]
+    magnitude = np.hypot(gx, gy)
+    orientation = (np.arctan2(gy, gx) % np.pi) / np.pi * ORIENTATIONS
+    bins = np.minimum(orientation.astype(np.int64), ORIENTATIONS - 1)
+
+    cells = height // CELL_SIZE
+    histograms = np.empty((n, cells, cells, ORIENTATIONS), dtype=np.float32)
+    for k in range(ORIENTATIONS):
+        weights = np.where(bins == k, magnitude, 0)
+        histograms[..., k] = weights.reshape(n, cells, CELL_SIZE, cells, CELL_SIZE).sum(axis=(2, 4))
+    return _normalize(histograms.reshape(n, -1))
+
+
+def compute_descriptors(images):
+    """
+    :param images: uint8 array (n x 32 x 32 x 3)
+    :return: float32 array (n x DESCRIPTOR_SIZE), each part has the same weight and descriptors have unit length
+    """
+    gray = images.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    parts = [color_histograms(images), tiny_images(gray), gradient_histograms(gray)]
+    return (np.concatenate(parts, axis=1) / math.sqrt(len(parts))).astype(np.float32)
+
+
+def nearest_centroids(data, centroids, chunk_size=65536):
+    """
+    :return: (index of the nearest centroid, squared distance to it) of each row of data
+    """
+    nearest = np.empty(len(data), dtype=np.int64)
+    distances = np.empty(len(data), dtype=np.float32)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        # |a - b|^2 = |a|^2 - 2ab + |b|^2, computed as one matrix product
+        squared = (chunk ** 2).sum(axis=1)[:, None] - 2 * chunk @ centroids.T + centroid_norms
+        nearest[start:start + chunk_size] = squared.argmin(axis=1)
+        distances[start:start + chunk_size] = squared[np.arange(len(chunk)), nearest[start:start + chunk_size]]
+    return nearest, np.maximum(distances, 0)
+
+
+def kmeans_plus_plus(data, k, rng, sample_size=8192):
+    """
+    k-means++ seeding on a sample of rows: each next centroid is a row picked with probability proportional
+    to its squared distance from the nearest centroid picked so far
+    :return: initial centroids (k x d)
+    """
+    sample = data[rng.choice(len(data), min(sample_size, len(data)), replace=False)]
+    centroids = [sample[rng.integers(len(sample))]]
+    distances = ((sample - centroids[0]) ** 2).sum(axis=1)
+    for _ in range(k - 1):
+        total = distances.sum()
+        if total <= 0:
+            # fewer distinct rows than clusters
+            centroids.append(sample[rng.integers(len(sample))])
+            continue
+        centroids.append(sample[rng.choice(len(sample), p=distances / total)])
+        distances = np.minimum(distances, ((sample - centroids[-1]) ** 2).sum(axis=1))
+    return np.array(centroids, dtype=np.float32)
+
+
+def minibatch_kmeans(data, k, centroids=None, batch_size=1024, iterations=50, seed=0):
+    """
+    Mini-batch k-means (Sculley 2010): centroids move towards random batches with a learning rate which
+    decreases with the number of rows assigned to them
+    :param data: float32 array (n x d)
+    :param centroids: initial centroids (e.g. from the previous clustering), k-means++ seeding is used if None
+    :return: centroids (k x d)
+    """
+    rng = np.random.default_rng(seed)
+    n = len(data)
+    k = min(k, n)
+    if centroids is None or len(centroids) != k:
+        centroids = kmeans_plus_plus(data, k, rng)
+    else:
+        centroids = centroids.copy()
+
+    counts = np.zeros(k, dtype=np.float64)
+    for _ in range(iterations):
+        batch = data[rng.choice(n, min(batch_size, n), replace=False)]
+        nearest, _ = nearest_centroids(batch, centroids)
+        batch_counts = np.bincount(nearest, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, batch)
+
+        updated = batch_counts > 0
+        counts[updated] += batch_counts[updated]
+        rate = (batch_counts[updated] / counts[updated])[:, None]
+        centroids[updated] += rate * (sums[updated] / batch_counts[updated][:, None] - centroids[updated])
+    return centroids
+
+
+class DescriptorIndex:
+    """
+    Descriptors of images by ordinal and the clustering which orders them
+    """
+
+    def __init__(self, capacity=1024, max_clusters=256):
+        self.descriptors = np.zeros((capacity, DESCRIPTOR_SIZE), dtype=np.float32)
+        self.known = np.zeros(capacity, dtype=bool)
+        self.max_clusters = max_clusters
+        self.centroids = None  # of the last clustering, the next clustering starts from them
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def set(self, ordinal, descriptor):
+        if ordinal >= len(self.known):
+            capacity = max(ordinal + 1, 2 * len(self.known))
+            self.descriptors = np.concatenate([self.descriptors, np.zeros(
+                (capacity - len(self.known), DESCRIPTOR_SIZE), dtype=np.float32)])
+            self.known = np.concatenate([self.known, np.zeros(capacity - len(self.known), dtype=bool)])
+        self.descriptors[ordinal] = descriptor
+        self.known[ordinal] = True
+
+    def similar_together(self, ordinals):
+        """
+        :param ordinals: ordinals of images in the current order
+        :return: ordinals grouped by clusters, starting with the cluster of the first image (the current one),
+            which stays first. If the first image isn't described yet, the clusters start with the cluster of
+            the first described image and no image is pinned. Images without descriptors follow in the current order.
+        """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        inside = ordinals < len(self.known)
+        known = np.zeros(len(ordinals), dtype=bool)
+        known[inside] = self.known[ordinals[inside]]
+        described = ordinals[known]
+        if len(described) < 2:
+            return ordinals
+
+        data = self.descriptors[described]
+        k = max(1, min(self.max_clusters, round(math.sqrt(len(described) / 2))))
+        with profiler.span('similarity.cluster'):
+            self.centroids = minibatch_kmeans(data, k, self.centroids)
+            clusters, distances = nearest_centroids(data, self.centroids)
+
+        # clusters are visited in a chain, each time the nearest cluster which wasn't visited yet
+        k = len(self.centroids)
+        norms = (self.centroids ** 2).sum(axis=1)
+        centroid_distances = norms[:, None] - 2 * self.centroids @ self.centroids.T + norms[None, :]
+        chain = [int(clusters[0])]
+        visited = np.zeros(k, dtype=bool)
+        visited[chain[0]] = True
+        for _ in range(k - 1):
+            chain.append(int(np.where(visited, np.inf, centroid_distances[chain[-1]]).argmin()))
+            visited[chain[-1]] = True
+
+        # images of a cluster from the closest to its centroid, the first image stays first
+        rank = np.empty(k, dtype=np.int64)
+        rank[chain] = np.arange(k)
+        if known[0]:
+            distances[0] = -1
+        order = np.lexsort((distances, rank[clusters]))
+        return np.concatenate([described[order], ordinals[~known]])
+
+
+class DescriptorCache:
+    """
+    Descriptors of images saved in the output folder. Entry is valid while size and mtime of the image
+    don't change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # {key: (size, mtime_ns, descriptor)}
+        self.changed = False
+
+    def load(self):
+        try:
+            with np.load(self.path) as data:
+                if data['descriptors'].shape[1] != DESCRIPTOR_SIZE:
+                    return
+                self.entries = dict(zip(data['keys'].tolist(), zip(data['sizes'].tolist(), data['mtimes'].tolist(),
+                                                                    data['descriptors'])))
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError, IndexError) as e:
+            print(f"Can't read image descriptors: {e}")
+
+    def save(self):
+        if not self.changed:
+            return
+
+        keys = list(self.entries)
+        values = list(self.entries.values())
+        descriptors = (np.stack([v[2] for v in values]) if values
+                       else np.zeros((0, DESCRIPTOR_SIZE), dtype=np.float32))
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=np.array(keys, dtype=str), sizes=np.array([v[0] for v in values], dtype=np.int64),
+                     mtimes=np.array([v[1] for v in values], dtype=np.int64), descriptors=descriptors)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    def get(self, key, stat):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def put(self, key, stat, descriptor):
+        self.entries[key] = (stat.st_size, stat.st_mtime_ns, descriptor)
+        self.changed = True
+
+
+class DescriptorThread(QThread):
+    """
+    Computes descriptors of images in background and clusters them, so the GUI thread isn't blocked by k-means.
+    Images are added with enqueue(), idle is emitted when all queued images are described. Order requested
+    by request_order() is emitted by ordered.
+    """
+
+    idle = pyqtSignal()
+    ordered = pyqtSignal(object)
+
+    def __init__(self, cache, batch_size=256, workers=4, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.workers = workers
+        self.index = DescriptorIndex()  # used only by the thread
+        self._queue = queue.Queue()
+        self._requested = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, items):
+        """
+        :param items: list of (ordinal, key, path) of images
+        """
+        self._queue.put(list(items))
+
+    def request_order(self, ordinals):
+        """
+        Requests similarity order of images (see DescriptorIndex.similar_together), it's computed after
+        the images queued before are described. Only the last request is served if more of them are waiting.
+        :param ordinals: ordinals of images in the current order, starting with the current image
+        """
+        with self._lock:
+            self._requested = np.array(ordinals, dtype=np.int64)
+        self._queue.put(_ORDER_REQUEST)
+
+    def stop(self):
+        self.requestInterruption()
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.isInterruptionRequested():
+                items = self._queue.get()
+                if items is None:
+                    break
+
+                if items is _ORDER_REQUEST:
+                    with self._lock:
+                        ordinals, self._requested = self._requested, None
+                    if ordinals is not None:
+                        self.ordered.emit(self.index.similar_together(ordinals))
+                    continue
+
+                for start in range(0, len(items), self.batch_size):
+                    if self.isInterruptionRequested():
+                        break
+                    for ordinal, descriptor in self.describe_batch(items[start:start + self.batch_size], executor):
+                        self.index.set(ordinal, descriptor)
+                if self._queue.empty():
+                    self.idle.emit()
+
+    def describe_batch(self, items, executor):
+        """
+        :return: list of (ordinal, descriptor) of images, cached descriptors are used when possible
+        """
+        results = []
+        missing = []
+        for ordinal, key, path in items:
+            try:
+                stat = stat_image(path)
+            except OSError:
+                continue
+            descriptor = self.cache.get(key, stat)
+            if descriptor is None:
+                missing.append((ordinal, key, path, stat))
+            else:
+                results.append((ordinal, descriptor))
+
+        if missing:
+            size = DESCRIPTOR_INPUT_SIZE
+            with profiler.span('similarity.decode'):
+                images = list(executor.map(lambda item: load_rgb(item[2], size, size), missing))
+            decoded = [(item, image) for item, image in zip(missing, images) if image is not None]
+            if decoded:
+                with profiler.span('similarity.describe'):
+                    descriptors = compute_descriptors(np.stack([image for _, image in decoded]))
+                for ((ordinal, key, path, stat), _), descriptor in zip(decoded, descriptors):
+                    self.cache.put(key, stat, descriptor)
+                    results.append((ordinal, descriptor))
+        return results
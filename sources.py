@@ -0,0 +1,445 @@
+"""
+Sources of images: local folder (default) or a folder in an HTTP / S3-compatible object store.
+
+A source lists images, returns their size and mtime, reads their bytes and copies / moves / removes them
+in label locations. Images of a remote source are addressed by URLs (http://host:9000/bucket/prefix/img1.jpg),
+so the rest of the app handles them like paths. The remote source keeps a pool of keep-alive connections,
+so decoding threads read images in parallel, and big objects are read by parallel range requests.
+"""
+import collections
+import datetime
+import hashlib
+import hmac
+import http.client
+import os
+import queue
+import shutil
+import threading
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+from scanning import IMG_EXTENSIONS, scan_img_paths
+
+REMOTE_SCHEMES = ('http://', 'https://')
+
+
+# size and mtime of an image (same attribute names as os.stat_result)
+SourceStat = collections.namedtuple('SourceStat', ['st_size', 'st_mtime_ns'])
+
+
+def _mtime_ns(modified):
+    # listing has milliseconds, but HEAD only seconds, so mtimes are compared in whole seconds
+    return int(modified.timestamp()) * 1_000_000_000
+
+
+class ImageSource:
+    """
+    Interface of image sources
+    """
+    remote = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def output_folder(self):
+        """
+        :return: local folder for csv, journal and caches of this source
+        """
+        raise NotImplementedError
+
+    def list_images(self, extensions=IMG_EXTENSIONS, recursive=False, exclude_dirs=()):
+        """
+        :return: generator of image paths, in deterministic order
+        """
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def stat(self, path):
+        """
+        :return: object with st_size and st_mtime_ns, OSError if the image doesn't exist
+        """
+        raise NotImplementedError
+
+    def read_bytes(self, path):
+        raise NotImplementedError
+
+    def read_range(self, path, start, length):
+        """
+        :return: up to length bytes of the image from start
+        """
+        raise NotImplementedError
+
+    def copy(self, src, dst_folder, method='copy'):
+        """
+        Copies the image into the label location
+        :return: path of the copy
+        """
+        raise NotImplementedError
+
+    def move(self, src, dst_folder):
+        raise NotImplementedError
+
+    def remove(self, path):
+        raise NotImplementedError
+
+
+class LocalSource(ImageSource):
+    """
+    Images in a local folder
+    """
+
+    def output_folder(self):
+        return os.path.join(self.root, 'output')
+
+    def list_images(self, extensions=IMG_EXTENSIONS, recursive=False, exclude_dirs=()):
+        return scan_img_paths(self.root, extensions, recursive, exclude_dirs)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def read_bytes(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def read_range(self, path, start, length):
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def copy(self, src, dst_folder, method='copy'):
+        # file_ops dispatches remote paths to their source, so it can't be imported at module level
+        from file_ops import copy_file
+        return copy_file(src, dst_folder, method)
+
+    def move(self, src, dst_folder):
+        os.makedirs(dst_folder, exist_ok=True)
+        return shutil.move(src, dst_folder)
+
+    def remove(self, path):
+        os.remove(path)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections to one host, shared by threads. A connection is used by one request at a time.
+    """
+
+    def __init__(self, scheme, netloc, max_connections=8, timeout=30):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        # limits number of open connections, requests over the limit wait for a free connection
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, method, path, headers=None):
+        """
+        Sends the request and reads the whole response
+        :return: (status, response headers, body)
+        """
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                connection = self._connect()
+                reused = False
+
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection in the meantime, the request is sent again
+                connection = self._connect()
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+            return response.status, response.headers, body
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+class HttpSource(ImageSource):
+    """
+    Images in a bucket of an S3-compatible object store (AWS S3, MinIO, ...), addressed path-style:
+    http(s)://host[:port]/bucket[/prefix]. Requests are signed (AWS signature version 4) if access keys are given,
+    otherwise the bucket has to allow anonymous access.
+    Labels are stored under the prefix like label folders: prefix/label/img1.jpg.
+    """
+    remote = True
+
+    def __init__(self, root, access_key=None, secret_key=None, region=None, max_connections=8, part_size=8 << 20,
+                 cache_folder='output'):
+        """
+        :param root: URL of the folder with images
+        :param access_key: access key (default: AWS_ACCESS_KEY_ID environment variable)
+        :param secret_key: secret key (default: AWS_SECRET_ACCESS_KEY environment variable)
+        :param region: region used for signing (default: AWS_REGION environment variable or us-east-1)
+        :param max_connections: maximal number of parallel requests
+        :param part_size: objects bigger than this are read by parallel range requests
+        :param cache_folder: local folder where the output folder of this source is created
+        """
+        super().__init__(root.rstrip('/'))
+        url = urllib.parse.urlsplit(self.root)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        bucket, _, prefix = url.path.lstrip('/').partition('/')
+        if not bucket:
+            raise ValueError(f'URL of the source has to contain a bucket: {root}')
+        self.bucket = bucket
+        self.prefix = prefix + '/' if prefix else ''
+
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.region = region or os.environ.get('AWS_REGION') or 'us-east-1'
+        self.max_connections = max_connections
+        self.part_size = part_size
+        self.cache_folder = cache_folder
+
+        self.pool = ConnectionPool(self.scheme, self.netloc, max_connections)
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
+        # {object key: SourceStat} filled by listing, so no HEAD request is needed for listed images
+        self._stats = {}
+
+    def output_folder(self):
+        digest = hashlib.sha1(self.root.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_folder, f'{self.netloc.replace(":", "_")}-{self.bucket}-{digest}')
+
+    def object_key(self, path):
+        """
+        :param path: URL of an image in this source
+        :return: key of the object in the bucket
+        """
+        base = f'{self.scheme}://{self.netloc}/{self.bucket}/'
+        if not path.startswith(base):
+            raise ValueError(f'{path} is not in {self.root}')
+        return path[len(base):].replace(os.sep, '/')
+
+    def object_url(self, object_key):
+        return f'{self.scheme}://{self.netloc}/{self.bucket}/{object_key}'
+
+    def _request(self, method, object_key='', query=None, headers=None, expected=(200,)):
+        """
+        Sends a (signed) request to the bucket
+        :param object_key: key of the object ('' = the bucket)
+        :param query: dict of query parameters
+        :return: (response headers, body)
+        """
+        path = '/' + urllib.parse.quote(f'{self.bucket}/{object_key}' if object_key else self.bucket, safe='/~')
+        query_string = '&'.join(f'{urllib.parse.quote(str(k), safe="~")}={urllib.parse.quote(str(v), safe="~")}'
+                                for k, v in sorted((query or {}).items()))
+        headers = dict(headers or {})
+        headers['Host'] = self.netloc
+        if self.access_key and self.secret_key:
+            self._sign(method, path, query_string, headers)
+
+        status, response_headers, body = self.pool.request(method, f'{path}?{query_string}' if query_string else path,
+                                                           headers)
+        if status == 404:
+            raise FileNotFoundError(f'{method} {self.object_url(object_key)}: not found')
+        if status not in expected:
+            raise OSError(f'{method} {self.object_url(object_key)} failed: HTTP {status} {body[:200]!r}')
+        return response_headers, body
+
+    def _sign(self, method, path, query_string, headers):
+        """
+        Adds AWS signature version 4 to the headers
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = amz_date[:8]
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+
+        signed = sorted((name.lower(), str(value).strip()) for name, value in headers.items())
+        signed_names = ';'.join(name for name, _ in signed)
+        canonical_request = '\n'.join([method, path, query_string, ''.join(f'{n}:{v}\n' for n, v in signed),
+                                       signed_names, 'UNSIGNED-PAYLOAD'])
+        scope = f'{date}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, _sha256(canonical_request.encode('utf-8'))])
+
+        key = _hmac(('AWS4' + self.secret_key).encode('utf-8'), date)
+        for part in (self.region, 's3', 'aws4_request'):
+            key = _hmac(key, part)
+        signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={signed_names}, Signature={signature}')
+
+    def list_images(self, extensions=IMG_EXTENSIONS, recursive=False, exclude_dirs=()):
+        """
+        Lists objects under the prefix page by page (ListObjectsV2), objects come sorted by key
+        """
+        exclude_prefixes = tuple(self.prefix + name + '/' for name in exclude_dirs)
+        query = {'list-type': 2, 'prefix': self.prefix}
+        if not recursive:
+            query['delimiter'] = '/'
+
+        while True:
+            _, body = self._request('GET', query=query)
+            root = ElementTree.fromstring(body)
+            # elements are in the S3 namespace
+            ns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+
+            for item in root.iter(f'{ns}Contents'):
+                object_key = item.findtext(f'{ns}Key')
+                if not object_key.lower().endswith(extensions) or object_key.startswith(exclude_prefixes):
+                    continue
+                modified = datetime.datetime.fromisoformat(item.findtext(f'{ns}LastModified').replace('Z', '+00:00'))
+                self._stats[object_key] = SourceStat(int(item.findtext(f'{ns}Size')), _mtime_ns(modified))
+                yield self.object_url(object_key)
+
+            token = root.findtext(f'{ns}NextContinuationToken')
+            if root.findtext(f'{ns}IsTruncated') != 'true' or not token:
+                return
+            query['continuation-token'] = token
+
+    def exists(self, path):
+        try:
+            self._head(self.object_key(path))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _head(self, object_key):
+        headers, _ = self._request('HEAD', object_key)
+        modified = parsedate_to_datetime(headers['Last-Modified']) if headers.get('Last-Modified') else None
+        stat = SourceStat(int(headers.get('Content-Length', 0)), _mtime_ns(modified) if modified else 0)
+        self._stats[object_key] = stat
+        return stat
+
+    def stat(self, path):
+        object_key = self.object_key(path)
+        stat = self._stats.get(object_key)
+        return stat if stat is not None else self._head(object_key)
+
+    def read_range(self, path, start, length):
+        """
+        :return: length bytes of the object from start (range request)
+        """
+        _, body = self._request('GET', self.object_key(path), headers={'Range': f'bytes={start}-{start + length - 1}'},
+                                expected=(200, 206))
+        return body
+
+    def read_bytes(self, path):
+        object_key = self.object_key(path)
+        stat = self._stats.get(object_key)
+        if stat is None or stat.st_size <= self.part_size:
+            _, body = self._request('GET', object_key)
+            return body
+
+        # parts of a big object are downloaded in parallel over pooled connections
+        starts = range(0, stat.st_size, self.part_size)
+        parts = self._executor.map(lambda start: self.read_range(path, start, min(self.part_size,
+                                                                                   stat.st_size - start)), starts)
+        return b''.join(parts)
+
+    def copy(self, src, dst_folder, method='copy'):
+        """
+        Server-side copy, no data goes through the client (so copy method doesn't matter)
+        """
+        src_key = self.object_key(src)
+        dst = dst_folder.rstrip('/') + '/' + src_key.rsplit('/', 1)[-1]
+        copy_source = urllib.parse.quote(f'/{self.bucket}/{src_key}', safe='/~')
+        self._request('PUT', self.object_key(dst), headers={'x-amz-copy-source': copy_source})
+        self._stats.pop(self.object_key(dst), None)
+        return dst
+
+    def move(self, src, dst_folder):
+        dst = self.copy(src, dst_folder)
+        self.remove(src)
+        return dst
+
+    def remove(self, path):
+        object_key = self.object_key(path)
+        self._request('DELETE', object_key, expected=(200, 204))
+        self._stats.pop(object_key, None)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.pool.close()
+
+
+# opened remote sources {root URL: HttpSource}, looked up by paths of images
+_remote_sources = {}
+_local_source = LocalSource('')
+
+
+def is_remote(path):
+    return path.startswith(REMOTE_SCHEMES)
+
+
+def open_source(root, **kwargs):
+    """
+    :param root: local folder or URL of a folder in an object store
+    :param kwargs: arguments of HttpSource
+    :return: source of images in the folder
+    """
+    if not is_remote(root):
+        return LocalSource(root)
+
+    source = HttpSource(root, **kwargs)
+    _remote_sources[source.root] = source
+    return source
+
+
+def close_sources():
+    for source in _remote_sources.values():
+        source.close()
+    _remote_sources.clear()
+
+
+def get_source(path):
+    """
+    :return: opened remote source which contains the image, otherwise the local source
+    """
+    if is_remote(path):
+        for root, source in _remote_sources.items():
+            if path.startswith(root + '/'):
+                return source
+    return _local_source
+
+
+def remote_source(path):
+    """
+    :return: opened remote source which contains the image or None
+    """
+    source = get_source(path)
+    return source if source.remote else None
+
+
+def path_exists(path):
+    return get_source(path).exists(path)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# modules of the app are next to main.py, tests run without display
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
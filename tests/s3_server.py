@@ -0,0 +1,123 @@
+"""
+Minimal stand-in for an S3-compatible object store (one bucket in memory, path-style URLs) for tests of
+HttpSource: ListObjectsV2 with prefix, delimiter and pagination, GET with Range, HEAD, PUT (also with
+x-amz-copy-source) and DELETE. Requests aren't authenticated.
+"""
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+LAST_MODIFIED_ISO = '2024-01-02T03:04:05.000Z'
+LAST_MODIFIED_HTTP = 'Tue, 02 Jan 2024 03:04:05 GMT'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive connections, as HttpSource pools them
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _split(self):
+        """
+        :return: (object key, query parameters)
+        """
+        url = urllib.parse.urlsplit(self.path)
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        return key, {name: values[0] for name, values in urllib.parse.parse_qs(url.query).items()}
+
+    def _send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        key, query = self._split()
+        self.server.requests.append(('GET', key, self.headers.get('Range')))
+        if not key:
+            return self._list(query)
+
+        data = self.server.objects.get(key)
+        if data is None:
+            return self._send(404)
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start, end = byte_range.split('=')[1].split('-')
+            return self._send(206, data[int(start):int(end) + 1])
+        self._send(200, data)
+
+    def _list(self, query):
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        keys = sorted(key for key in self.server.objects if key.startswith(prefix))
+        if delimiter:
+            keys = [key for key in keys if delimiter not in key[len(prefix):]]
+
+        start = int(query.get('continuation-token', 0))
+        page = keys[start:start + self.server.page_size]
+        truncated = start + self.server.page_size < len(keys)
+        contents = ''.join(f'<Contents><Key>{escape(key)}</Key><LastModified>{LAST_MODIFIED_ISO}</LastModified>'
+                           f'<Size>{len(self.server.objects[key])}</Size></Contents>' for key in page)
+        token = f'<NextContinuationToken>{start + len(page)}</NextContinuationToken>' if truncated else ''
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f'<IsTruncated>{str(truncated).lower()}</IsTruncated>{contents}{token}</ListBucketResult>')
+        self._send(200, body.encode('utf-8'))
+
+    def do_HEAD(self):
+        key, _ = self._split()
+        data = self.server.objects.get(key)
+        if data is None:
+            return self._send(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Last-Modified', LAST_MODIFIED_HTTP)
+        self.end_headers()
+
+    def do_PUT(self):
+        key, _ = self._split()
+        copy_source = self.headers.get('x-amz-copy-source')
+        self.server.requests.append(('PUT', key, copy_source))
+        if copy_source:
+            source_key = urllib.parse.unquote(copy_source).lstrip('/').partition('/')[2]
+            if source_key not in self.server.objects:
+                return self._send(404)
+            self.server.objects[key] = self.server.objects[source_key]
+            return self._send(200, b'<CopyObjectResult/>')
+
+        self.server.objects[key] = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send(200)
+
+    def do_DELETE(self):
+        key, _ = self._split()
+        self.server.requests.append(('DELETE', key, None))
+        self.server.objects.pop(key, None)
+        self._send(204)
+
+
+class S3Server(ThreadingHTTPServer):
+    """
+    Object store on a free local port, serving in a daemon thread. objects = {key: bytes} of the bucket,
+    requests = list of (method, key, Range or x-amz-copy-source header) of data requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, page_size=1000):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.objects = {}
+        self.requests = []
+        self.page_size = page_size
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def url(self, bucket, prefix=''):
+        return f'http://127.0.0.1:{self.server_address[1]}/{bucket}' + (f'/{prefix}' if prefix else '')
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,20 @@
+"""
+Stub model for tests, loaded as 'stub_predictor:load'. It tells red images from blue ones by the mean of
+the red and blue channels, so the probabilities of an image are known in advance.
+"""
+import numpy as np
+
+
+class StubPredictor:
+    labels = ['red', 'blue']
+    input_size = (32, 32)
+
+    def __call__(self, images):
+        means = images.reshape(len(images), -1, 3).mean(axis=1)
+        red, blue = means[:, 0], means[:, 2]
+        p_red = red / np.maximum(red + blue, 1e-6)
+        return np.stack([p_red, 1 - p_red], axis=1).astype(np.float32)
+
+
+def load():
+    return StubPredictor()
@@ -0,0 +1,40 @@
+import os
+
+from batch import parse_args, read_label_csv, run
+from label_store import METADATA_COLUMNS
+
+
+def write_csv(path, lines):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def test_read_labels(tmp_path):
+    path = str(tmp_path / 'labels.csv')
+    write_csv(path, ['img,cat,dog', 'a.jpg,1,0', 'sub/b.jpg,1,1', 'c.jpg,0,0'])
+    assert read_label_csv(path) == (['cat', 'dog'], [('a.jpg', ['cat']), ('sub/b.jpg', ['cat', 'dog']),
+                                                     ('c.jpg', [])])
+
+
+def test_metadata_columns_are_not_labels(tmp_path):
+    path = str(tmp_path / 'labels.csv')
+    write_csv(path, ['img,cat,format,' + ','.join(METADATA_COLUMNS),
+                     'a.jpg,1,0,640,480,JPEG,12345,2020-01-01T10:00:00,0',
+                     'b.jpg,0,1,,,,,,',
+                     'c.jpg,0,0,10,10,PNG,100,,1'])
+    labels, rows = read_label_csv(path)
+    # only the trailing metadata columns are skipped, a label can have the same name as one of them
+    assert labels == ['cat', 'format']
+    assert rows == [('a.jpg', ['cat']), ('b.jpg', ['format']), ('c.jpg', [])]
+
+
+def test_copy_with_metadata_columns(tmp_path):
+    folder = tmp_path / 'images'
+    folder.mkdir()
+    (folder / 'a.jpg').write_bytes(b'a')
+    path = str(tmp_path / 'labels.csv')
+    write_csv(path, ['img,cat,' + ','.join(METADATA_COLUMNS), 'a.jpg,1,640,480,JPEG,1,,0'])
+
+    assert run(parse_args([path, str(folder)])) == 0
+    assert sorted(os.listdir(folder)) == ['a.jpg', 'cat', 'output']
+    assert os.listdir(folder / 'cat') == ['a.jpg']
@@ -0,0 +1,38 @@
+import numpy as np
+
+from image_index import ImageIndex
+from label_store import LabelStore
+
+
+def make_index(n):
+    index = ImageIndex('/data', ['cat', 'dog'])
+    store = LabelStore(['cat', 'dog'])
+    for i in range(n):
+        key = index.make_key(f'/data/{i}.jpg')
+        index.add(f'/data/{i}.jpg')
+        store.add_image(key)
+    return index, store
+
+
+def test_removed_images_are_skipped():
+    index, store = make_index(10)
+    for i in (3, 4, 6):
+        index.remove(i)
+
+    assert index.neighbours(5, 3, 3) == ([7, 8, 9], [2, 1, 0])
+    assert index.neighbours(2, 2, 5) == ([5, 7], [1, 0])
+    assert store.find_unlabeled(2, excluded=index.removed) == 5
+    assert store.find_unlabeled(7, forward=False, excluded=index.removed) == 5
+
+    store.set('4.jpg', 'cat', True)
+    store.set('8.jpg', 'cat', True)
+    assert store.find_with_label('cat', 2, excluded=index.removed) == 8
+    assert store.find_with_label('cat', 2) == 4
+
+    index.set_order([9, 6, 8, 4, 2, 0])
+    assert index.neighbours(8, 3, 3) == ([2, 0], [9])
+    with_label = store.with_label('cat')
+    assert index.step(9, accepted=with_label) == 8
+    assert index.step(8, accepted=with_label) is None
+    assert index.first(accepted=with_label) == 8
+    assert index.first(accepted=np.zeros(10, dtype=bool)) is None
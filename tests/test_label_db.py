@@ -0,0 +1,26 @@
+import os
+import time
+
+from label_db import LabelDatabase
+
+
+def test_claims_of_other_annotators(tmp_path):
+    path = os.path.join(str(tmp_path), 'labels.sqlite')
+    keys = [f'{i}.jpg' for i in range(6)]
+    alice = LabelDatabase(path, 'alice', ['cat'], claim_timeout=60)
+    bob = LabelDatabase(path, 'bob', ['cat'], claim_timeout=60)
+    alice.add_images(keys)
+
+    assert alice.claim_batch(size=2) == keys[:2]
+    assert bob.claim_batch(size=2) == keys[2:4]
+    assert bob.claimed_by_others(keys) == {'0.jpg': 'alice', '1.jpg': 'alice'}
+    assert alice.claimed_by_others(keys) == {'2.jpg': 'bob', '3.jpg': 'bob'}
+
+    # labeled images and expired claims don't count
+    alice.record('0.jpg', 'cat', True)
+    alice.flush()
+    alice.connection.execute('UPDATE images SET claimed_at = ? WHERE key = ?', (time.time() - 120, '1.jpg'))
+    assert bob.claimed_by_others(keys) == {}
+
+    alice.close()
+    bob.close()
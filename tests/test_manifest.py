@@ -0,0 +1,55 @@
+import os
+
+from manifest import Manifest
+from scanning import scan_img_paths
+
+
+def make_tree(root):
+    for rel_path in ('a.jpg', 'notes.txt', 'sub/b.png', 'sub/deep/c.jpg', 'sub/deep/d.jpg'):
+        path = os.path.join(str(root), *rel_path.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x')
+
+
+def scan(root, manifest_path):
+    manifest = Manifest(str(root), recursive=True)
+    manifest.load(manifest_path)
+    paths = list(manifest.scan())
+    manifest.save(manifest_path)
+    return paths, manifest.rescanned_dirs
+
+
+def test_unchanged_folders_are_not_listed(tmp_path):
+    root = tmp_path / 'images'
+    make_tree(root)
+    manifest_path = str(tmp_path / 'manifest.bin')
+
+    expected = list(scan_img_paths(str(root), recursive=True))
+    assert scan(root, manifest_path) == (expected, 3)
+    assert scan(root, manifest_path) == (expected, 0)
+
+    os.remove(os.path.join(str(root), 'sub', 'deep', 'c.jpg'))
+    assert scan(root, manifest_path) == ([path for path in expected if not path.endswith('c.jpg')], 1)
+
+
+def test_folder_which_cant_be_read_is_scanned_next_time(tmp_path, monkeypatch):
+    root = tmp_path / 'images'
+    make_tree(root)
+    manifest_path = str(tmp_path / 'manifest.bin')
+    expected, _ = scan(root, manifest_path)
+
+    sub = os.path.join(str(root), 'sub')
+    stat = os.stat
+
+    def failing_stat(path, *args, **kwargs):
+        if path == sub:
+            raise PermissionError(13, 'Permission denied', path)
+        return stat(path, *args, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'stat', failing_stat)
+        assert scan(root, manifest_path) == ([os.path.join(str(root), 'a.jpg')], 0)
+
+    # the folder is still a child of the root folder, so it's found although the root didn't change
+    assert scan(root, manifest_path) == (expected, 2)
@@ -0,0 +1,95 @@
+import os
+import time
+
+import numpy as np
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QColor, QImage
+
+from predictions import PredictionCache, PredictionIndex, PredictionThread
+
+# (red, blue) of the images, probability of 'red' is red / (red + blue)
+COLORS = [(200, 50), (128, 128), (255, 0), (150, 100)]
+
+
+def make_images(folder):
+    items = []
+    for i, (red, blue) in enumerate(COLORS):
+        path = os.path.join(str(folder), f'{i}.png')
+        image = QImage(64, 48, QImage.Format_RGB888)
+        image.fill(QColor(red, 0, blue))
+        assert image.save(path)
+        items.append((f'{i}.png', path))
+    return items
+
+
+def run_predictions(items, cache, timeout=60):
+    """
+    :return: {key: probabilities of the session labels}
+    """
+    results = {}
+    errors = []
+    thread = PredictionThread('stub_predictor:load', ['red', 'green', 'blue'], cache, batch_size=3, workers=1)
+    # signals are delivered in the prediction thread, the test has no event loop
+    thread.predicted.connect(lambda batch: results.update(batch), Qt.DirectConnection)
+    thread.failed.connect(errors.append, Qt.DirectConnection)
+    thread.start()
+    thread.enqueue(items)
+
+    start = time.monotonic()
+    while len(results) < len(items) and not errors and time.monotonic() - start < timeout:
+        time.sleep(0.05)
+    thread.stop()
+    assert not errors
+    return results
+
+
+def test_stub_model_predictions_and_uncertain_first(tmp_path):
+    items = make_images(tmp_path)
+    cache = PredictionCache(os.path.join(str(tmp_path), 'output', 'predictions.npz'), 'stub_predictor:load')
+    results = run_predictions(items, cache)
+
+    assert sorted(results) == [key for key, _ in items]
+    for i, (red, blue) in enumerate(COLORS):
+        p_red = red / (red + blue)
+        # 'green' isn't a label of the model
+        np.testing.assert_allclose(results[f'{i}.png'], [p_red, 0, 1 - p_red], atol=0.01)
+
+    index = PredictionIndex(3)
+    for i in range(len(items)):
+        index.set(i, results[f'{i}.png'])
+    labeled = np.zeros(len(items) + 1, dtype=bool)
+    labeled[3] = True
+    # image 4 isn't predicted, labeled image 3 goes last although its margin is the smallest but one
+    order = index.uncertain_first(np.arange(len(items) + 1), labeled)
+    assert order.tolist() == [1, 0, 2, 4, 3]
+
+    # predictions are cached, the next session doesn't run the model again
+    cache.save()
+    cache = PredictionCache(cache.path, 'stub_predictor:load')
+    cache.load()
+    assert sorted(cache.entries) == sorted(results)
+
+
+def test_images_in_flight_are_predicted_after_restart(tmp_path):
+    # the same images under more keys
+    items = [(f'{i}/{key}', path) for i in range(6) for key, path in make_images(tmp_path)]
+    cache = PredictionCache(os.path.join(str(tmp_path), 'output', 'predictions.npz'), 'stub_predictor:load')
+    results = {}
+    thread = PredictionThread('stub_predictor:load', ['red', 'blue'], cache, batch_size=2, workers=1)
+    thread.predicted.connect(lambda batch: results.update(batch), Qt.DirectConnection)
+    thread.start()
+    thread.enqueue(items)
+
+    # stopped while batches are in the worker process
+    start = time.monotonic()
+    while not results and time.monotonic() - start < 60:
+        time.sleep(0.01)
+    thread.stop()
+    assert 0 < len(results) < len(items)
+
+    thread.start()
+    start = time.monotonic()
+    while len(results) < len(items) and time.monotonic() - start < 60:
+        time.sleep(0.05)
+    thread.stop()
+    assert sorted(results) == sorted(key for key, _ in items)
@@ -0,0 +1,49 @@
+import os
+import time
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QColor, QImage
+
+from similarity import DescriptorCache, DescriptorThread
+
+# reddish and bluish images alternate in folder order
+COLORS = [(250, 0, 0), (0, 0, 250), (230, 20, 0), (0, 20, 230), (240, 10, 10), (10, 10, 240)]
+
+
+def make_images(folder):
+    items = []
+    for i, color in enumerate(COLORS):
+        path = os.path.join(str(folder), f'{i}.png')
+        image = QImage(64, 48, QImage.Format_RGB888)
+        image.fill(QColor(*color))
+        assert image.save(path)
+        items.append((i, f'{i}.png', path))
+    return items
+
+
+def test_order_is_computed_in_descriptor_thread(tmp_path):
+    cache = DescriptorCache(os.path.join(str(tmp_path), 'output', 'image_descriptors.npz'))
+    thread = DescriptorThread(cache, batch_size=4)
+    orders = []
+    # signals are delivered in the descriptor thread, the test has no event loop
+    thread.ordered.connect(lambda order: orders.append((order.tolist(), thread.currentThread())),
+                           Qt.DirectConnection)
+    thread.start()
+    thread.enqueue(make_images(tmp_path))
+    # the order is computed after the queued images are described, image 6 doesn't exist yet
+    thread.request_order([1, 0, 2, 3, 4, 5, 6])
+
+    start = time.monotonic()
+    while not orders and time.monotonic() - start < 60:
+        time.sleep(0.05)
+    thread.stop()
+
+    assert len(orders) == 1
+    order, emitted_from = orders[0]
+    # the current image stays first, its cluster follows, then the other cluster and images without descriptors
+    assert order[0] == 1
+    assert sorted(order[:3]) == [1, 3, 5]
+    assert sorted(order[3:6]) == [0, 2, 4]
+    assert order[6] == 6
+    assert emitted_from is thread
+    assert len(cache.entries) == len(COLORS)
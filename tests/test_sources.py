@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from s3_server import S3Server
+from sources import HttpSource, close_sources, open_source
+
+
+@pytest.fixture
+def server():
+    server = S3Server(page_size=2)
+    server.objects = {
+        'data/a.jpg': b'a' * 100,
+        'data/b.png': os.urandom(1000),
+        'data/notes.txt': b'not an image',
+        'data/sub/c.jpg': b'c' * 10,
+        'data/sub/d.jpg': b'd' * 10,
+        'other/e.jpg': b'e',
+    }
+    yield server
+    close_sources()
+    server.stop()
+
+
+def test_list(server, tmp_path):
+    source = HttpSource(server.url('bucket', 'data'), cache_folder=str(tmp_path))
+    # listing comes in pages of two objects
+    assert list(source.list_images()) == [server.url('bucket', 'data/a.jpg'), server.url('bucket', 'data/b.png')]
+    assert list(source.list_images(recursive=True, exclude_dirs=('sub',))) == list(source.list_images())
+    assert list(source.list_images(recursive=True))[2:] == [server.url('bucket', 'data/sub/c.jpg'),
+                                                             server.url('bucket', 'data/sub/d.jpg')]
+
+    # listed images need no HEAD request
+    stat = source.stat(server.url('bucket', 'data/b.png'))
+    assert stat.st_size == 1000 and stat.st_mtime_ns == 1704164645 * 1_000_000_000
+    assert source.exists(server.url('bucket', 'data/sub/c.jpg'))
+    assert not source.exists(server.url('bucket', 'data/missing.jpg'))
+
+
+def test_read_range_and_parts(server, tmp_path):
+    source = HttpSource(server.url('bucket', 'data'), part_size=300, cache_folder=str(tmp_path))
+    list(source.list_images())
+    url = server.url('bucket', 'data/b.png')
+    data = server.objects['data/b.png']
+
+    assert source.read_range(url, 10, 20) == data[10:30]
+    del server.requests[:]
+    assert source.read_bytes(url) == data
+    # 1000 bytes in parts of 300
+    assert sorted(request[2] for request in server.requests) == ['bytes=0-299', 'bytes=300-599', 'bytes=600-899',
+                                                                 'bytes=900-999']
+    # small objects are read by one request
+    assert source.read_bytes(server.url('bucket', 'data/a.jpg')) == b'a' * 100
+
+
+def test_copy_move_remove(server, tmp_path):
+    source = open_source(server.url('bucket', 'data'), cache_folder=str(tmp_path))
+    src = server.url('bucket', 'data/a.jpg')
+
+    dst = source.copy(src, server.url('bucket', 'data/cat'))
+    assert dst == server.url('bucket', 'data/cat/a.jpg')
+    assert server.objects['data/cat/a.jpg'] == b'a' * 100
+    # server-side copy, no data goes through the client
+    assert ('PUT', 'data/cat/a.jpg', '/bucket/data/a.jpg') in server.requests
+
+    moved = source.move(dst, server.url('bucket', 'data/dog'))
+    assert moved == server.url('bucket', 'data/dog/a.jpg')
+    assert 'data/cat/a.jpg' not in server.objects and server.objects['data/dog/a.jpg'] == b'a' * 100
+
+    source.remove(moved)
+    assert 'data/dog/a.jpg' not in server.objects
+    with pytest.raises(FileNotFoundError):
+        source.read_bytes(moved)
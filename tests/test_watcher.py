@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+from PyQt5.QtCore import Qt
+
+from watcher import FolderWatcher, watch_supported
+
+pytestmark = pytest.mark.skipif(not watch_supported(), reason='inotify is not available')
+
+
+def write(path):
+    with open(path, 'wb') as f:
+        f.write(b'x')
+
+
+def wait_for(events, count, timeout=5):
+    start = time.monotonic()
+    while len(events) < count and time.monotonic() - start < timeout:
+        time.sleep(0.02)
+    time.sleep(0.3)  # nothing else comes
+    return list(events)
+
+
+def test_sub_folder_renamed_and_moved_out(tmp_path):
+    root = os.path.join(str(tmp_path), 'images')
+    os.makedirs(os.path.join(root, 'sub', 'deep'))
+    write(os.path.join(root, 'sub', 'a.jpg'))
+    write(os.path.join(root, 'sub', 'deep', 'b.jpg'))
+
+    watcher = FolderWatcher(root, recursive=True, move_timeout=0.1)
+    events = []
+    ready = []
+    # signals are delivered in the watcher thread, the test has no event loop
+    watcher.changed.connect(events.extend, Qt.DirectConnection)
+    watcher.ready.connect(lambda: ready.append(True), Qt.DirectConnection)
+    assert watcher.start_watching()
+    try:
+        wait_for(ready, 1)
+
+        os.rename(os.path.join(root, 'sub'), os.path.join(root, 'renamed'))
+        assert sorted(wait_for(events, 2)) == [
+            ('renamed', os.path.join(root, 'sub', 'a.jpg'), os.path.join(root, 'renamed', 'a.jpg')),
+            ('renamed', os.path.join(root, 'sub', 'deep', 'b.jpg'), os.path.join(root, 'renamed', 'deep', 'b.jpg'))]
+
+        # watches of the renamed folders report the new paths
+        del events[:]
+        write(os.path.join(root, 'renamed', 'deep', 'c.jpg'))
+        assert wait_for(events, 1) == [('created', os.path.join(root, 'renamed', 'deep', 'c.jpg'))]
+
+        del events[:]
+        outside = os.path.join(str(tmp_path), 'outside')
+        os.rename(os.path.join(root, 'renamed'), outside)
+        assert wait_for(events, 1) == [('folder_deleted', os.path.join(root, 'renamed'))]
+
+        # the folder isn't watched any more
+        del events[:]
+        write(os.path.join(outside, 'deep', 'd.jpg'))
+        assert wait_for(events, 1, timeout=0.5) == []
+    finally:
+        watcher.stop()
@@ -0,0 +1,239 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QObject, QRunnable, QSize, QThreadPool, Qt, pyqtSignal
+from PyQt5.QtGui import QBrush, QColor, QImage, QPixmap
+from PyQt5.QtWidgets import QAbstractItemView, QListView
+
+from archives import stat_image
+from instrumentation import profiler
+from prefetch import decode_image
+
+LABELED_BACKGROUND = QBrush(QColor('#C8E6C9'))
+
+
+class ThumbnailCache:
+    """
+    Persistent on-disk cache of thumbnails. A thumbnail is keyed by path, modification time and size of the image,
+    so it is generated again when the image changes. Safe to use from worker threads.
+    """
+
+    def __init__(self, folder, size=128, quality=85):
+        """
+        :param folder: folder where thumbnails are stored (created when needed)
+        :param size: maximal width and height of thumbnails
+        :param quality: jpeg quality of stored thumbnails
+        """
+        self.folder = folder
+        self.size = size
+        self.quality = quality
+
+    def cache_path(self, path):
+        """
+        :return: path of the cached thumbnail of the image (None if the image doesn't exist)
+        """
+        try:
+            stat = stat_image(path)
+        except (OSError, KeyError):
+            return None
+
+        key = f'{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}\0{self.size}'
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        # thumbnails are spread into sub-folders, so no folder contains too many files
+        return os.path.join(self.folder, digest[:2], digest[2:] + '.jpg')
+
+    def load(self, path):
+        """
+        Loads the thumbnail from the cache, or generates and stores it on cache miss
+        :param path: path to the image
+        :return: QImage (null QImage if the image can't be decoded)
+        """
+        cache_path = self.cache_path(path)
+        if cache_path is None:
+            return QImage()
+
+        with profiler.span('thumbnail.load'):
+            image = QImage(cache_path)
+        if not image.isNull():
+            return image
+
+        with profiler.span('thumbnail.generate'):
+            image = decode_image(path, self.size, self.size, margin=0)
+            if image.isNull():
+                return image
+
+            # written under temporary name, so other threads never read half written thumbnail
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.{id(image)}.tmp'
+            if image.save(tmp_path, 'JPG', self.quality):
+                os.replace(tmp_path, cache_path)
+        return image
+
+
+class _ThumbnailSignals(QObject):
+    # row, path, thumbnail
+    loaded = pyqtSignal(int, str, QImage)
+
+
+class _ThumbnailTask(QRunnable):
+    def __init__(self, row, path, cache, signals):
+        super().__init__()
+        self.row = row
+        self.path = path
+        self.cache = cache
+        self.signals = signals
+
+    def run(self):
+        self.signals.loaded.emit(self.row, self.path, self.cache.load(self.path))
+
+
+class ThumbnailGridModel(QAbstractListModel):
+    """
+    Thumbnails of all images in the image index. Thumbnails are loaded in worker threads only when the view
+    asks for them (= when they are visible), the model keeps a limited number of them in memory.
+    """
+
+    def __init__(self, image_index, label_store, cache, max_threads=None, max_pixmaps=2000, parent=None):
+        super().__init__(parent)
+        self.image_index = image_index
+        self.label_store = label_store
+        self.cache = cache
+        self.max_pixmaps = max_pixmaps
+        self.rows = 0
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads or min(4, os.cpu_count() or 1))
+
+        self._pixmaps = OrderedDict()  # {row: (path, QPixmap)}
+        self._pending = set()  # rows which are queued or being loaded
+        self._placeholder = QPixmap(cache.size, cache.size)
+        self._placeholder.fill(QColor('#EEEEEE'))
+        self._signals = _ThumbnailSignals(self)
+        self._signals.loaded.connect(self._on_loaded)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.rows
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = index.row()
+        if role == Qt.DisplayRole:
+            return self.image_index.key(row).rsplit('/', 1)[-1]
+        if role == Qt.DecorationRole:
+            return self.thumbnail(row)
+        if role == Qt.ToolTipRole:
+            key = self.image_index.key(row)
+            labels = self.label_store.get_labels(key)
+            return f'{key}\n{", ".join(labels)}' if labels else key
+        if role == Qt.BackgroundRole and self.label_store.counts[row]:
+            return LABELED_BACKGROUND
+        return None
+
+    def thumbnail(self, row):
+        """
+        :return: thumbnail of the image, or a placeholder while the thumbnail is being loaded
+        """
+        path = self.image_index.location(row)
+        entry = self._pixmaps.get(row)
+        if entry is not None and entry[0] == path:
+            self._pixmaps.move_to_end(row)
+            return entry[1]
+
+        if row not in self._pending:
+            self._pending.add(row)
+            self.pool.start(_ThumbnailTask(row, path, self.cache, self._signals))
+        return self._placeholder
+
+    def _on_loaded(self, row, path, image):
+        self._pending.discard(row)
+        # image can be moved to another folder in the meantime, then it is loaded again
+        if image.isNull() or row >= self.rows or self.image_index.location(row) != path:
+            return
+
+        self._pixmaps[row] = (path, QPixmap.fromImage(image))
+        while len(self._pixmaps) > self.max_pixmaps:
+            self._pixmaps.popitem(last=False)
+
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def drop_pending(self):
+        """
+        Drops queued loads which didn't start yet (e.g. after fast scrolling, the visible rows ask again)
+        """
+        self.pool.clear()
+        self._pending.clear()
+
+    def set_row_count(self, rows):
+        """
+        Shows new images found by the scanner
+        :param rows: number of images in the image index
+        """
+        if rows > self.rows:
+            self.beginInsertRows(QModelIndex(), self.rows, rows - 1)
+            self.rows = rows
+            self.endInsertRows()
+
+    def refresh_rows(self, rows):
+        """
+        Repaints rows whose labels (or location) changed
+        :param rows: ordinals of images
+        """
+        if len(rows) == 0:
+            return
+        self.dataChanged.emit(self.index(int(min(rows))), self.index(int(max(rows))),
+                              [Qt.DecorationRole, Qt.ToolTipRole, Qt.BackgroundRole])
+
+    def shutdown(self):
+        self.drop_pending()
+        self.pool.waitForDone()
+
+
+class ThumbnailGrid(QListView):
+    """
+    Virtualized grid of thumbnails. Only visible thumbnails are loaded.
+    Many images can be selected by dragging a rubber band, Shift+click, Ctrl+click or Ctrl+A.
+    """
+
+    image_activated = pyqtSignal(int)
+
+    def __init__(self, image_index, label_store, cache, parent=None):
+        super().__init__(parent)
+        self.grid_model = ThumbnailGridModel(image_index, label_store, cache, parent=self)
+        self.setModel(self.grid_model)
+
+        size = cache.size
+        self.setViewMode(QListView.IconMode)
+        self.setMovement(QListView.Static)
+        self.setResizeMode(QListView.Adjust)
+        self.setIconSize(QSize(size, size))
+        self.setGridSize(QSize(size + 16, size + 32))
+        self.setTextElideMode(Qt.ElideMiddle)
+        # all items have the same size and they are laid out in batches, so the view works with huge folders
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QListView.Batched)
+        self.setBatchSize(1000)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setSelectionRectVisible(True)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+        self.doubleClicked.connect(lambda index: self.image_activated.emit(index.row()))
+        self.verticalScrollBar().valueChanged.connect(lambda value: self.grid_model.drop_pending())
+
+    def selected_ordinals(self):
+        """
+        :return: sorted list of ordinals of selected images
+        """
+        return sorted(index.row() for index in self.selectionModel().selectedIndexes())
+
+    def select_ordinal(self, ordinal):
+        """
+        Selects only the image and scrolls to it
+        """
+        if ordinal < self.grid_model.rows:
+            index = self.grid_model.index(ordinal)
+            self.setCurrentIndex(index)
+            self.scrollTo(index)
@@ -0,0 +1,343 @@
+"""
+Zoomable and pannable viewer of huge images (satellite scans, pathology slides, ...).
+
+The image is split into tiles of 256 x 256 pixels on levels of detail (level k = image downscaled 2^k times).
+Only tiles which are visible at the current zoom are decoded, each one from its region of the file
+(QImageReader clip rect + scaled size, so JPEGs are decoded at reduced size and only up to the region).
+Pyramidal TIFFs with smaller pages decode coarse levels from the smallest page which is big enough.
+Formats which can't decode a region (e.g. PNG) decode the whole level once, up to a pixel limit.
+Decoded tiles are kept in a bounded LRU cache, painting only draws cached tiles (missing ones are drawn
+from coarser levels until they arrive), so panning stays smooth.
+"""
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QPointF, QRect, QRectF, QRunnable, QSize, QThreadPool, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QImageIOHandler, QPainter, QPixmap
+from PyQt5.QtWidgets import QWidget
+
+from instrumentation import profiler
+from prefetch import image_reader
+
+TILE_SIZE = 256
+
+
+class TiledImage:
+    """
+    Size, levels of detail and pyramid pages of one image. Tiles are decoded from worker threads.
+    """
+
+    def __init__(self, path, max_level_pixels=64 * 1024 * 1024):
+        """
+        :param path: path to the image
+        :param max_level_pixels: formats without region decoding decode the whole level, levels bigger than this
+            are not available for them
+        """
+        self.path = path
+        self.max_level_pixels = max_level_pixels
+
+        reader = image_reader(path)
+        # EXIF orientation isn't applied, clip rects are in the coordinates of stored pixels
+        reader.setAutoTransform(False)
+        size = reader.size()
+        self.width = size.width()
+        self.height = size.height()
+        self.clip_supported = reader.supportsOption(QImageIOHandler.ClipRect)
+
+        # pages of a pyramidal TIFF: (page number, width) of pages with the same aspect ratio, biggest first
+        self.pages = [(0, self.width)]
+        if self.width > 0 and reader.imageCount() > 1:
+            for page in range(1, reader.imageCount()):
+                if reader.jumpToImage(page):
+                    page_size = reader.size()
+                    if page_size.isValid() and abs(page_size.height() * self.width / page_size.width()
+                                                   - self.height) <= 2 ** page:
+                        self.pages.append((page, page_size.width()))
+            self.pages.sort(key=lambda page: -page[1])
+
+        # level where the whole image fits into one tile
+        self.max_level = max(0, math.ceil(math.log2(max(self.width, self.height, 1) / TILE_SIZE)))
+        self.min_level = 0
+        if not self.clip_supported:
+            while (self.width * self.height) >> (2 * self.min_level) > max_level_pixels:
+                self.min_level += 1
+
+        self._level_image = None  # (level, QImage) whole level for formats without region decoding
+        self._lock = threading.Lock()
+
+    @property
+    def valid(self):
+        return self.width > 0 and self.height > 0
+
+    def tile_count(self, level):
+        """
+        :return: (columns, rows) of tiles on the level
+        """
+        span = TILE_SIZE << level
+        return math.ceil(self.width / span), math.ceil(self.height / span)
+
+    def tile_rect(self, level, column, row):
+        """
+        :return: region of the tile in image coordinates (level 0)
+        """
+        span = TILE_SIZE << level
+        return QRect(column * span, row * span, span, span).intersected(QRect(0, 0, self.width, self.height))
+
+    def decode_tile(self, level, column, row):
+        """
+        :return: QImage of the tile (downscaled 2^level times), null QImage if it can't be decoded
+        """
+        region = self.tile_rect(level, column, row)
+        target = QSize(max(1, math.ceil(region.width() / (1 << level))),
+                       max(1, math.ceil(region.height() / (1 << level))))
+
+        if not self.clip_supported:
+            return self._level(level).copy(QRect(column * TILE_SIZE, row * TILE_SIZE,
+                                                 target.width(), target.height()))
+
+        # the smallest pyramid page which still has enough pixels for the level
+        page, page_width = self.pages[0]
+        for candidate, candidate_width in self.pages:
+            if candidate_width * (1 << level) >= self.width:
+                page, page_width = candidate, candidate_width
+
+        reader = image_reader(self.path)
+        reader.setAutoTransform(False)
+        if page:
+            reader.jumpToImage(page)
+            ratio = page_width / self.width
+            region = QRect(int(region.x() * ratio), int(region.y() * ratio),
+                           max(1, round(region.width() * ratio)), max(1, round(region.height() * ratio)))
+        # clip rect is applied before scaling
+        reader.setClipRect(region)
+        reader.setScaledSize(target)
+        return reader.read()
+
+    def _level(self, level):
+        """
+        :return: the whole level decoded at once (only the last one is kept)
+        """
+        with self._lock:
+            if self._level_image is None or self._level_image[0] != level:
+                reader = image_reader(self.path)
+                reader.setAutoTransform(False)
+                reader.setScaledSize(QSize(max(1, math.ceil(self.width / (1 << level))),
+                                           max(1, math.ceil(self.height / (1 << level)))))
+                self._level_image = (level, reader.read())
+            return self._level_image[1]
+
+
+class _TileSignals(QObject):
+    # path, level, column, row, tile
+    decoded = pyqtSignal(str, int, int, int, object)
+
+
+class _TileTask(QRunnable):
+    def __init__(self, image, level, column, row, signals):
+        super().__init__()
+        self.image = image
+        self.level = level
+        self.column = column
+        self.row = row
+        self.signals = signals
+
+    def run(self):
+        with profiler.span('tile.decode'):
+            tile = self.image.decode_tile(self.level, self.column, self.row)
+        self.signals.decoded.emit(self.image.path, self.level, self.column, self.row, tile)
+
+
+class TileViewer(QWidget):
+    """
+    Viewer with mouse wheel zoom (around the cursor) and panning by dragging. Double click fits the image.
+    """
+
+    def __init__(self, cache_size_mb=256, max_threads=None, parent=None):
+        super().__init__(parent)
+        self.max_bytes = cache_size_mb * 1024 * 1024
+        self.image = None
+        self.scale = 1.0  # screen pixels per image pixel
+        self.offset = QPointF()  # screen position of the image origin
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads or min(4, os.cpu_count() or 1))
+        self._tiles = OrderedDict()  # {(level, column, row): QPixmap} of the current image
+        self._bytes = 0
+        self._pending = set()
+        self._drag_start = None
+        self._signals = _TileSignals(self)
+        self._signals.decoded.connect(self._on_decoded)
+
+        self.setMouseTracking(False)
+        self.setAutoFillBackground(True)
+        palette = self.palette()
+        palette.setColor(self.backgroundRole(), QColor('#303030'))
+        self.setPalette(palette)
+
+    def open(self, path):
+        """
+        Shows the image fitted into the viewer. Only the header is read here.
+        """
+        if self.image is not None and self.image.path == path:
+            return
+
+        self.pool.clear()
+        self._pending.clear()
+        self._tiles.clear()
+        self._bytes = 0
+        self.image = TiledImage(path)
+        self.fit()
+
+    def fit(self):
+        if self.image is None or not self.image.valid or self.width() <= 0 or self.height() <= 0:
+            self.update()
+            return
+        self.scale = min(self.width() / self.image.width, self.height() / self.image.height)
+        self.offset = QPointF((self.width() - self.image.width * self.scale) / 2,
+                              (self.height() - self.image.height * self.scale) / 2)
+        self.update()
+
+    def current_level(self):
+        """
+        :return: the coarsest level which still has at least one image pixel per screen pixel
+        """
+        level = int(math.floor(math.log2(1 / self.scale))) if self.scale < 1 else 0
+        return max(self.image.min_level, min(level, self.image.max_level))
+
+    def visible_tiles(self, level):
+        """
+        :return: list of (column, row) of tiles of the level which are visible
+        """
+        span = (TILE_SIZE << level) * self.scale
+        columns, rows = self.image.tile_count(level)
+        first_column = max(0, int(-self.offset.x() // span))
+        first_row = max(0, int(-self.offset.y() // span))
+        last_column = min(columns - 1, int((self.width() - self.offset.x()) // span))
+        last_row = min(rows - 1, int((self.height() - self.offset.y()) // span))
+        return [(column, row) for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1)]
+
+    def paintEvent(self, event):
+        if self.image is None or not self.image.valid:
+            return
+
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, self.scale < 1)
+        level = self.current_level()
+        missing = []
+        for column, row in self.visible_tiles(level):
+            pixmap = self._tiles.get((level, column, row))
+            if pixmap is not None:
+                self._tiles.move_to_end((level, column, row))
+                self._draw(painter, level, column, row, pixmap)
+            else:
+                missing.append((column, row))
+                self._draw_coarser(painter, level, column, row)
+        painter.end()
+
+        # tiles closest to the centre are decoded first
+        center_x = (self.width() / 2 - self.offset.x()) / ((TILE_SIZE << level) * self.scale)
+        center_y = (self.height() / 2 - self.offset.y()) / ((TILE_SIZE << level) * self.scale)
+        missing.sort(key=lambda tile: (tile[0] + 0.5 - center_x) ** 2 + (tile[1] + 0.5 - center_y) ** 2)
+        for column, row in missing:
+            self._request(level, column, row)
+
+    def _draw(self, painter, level, column, row, pixmap):
+        rect = self.image.tile_rect(level, column, row)
+        painter.drawPixmap(QRectF(self.offset.x() + rect.x() * self.scale, self.offset.y() + rect.y() * self.scale,
+                                  rect.width() * self.scale, rect.height() * self.scale),
+                           pixmap, QRectF(pixmap.rect()))
+
+    def _draw_coarser(self, painter, level, column, row):
+        """
+        Draws part of a cached tile of a coarser level in place of the missing tile
+        """
+        for coarser in range(level + 1, self.image.max_level + 1):
+            shift = coarser - level
+            pixmap = self._tiles.get((coarser, column >> shift, row >> shift))
+            if pixmap is None:
+                continue
+
+            rect = self.image.tile_rect(level, column, row)
+            coarse_rect = self.image.tile_rect(coarser, column >> shift, row >> shift)
+            factor = 1 << coarser
+            source = QRectF((rect.x() - coarse_rect.x()) / factor, (rect.y() - coarse_rect.y()) / factor,
+                            rect.width() / factor, rect.height() / factor)
+            painter.drawPixmap(QRectF(self.offset.x() + rect.x() * self.scale,
+                                      self.offset.y() + rect.y() * self.scale,
+                                      rect.width() * self.scale, rect.height() * self.scale), pixmap, source)
+            return
+
+    def _request(self, level, column, row):
+        key = (level, column, row)
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        self.pool.start(_TileTask(self.image, level, column, row, self._signals))
+
+    def _on_decoded(self, path, level, column, row, tile):
+        key = (level, column, row)
+        self._pending.discard(key)
+        if self.image is None or path != self.image.path or tile.isNull():
+            return
+
+        pixmap = QPixmap.fromImage(tile)
+        self._tiles[key] = pixmap
+        self._bytes += pixmap.width() * pixmap.height() * 4
+        # the coarsest tile is kept, it is drawn when nothing else is cached
+        while self._bytes > self.max_bytes and len(self._tiles) > 1:
+            old_key, old = self._tiles.popitem(last=False)
+            if old_key[0] == self.image.max_level:
+                self._tiles[old_key] = old
+                continue
+            self._bytes -= old.width() * old.height() * 4
+        self.update()
+
+    def _view_changed(self):
+        # tiles queued for the previous view are dropped, the new view requests what it needs
+        self.pool.clear()
+        self._pending.clear()
+        self.update()
+
+    def zoom(self, factor, anchor):
+        """
+        :param factor: zoom factor (> 1 zooms in)
+        :param anchor: screen point which stays in place
+        """
+        if self.image is None or not self.image.valid:
+            return
+        fit_scale = min(self.width() / self.image.width, self.height() / self.image.height)
+        # from the whole image up to 8 screen pixels per image pixel
+        scale = min(max(self.scale * factor, fit_scale), 8.0)
+        factor = scale / self.scale
+        self.offset = anchor - (anchor - self.offset) * factor
+        self.scale = scale
+        self._view_changed()
+
+    def wheelEvent(self, event):
+        self.zoom(1.25 ** (event.angleDelta().y() / 120), QPointF(event.pos()))
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self._drag_start = (QPointF(event.pos()), self.offset)
+
+    def mouseMoveEvent(self, event):
+        if self._drag_start is not None:
+            start, offset = self._drag_start
+            self.offset = offset + QPointF(event.pos()) - start
+            self._view_changed()
+
+    def mouseReleaseEvent(self, event):
+        self._drag_start = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.fit()
+
+    def resizeEvent(self, event):
+        self.fit()
+
+    def shutdown(self):
+        self.pool.clear()
+        self.pool.waitForDone()
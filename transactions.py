@@ -0,0 +1,213 @@
+"""
+Undo / redo of label changes and deferred commit of file operations.
+
+In deferred mode label changes don't touch the label folders. The difference between the labels which are
+already in label folders (committed) and the current labels is turned into a plan of file operations when
+the changes are committed. Toggling a label on and off again therefore costs no file operation at all.
+
+The plan is saved before it is executed and executed operations are logged, so an interrupted commit
+is resumed when the folder is opened again. Operations are ordered in phases (copies, moves, removes),
+so at any point of the commit every image exists at least once.
+"""
+import json
+import os
+
+from file_ops import copy_file, move_file, remove_file
+from sources import path_exists
+
+PLAN_FILENAME = 'commit_plan.json'
+PROGRESS_FILENAME = 'commit_progress.log'
+COMMITTED_FILENAME = 'committed_labels.json'
+
+
+class LabelHistory:
+    """
+    Unlimited undo / redo of label changes. Command = (label, ordinals of images, assigned).
+    """
+
+    def __init__(self):
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def record(self, label, ordinals, assigned):
+        """
+        :param label: changed label
+        :param ordinals: ordinals of images whose label changed
+        :param assigned: True = label was assigned, False = removed
+        """
+        if len(ordinals) == 0:
+            return
+        self.undo_stack.append((label, tuple(ordinals), assigned))
+        self.redo_stack.clear()
+
+    def undo(self):
+        """
+        :return: command which should be reverted or None
+        """
+        if not self.undo_stack:
+            return None
+        command = self.undo_stack.pop()
+        self.redo_stack.append(command)
+        return command
+
+    def redo(self):
+        """
+        :return: command which should be applied again or None
+        """
+        if not self.redo_stack:
+            return None
+        command = self.redo_stack.pop()
+        self.undo_stack.append(command)
+        return command
+
+
+def plan_commit(image_index, changes, mode, copy_method='copy'):
+    """
+    Plans file operations which turn committed labels of images into current labels
+    :param image_index: ImageIndex with paths of images
+    :param changes: list of (ordinal, committed labels, current labels), labels in the order of label list
+    :param mode: 'copy' or 'move'
+    :param copy_method: see file_ops.copy_file
+    :return: list of operation tuples (as for FileOpQueue): all copies, then moves, then removes
+    """
+    copies, moves, removes = [], [], []
+
+    for ordinal, before, after in changes:
+        img_path = image_index.paths[ordinal]
+        added = [label for label in after if label not in before]
+        removed = [label for label in before if label not in after]
+
+        def label_path(label):
+            return image_index.label_path(ordinal, label)
+
+        if mode == 'copy':
+            copies += [('copy', img_path, os.path.dirname(label_path(label)), copy_method) for label in added]
+            removes += [('remove', label_path(label)) for label in removed]
+
+        elif mode == 'move':
+            if not before:
+                # copies are made from the original before the original is moved into the first label folder
+                copies += [('copy', img_path, os.path.dirname(label_path(label)), copy_method) for label in added[1:]]
+                moves.append(('move', img_path, os.path.dirname(label_path(added[0]))))
+            elif not after:
+                # the last label was removed, the image goes back to its original folder
+                moves.append(('move', label_path(before[0]), os.path.dirname(img_path)))
+                removes += [('remove', label_path(label)) for label in before[1:]]
+            else:
+                copies += [('copy', label_path(before[0]), os.path.dirname(label_path(label)), copy_method)
+                           for label in added]
+                removes += [('remove', label_path(label)) for label in removed]
+
+    return copies + moves + removes
+
+
+def run_operation(op):
+    """
+    Executes the operation. Operations done already (by an interrupted commit) are skipped.
+    """
+    name = op[0]
+    if name == 'copy':
+        copy_file(*op[1:])
+    elif name == 'move':
+        src, dst_folder = op[1:]
+        dst = os.path.join(dst_folder, os.path.basename(src))
+        if not path_exists(src) and path_exists(dst):
+            return
+        move_file(src, dst_folder)
+    elif name == 'remove':
+        if path_exists(op[1]):
+            remove_file(op[1])
+    else:
+        raise ValueError(f'Unknown file operation: {name}')
+
+
+class CommitLog:
+    """
+    Saved commit plan and progress of its execution, committed labels of images
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.plan_path = os.path.join(folder, PLAN_FILENAME)
+        self.progress_path = os.path.join(folder, PROGRESS_FILENAME)
+        self.committed_path = os.path.join(folder, COMMITTED_FILENAME)
+
+    def load_committed(self):
+        """
+        :return: {img_key: [label, ...]} of labels which are in label folders, None if nothing was committed yet
+        """
+        try:
+            with open(self.committed_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f"Can't read committed labels: {e}")
+            return None
+
+    def save_committed(self, committed):
+        self._write_json(self.committed_path, committed)
+
+    def remove_committed(self):
+        if os.path.exists(self.committed_path):
+            os.remove(self.committed_path)
+
+    def load_plan(self):
+        """
+        :return: unfinished plan {'ops': [...], 'labels': {img_key: [label, ...]}} and number of executed
+            operations, or (None, 0)
+        """
+        try:
+            with open(self.plan_path, encoding='utf-8') as f:
+                plan = json.load(f)
+        except FileNotFoundError:
+            return None, 0
+        except ValueError as e:
+            print(f"Can't read commit plan: {e}")
+            return None, 0
+
+        try:
+            with open(self.progress_path, encoding='utf-8') as f:
+                done = sum(1 for line in f if line.endswith('\n'))
+        except FileNotFoundError:
+            done = 0
+        return plan, done
+
+    def execute(self, plan, start=0, on_error=print):
+        """
+        Saves the plan (when it is new) and executes its operations from start
+        :param plan: {'ops': list of operations, 'labels': committed labels of changed images after the commit}
+        :param start: number of operations executed by an interrupted commit
+        :param on_error: called with error message of a failed operation
+        :return: number of failed operations
+        """
+        if start == 0:
+            self._write_json(self.plan_path, plan)
+            open(self.progress_path, 'w').close()
+
+        errors = 0
+        with open(self.progress_path, 'a', encoding='utf-8') as progress:
+            for i in range(start, len(plan['ops'])):
+                op = plan['ops'][i]
+                try:
+                    run_operation(op)
+                except Exception as e:
+                    errors += 1
+                    on_error(f'{op[0]} {op[1]} failed: {e}')
+                progress.write(f'{i}\n')
+                progress.flush()
+        return errors
+
+    def finish(self):
+        for path in (self.plan_path, self.progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write_json(self, path, data):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
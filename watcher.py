@@ -0,0 +1,253 @@
+"""
+Watch mode: images created, renamed and deleted in the input folder are picked up while the app runs.
+
+Linux inotify is used through ctypes, so each event names the file which changed and is handled in O(1),
+no folder is listed again. A new image is reported when the writer closes it (IN_CLOSE_WRITE) or when
+it is renamed into the folder (IN_MOVED_TO), so half written files are never reported. Sub-folders renamed
+inside the watched folder keep their watches, sub-folders moved out of it are reported as deleted.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from scanning import IMG_EXTENSIONS, scan_img_paths
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# wd, mask, cookie, length of the name
+_EVENT = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+
+def watch_supported():
+    return _libc is not None
+
+
+class FolderWatcher(QThread):
+    """
+    Reports changes of images in the folder (and its sub-folders if recursive) in batches. A batch is a list
+    of events in the order they happened: ('created', path) for complete new images, ('deleted', path) for deleted
+    images (or images moved out of the folder), ('renamed', old path, new path) and ('folder_deleted', path)
+    for sub-folders moved out of the folder (with all their images).
+    """
+
+    changed = pyqtSignal(list)
+    overflowed = pyqtSignal()  # events were lost, the folder has to be scanned again
+    ready = pyqtSignal()  # folders are watched, images created from now on are reported
+
+    def __init__(self, folder, extensions=IMG_EXTENSIONS, recursive=False, exclude_dirs=(), move_timeout=0.2,
+                 parent=None):
+        """
+        :param exclude_dirs: names of sub-folders of the folder which are not watched (label folders, output)
+        :param move_timeout: image moved out of the folder is reported as deleted when it doesn't appear in
+            the folder (under another name) within this time (seconds)
+        """
+        super().__init__(parent)
+        self.folder = folder
+        self.extensions = extensions
+        self.recursive = recursive
+        self.exclude_dirs = set(exclude_dirs)
+        self.move_timeout = move_timeout
+
+        self._fd = None
+        self._folders = {}  # {watch descriptor: folder}
+        self._moves = {}  # {cookie: (old path, time)} images moved out, waiting for their new name
+        self._folder_moves = {}  # {cookie: (old path, time)} the same for sub-folders
+
+    def start_watching(self):
+        """
+        Starts the thread, which adds watches of the folder (and its sub-folders) and emits ready
+        :return: False if the platform doesn't support watching
+        """
+        if _libc is None:
+            return False
+
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            print(f"Can't watch folder: {os.strerror(ctypes.get_errno())}")
+            return False
+        self._fd = fd
+        self.start()
+        return True
+
+    def _add_watch(self, folder):
+        wd = _libc.inotify_add_watch(self._fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            print(f"Can't watch folder {folder}: {os.strerror(ctypes.get_errno())}")
+        else:
+            self._folders[wd] = folder
+
+    def _add_tree(self, folder):
+        self._add_watch(folder)
+        if not self.recursive:
+            return
+
+        stack = [folder]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) and not self._excluded(entry.path):
+                            self._add_watch(entry.path)
+                            stack.append(entry.path)
+            except OSError:
+                pass
+
+    def _rename_watches(self, old_folder, new_folder):
+        """
+        Watches follow the renamed folder, only paths reported by them change
+        """
+        prefix = old_folder + os.sep
+        for wd, folder in self._folders.items():
+            if folder == old_folder or folder.startswith(prefix):
+                self._folders[wd] = new_folder + folder[len(old_folder):]
+
+    def _remove_watches(self, folder):
+        """
+        Stops watching the folder and its sub-folders
+        """
+        prefix = folder + os.sep
+        for wd in [wd for wd, path in self._folders.items() if path == folder or path.startswith(prefix)]:
+            _libc.inotify_rm_watch(self._fd, wd)
+            del self._folders[wd]
+
+    def _excluded(self, path):
+        return (os.path.normpath(os.path.dirname(path)) == os.path.normpath(self.folder)
+                and os.path.basename(path) in self.exclude_dirs)
+
+    def _is_image(self, name):
+        return name.lower().endswith(self.extensions)
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+    def run(self):
+        poll = select.poll()
+        poll.register(self._fd, select.POLLIN)
+        try:
+            # listing of a big folder tree doesn't hold up the GUI
+            self._add_tree(self.folder)
+            self.ready.emit()
+            while not self.isInterruptionRequested():
+                if poll.poll(int(self.move_timeout * 1000)):
+                    self.read_events()
+                self.expire_moves()
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0'))
+            offset += _EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed.emit()
+                continue
+            if mask & IN_IGNORED:
+                self._folders.pop(wd, None)
+                continue
+            folder = self._folders.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name)
+
+            if mask & IN_ISDIR:
+                if self.recursive:
+                    events += self.folder_event(mask, cookie, path)
+                continue
+            if not self._is_image(name):
+                continue
+
+            if mask & IN_CLOSE_WRITE:
+                events.append(('created', path))
+            elif mask & IN_MOVED_FROM:
+                self._moves[cookie] = (path, time.monotonic())
+            elif mask & IN_MOVED_TO:
+                move = self._moves.pop(cookie, None)
+                events.append(('renamed', move[0], path) if move is not None else ('created', path))
+            elif mask & IN_DELETE:
+                events.append(('deleted', path))
+
+        if events:
+            self.changed.emit(events)
+
+    def folder_event(self, mask, cookie, path):
+        """
+        Handles sub-folder created, renamed, moved or deleted in the watched folder
+        :return: list of events of images in the sub-folder
+        """
+        if mask & IN_MOVED_FROM:
+            self._folder_moves[cookie] = (path, time.monotonic())
+            return []
+        if mask & IN_DELETE:
+            # only empty folder can be deleted, its images were reported already
+            self._remove_watches(path)
+            return []
+        if not mask & (IN_CREATE | IN_MOVED_TO) or self._excluded(path):
+            # folder moved into excluded folder is reported as deleted when its move expires
+            return []
+
+        move = self._folder_moves.pop(cookie, None) if mask & IN_MOVED_TO else None
+        images = scan_img_paths(path, self.extensions, recursive=True)
+        if move is not None:
+            old_folder = move[0]
+            self._rename_watches(old_folder, path)
+            return [('renamed', os.path.join(old_folder, os.path.relpath(image, path)), image) for image in images]
+
+        # new sub-folder is watched and images which got into it before the watch are reported
+        self._add_tree(path)
+        return [('created', image) for image in images]
+
+    def expire_moves(self):
+        """
+        Images and sub-folders moved out of the watched folders are reported as deleted
+        """
+        now = time.monotonic()
+        events = []
+        for cookie in [cookie for cookie, (_, moved) in self._moves.items() if now - moved >= self.move_timeout]:
+            events.append(('deleted', self._moves.pop(cookie)[0]))
+        for cookie in [cookie for cookie, (_, moved) in self._folder_moves.items()
+                       if now - moved >= self.move_timeout]:
+            folder = self._folder_moves.pop(cookie)[0]
+            self._remove_watches(folder)
+            events.append(('folder_deleted', folder))
+        if events:
+            self.changed.emit(events)